@@ -0,0 +1,662 @@
+"""In-process stand-ins for Motor and Pyrogram used by the benchmark harness.
+
+FakeMongoClient implements the slice of the Motor API that database.py uses, with a
+configurable round-trip latency and a counter per (collection, operation). FakeClient
+replaces pyrogram.Client: every API call sleeps for the configured latency, media moves
+at the configured transfer speed, and FloodWait can be injected at a given rate.
+"""
+import os
+import copy
+import random
+import asyncio
+import itertools
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pyrogram.errors import FloodWait, UserIsBlocked
+
+_MISSING = object()
+
+# Mongo
+
+def _get(doc: Dict[str, Any], path: str):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _set(doc: Dict[str, Any], path: str, value: Any):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+def _order(value) -> tuple:
+    # Enough of the BSON ordering for sorting and comparisons: null and missing sort first
+    if value is _MISSING or value is None:
+        return (0,)
+    return (1, value)
+
+def _compare(op: str, value, arg) -> bool:
+    if value is _MISSING:
+        return False
+    try:
+        left, right = _order(value), _order(arg)
+        return {"$gt": left > right, "$gte": left >= right, "$lt": left < right, "$lte": left <= right}[op]
+    except TypeError:
+        return False
+
+def _match_value(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        for op, arg in condition.items():
+            if op == "$eq":
+                ok = _match_value(value, arg)
+            elif op == "$ne":
+                ok = not _match_value(value, arg)
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                ok = _compare(op, value, arg)
+            elif op == "$in":
+                ok = any(_match_value(value, item) for item in arg)
+            elif op == "$nin":
+                ok = not any(_match_value(value, item) for item in arg)
+            elif op == "$exists":
+                ok = (value is not _MISSING) == bool(arg)
+            elif op == "$not":
+                ok = not _match_value(value, arg)
+            else:
+                raise NotImplementedError(f"query operator {op}")
+            if not ok:
+                return False
+        return True
+    if condition is None:
+        return value is None or value is _MISSING
+    return value == condition
+
+def matches(doc: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, branch) for branch in condition):
+                return False
+        elif key == "$expr":
+            if not evaluate(condition, doc):
+                return False
+        elif not _match_value(_get(doc, key), condition):
+            return False
+    return True
+
+def evaluate(expression, doc: Dict[str, Any]):
+    """Aggregation expressions as used by $expr and pipeline updates"""
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = _get(doc, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, list):
+        return [evaluate(item, doc) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) != 1 or not next(iter(expression)).startswith("$"):
+        return {key: evaluate(value, doc) for key, value in expression.items()}
+
+    op, args = next(iter(expression.items()))
+    if op == "$cond":
+        condition, then, otherwise = args
+        return evaluate(then if evaluate(condition, doc) else otherwise, doc)
+    values = [evaluate(arg, doc) for arg in args] if isinstance(args, list) else [evaluate(args, doc)]
+    if op == "$eq":
+        return values[0] == values[1]
+    if op == "$ne":
+        return values[0] != values[1]
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        return _compare(op, values[0], values[1])
+    if op == "$and":
+        return all(values)
+    if op == "$or":
+        return any(values)
+    if op == "$ifNull":
+        return next((value for value in values if value is not None), None)
+    if op == "$add":
+        return sum(values)
+    raise NotImplementedError(f"expression operator {op}")
+
+def apply_update(doc: Dict[str, Any], update, inserting: bool = False):
+    if isinstance(update, list):
+        for stage in update:
+            for op, fields in stage.items():
+                if op not in ("$set", "$addFields"):
+                    raise NotImplementedError(f"pipeline stage {op}")
+                values = {path: evaluate(value, doc) for path, value in fields.items()}
+                for path, value in values.items():
+                    _set(doc, path, value)
+        return
+
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            current = _get(doc, path)
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                _set(doc, path, arg)
+            elif op == "$inc":
+                _set(doc, path, (0 if current is _MISSING else current) + arg)
+            elif op == "$max":
+                if current is _MISSING or _order(arg) > _order(current):
+                    _set(doc, path, arg)
+            elif op == "$min":
+                if current is _MISSING or _order(arg) < _order(current):
+                    _set(doc, path, arg)
+            elif op == "$unset":
+                *parents, last = path.split(".")
+                parent = _get(doc, ".".join(parents)) if parents else doc
+                if isinstance(parent, dict):
+                    parent.pop(last, None)
+            elif op != "$setOnInsert":
+                raise NotImplementedError(f"update operator {op}")
+
+def project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {key for key, value in projection.items() if value and key != "_id"}
+    if include:
+        result = {key: copy.deepcopy(doc[key]) for key in include if key in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return {key: copy.deepcopy(value) for key, value in doc.items() if projection.get(key, 1)}
+
+def _sort_spec(key_or_list, direction=None) -> List[tuple]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    return list(key_or_list)
+
+class FakeCursor:
+    def __init__(self, collection: "FakeCollection", query, projection):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = []
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        await self.collection.roundtrip("find")
+        docs = self.collection.select(self.query, self._sort, self._limit or length or 0)
+        return [project(doc, self.projection) for doc in docs]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in await self.to_list():
+            yield doc
+
+class FakeAggregateCursor:
+    def __init__(self, collection: "FakeCollection", pipeline: List[Dict[str, Any]]):
+        self.collection = collection
+        self.pipeline = pipeline
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await self.collection.roundtrip("aggregate")
+        rows = list(self.collection.docs.values())
+        for stage in self.pipeline:
+            (op, spec), = stage.items()
+            if op == "$match":
+                rows = [row for row in rows if matches(row, spec)]
+            elif op == "$group":
+                groups = {}
+                for row in rows:
+                    key = evaluate(spec["_id"], row)
+                    group = groups.setdefault(key, {"_id": key})
+                    for field, accumulator in spec.items():
+                        if field == "_id":
+                            continue
+                        (acc_op, acc_arg), = accumulator.items()
+                        if acc_op != "$sum":
+                            raise NotImplementedError(f"accumulator {acc_op}")
+                        group[field] = group.get(field, 0) + (evaluate(acc_arg, row) or 0)
+                rows = list(groups.values())
+            else:
+                raise NotImplementedError(f"aggregation stage {op}")
+        for row in rows:
+            yield row
+
+class FakeCollection:
+    def __init__(self, client: "FakeMongoClient", name: str):
+        self.client = client
+        self.name = name
+        self.docs: Dict[Any, Dict[str, Any]] = {}
+        self.indexes: Dict[str, Dict[str, Any]] = {"_id_": {"key": [("_id", 1)]}}
+        self._unique = []
+        # Sorted views for single-field sorts, rebuilt after writes (broadcast keyset scans rely on it)
+        self._sorted: Dict[str, tuple] = {}
+
+    async def roundtrip(self, operation: str):
+        self.client.calls[(self.name, operation)] += 1
+        await asyncio.sleep(self.client.latency)
+
+    def seed(self, docs: List[Dict[str, Any]]):
+        """Load documents directly, without latency or counting"""
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+            self.docs[doc["_id"]] = doc
+        self._sorted.clear()
+
+    # Internals
+    def select(self, query, sort: List[tuple], limit: int = 0) -> List[Dict[str, Any]]:
+        if "_id" in query and not isinstance(query["_id"], dict):
+            candidates = [self.docs[query["_id"]]] if query["_id"] in self.docs else []
+        elif len(sort) == 1:
+            candidates = self._range(sort[0], query)
+        else:
+            candidates = self.docs.values()
+            for key, direction in reversed(sort):
+                candidates = sorted(candidates, key=lambda doc: _order(_get(doc, key)), reverse=direction < 0)
+        selected = []
+        for doc in candidates:
+            if matches(doc, query):
+                selected.append(doc)
+                if limit and len(selected) >= limit:
+                    break
+        return selected
+
+    def _range(self, sort: tuple, query):
+        key, direction = sort
+        if key not in self._sorted:
+            docs = sorted(self.docs.values(), key=lambda doc: _order(_get(doc, key)))
+            self._sorted[key] = ([_order(_get(doc, key)) for doc in docs], docs)
+        keys, docs = self._sorted[key]
+        start, end = 0, len(docs)
+        condition = query.get(key)
+        if isinstance(condition, dict):
+            if "$gt" in condition:
+                start = bisect_right(keys, _order(condition["$gt"]))
+            if "$lt" in condition:
+                end = bisect_left(keys, _order(condition["$lt"]))
+        view = docs[start:end]
+        return view if direction > 0 else reversed(view)
+
+    def _first(self, query, sort=None) -> Optional[Dict[str, Any]]:
+        found = self.select(query, _sort_spec(sort) if sort else [], 1)
+        return found[0] if found else None
+
+    def _check_unique(self, doc: Dict[str, Any], ignore=None):
+        for fields in self._unique:
+            key = tuple(_get(doc, field) for field in fields)
+            for other in self.docs.values():
+                if other is not ignore and other["_id"] != doc.get("_id") and \
+                        tuple(_get(other, field) for field in fields) == key:
+                    raise DuplicateKeyError(f"E11000 duplicate key on {self.name} {fields}", 11000)
+        if ignore is None and doc.get("_id") in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate _id on {self.name}", 11000)
+
+    def _write(self, doc: Dict[str, Any]):
+        self.docs[doc["_id"]] = doc
+        self._sorted.clear()
+
+    def _upsert_doc(self, query, update) -> Dict[str, Any]:
+        doc = {key: value for key, value in query.items()
+               if not key.startswith("$") and not (isinstance(value, dict) and any(k.startswith("$") for k in value))}
+        apply_update(doc, update, inserting=True)
+        doc.setdefault("_id", ObjectId())
+        self._check_unique(doc)
+        self._write(doc)
+        return doc
+
+    def _update(self, doc: Dict[str, Any], update) -> bool:
+        before = copy.deepcopy(doc)
+        apply_update(doc, update)
+        self._sorted.clear()
+        return doc != before
+
+    # Motor API
+    async def create_index(self, keys, unique: bool = False, name: Optional[str] = None, **options):
+        await self.roundtrip("create_index")
+        keys = _sort_spec(keys)
+        name = name or "_".join(f"{key}_{direction}" for key, direction in keys)
+        self.indexes[name] = {"key": keys, **options}
+        if unique:
+            self._unique.append([key for key, _ in keys])
+        return name
+
+    async def index_information(self) -> Dict[str, Dict[str, Any]]:
+        await self.roundtrip("index_information")
+        return copy.deepcopy(self.indexes)
+
+    async def drop_index(self, name: str):
+        await self.roundtrip("drop_index")
+        if name not in self.indexes:
+            raise OperationFailure(f"index not found with name [{name}]")
+        del self.indexes[name]
+
+    async def insert_one(self, doc: Dict[str, Any]):
+        await self.roundtrip("insert_one")
+        doc.setdefault("_id", ObjectId())
+        self._check_unique(doc)
+        self._write(copy.deepcopy(doc))
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    async def find_one(self, query=None, projection=None, **kwargs):
+        await self.roundtrip("find_one")
+        doc = self._first(query or {}, kwargs.get("sort"))
+        return project(doc, projection) if doc else None
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(self, query, projection)
+
+    def aggregate(self, pipeline: List[Dict[str, Any]]):
+        return FakeAggregateCursor(self, pipeline)
+
+    async def count_documents(self, query: Dict[str, Any]) -> int:
+        await self.roundtrip("count_documents")
+        return sum(1 for doc in self.docs.values() if matches(doc, query))
+
+    async def estimated_document_count(self) -> int:
+        await self.roundtrip("estimated_document_count")
+        return len(self.docs)
+
+    async def update_one(self, query, update, upsert: bool = False):
+        await self.roundtrip("update_one")
+        return self._update_one(query, update, upsert)
+
+    def _update_one(self, query, update, upsert: bool):
+        doc = self._first(query)
+        if doc is None:
+            if not upsert:
+                return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=self._upsert_doc(query, update)["_id"])
+        return SimpleNamespace(matched_count=1, modified_count=int(self._update(doc, update)), upserted_id=None)
+
+    async def update_many(self, query, update):
+        await self.roundtrip("update_many")
+        docs = [doc for doc in self.docs.values() if matches(doc, query)]
+        modified = sum(self._update(doc, update) for doc in docs)
+        return SimpleNamespace(matched_count=len(docs), modified_count=modified)
+
+    async def find_one_and_update(self, query, update, projection=None, upsert: bool = False,
+                                  return_document=ReturnDocument.BEFORE, sort=None):
+        await self.roundtrip("find_one_and_update")
+        doc = self._first(query, sort)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = self._upsert_doc(query, update)
+            return project(doc, projection) if return_document == ReturnDocument.AFTER else None
+        before = project(doc, projection)
+        self._update(doc, update)
+        return project(doc, projection) if return_document == ReturnDocument.AFTER else before
+
+    async def find_one_and_delete(self, query, projection=None):
+        await self.roundtrip("find_one_and_delete")
+        doc = self._first(query)
+        if doc is None:
+            return None
+        del self.docs[doc["_id"]]
+        self._sorted.clear()
+        return project(doc, projection)
+
+    async def delete_one(self, query):
+        await self.roundtrip("delete_one")
+        doc = self._first(query)
+        if doc is not None:
+            del self.docs[doc["_id"]]
+            self._sorted.clear()
+        return SimpleNamespace(deleted_count=int(doc is not None))
+
+    async def delete_many(self, query):
+        await self.roundtrip("delete_many")
+        ids = [doc["_id"] for doc in self.docs.values() if matches(doc, query)]
+        for doc_id in ids:
+            del self.docs[doc_id]
+        self._sorted.clear()
+        return SimpleNamespace(deleted_count=len(ids))
+
+    async def bulk_write(self, operations, ordered: bool = True):
+        await self.roundtrip("bulk_write")
+        for operation in operations:
+            # pymongo's UpdateOne keeps its arguments in these attributes
+            self._update_one(operation._filter, operation._doc, operation._upsert)
+        return SimpleNamespace(modified_count=len(operations))
+
+class FakeMongoDatabase:
+    def __init__(self, client: "FakeMongoClient", name: str):
+        self.client = client
+        self.name = name
+        self._collections: Dict[str, FakeCollection] = {}
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self.client, name)
+        return self._collections[name]
+
+    async def command(self, *args, **kwargs):
+        self.client.calls[("$cmd", args[0] if args else "command")] += 1
+        await asyncio.sleep(self.client.latency)
+        return {"ok": 1}
+
+class FakeMongoClient:
+    """Drop-in for motor's AsyncIOMotorClient; set `latency` and read `calls` on the class"""
+
+    latency = 0.0
+    calls = Counter()
+
+    def __init__(self, uri: Optional[str] = None, **kwargs):
+        self._databases: Dict[str, FakeMongoDatabase] = {}
+
+    def __getitem__(self, name: str) -> FakeMongoDatabase:
+        if name not in self._databases:
+            self._databases[name] = FakeMongoDatabase(self, name)
+        return self._databases[name]
+
+    def close(self):
+        pass
+
+# Telegram
+
+class FakeMedia(SimpleNamespace):
+    pass
+
+class FakeMessage:
+    def __init__(self, client: "FakeClient", chat_id: int, message_id: int, text: Optional[str] = None,
+                 kind: Optional[str] = None, media: Optional[FakeMedia] = None, from_user=None,
+                 protected: bool = False, reply_to_message=None):
+        self._client = client
+        self.id = message_id
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = from_user
+        self.text = text
+        self.caption = None
+        self.empty = False
+        self.has_protected_content = protected
+        self.reply_to_message = reply_to_message
+        self.kind = kind
+        self.media = media
+        for name in ("document", "video", "audio", "photo"):
+            setattr(self, name, media if name == kind else None)
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        return await self._client.send_message(self.chat.id, text, **kwargs)
+
+    async def edit_text(self, text: str, **kwargs) -> "FakeMessage":
+        await self._client.edit_message_text(self.chat.id, self.id, text, **kwargs)
+        return self
+
+    async def copy(self, chat_id: int, caption: Optional[str] = None, **kwargs) -> "FakeMessage":
+        return await self._client.copy_message(chat_id, self.chat.id, self.id, caption=caption)
+
+class FakeTelegram:
+    """The server side every FakeClient shares: chats of messages"""
+
+    def __init__(self):
+        self.chats: Dict[int, Dict[int, FakeMessage]] = defaultdict(dict)
+        self._ids = defaultdict(lambda: itertools.count(1))
+        self._file_ids = itertools.count(1)
+
+    def next_id(self, chat_id: int) -> int:
+        return next(self._ids[chat_id])
+
+    def new_file_id(self) -> str:
+        # Real file IDs are long, keep them long so anything built from them is realistic
+        return f"BQACAgUAAxkBAAI{next(self._file_ids):012d}" + "x" * 40
+
+class FakeClient:
+    """Drop-in for pyrogram.Client; configure the class attributes before creating clients"""
+
+    api_latency = 0.05  # seconds per API call
+    transfer_speed = 50 * 1024 * 1024  # bytes per second for media transfers
+    flood_wait_rate = 0.0  # share of calls answered with FloodWait
+    flood_wait_seconds = 1
+    blocked_chats = set()  # users who blocked the bot, copy_message to them fails
+    rng = random.Random(42)
+    calls = Counter()
+    telegram = FakeTelegram()
+
+    def __init__(self, name: str = "fake", *args, **kwargs):
+        self.name = name
+        self.handlers = []
+
+    # Decorators used by bot.py at import time
+    def on_message(self, filters=None, group: int = 0):
+        def decorator(func):
+            self.handlers.append(("message", filters, func))
+            return func
+        return decorator
+
+    def on_callback_query(self, filters=None, group: int = 0):
+        def decorator(func):
+            self.handlers.append(("callback_query", filters, func))
+            return func
+        return decorator
+
+    async def start(self):
+        return self
+
+    async def stop(self):
+        return self
+
+    def run(self, coroutine=None):
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    async def call(self, method: str):
+        FakeClient.calls[method] += 1
+        if self.flood_wait_rate and self.rng.random() < self.flood_wait_rate:
+            FakeClient.calls["flood_wait"] += 1
+            raise FloodWait(value=self.flood_wait_seconds)
+        await asyncio.sleep(self.api_latency)
+
+    def store(self, chat_id: int, **fields) -> FakeMessage:
+        message = FakeMessage(self, chat_id, self.telegram.next_id(chat_id), **fields)
+        self.telegram.chats[chat_id][message.id] = message
+        return message
+
+    def incoming(self, user_id: int, kind: str, file_size: int, file_unique_id: str,
+                 file_name: Optional[str] = None, protected: bool = False) -> FakeMessage:
+        """A media message a user sent to the bot"""
+        media = FakeMedia(
+            file_id=self.telegram.new_file_id(),
+            file_unique_id=file_unique_id,
+            file_size=file_size,
+            file_name=file_name,
+            mime_type="image/jpeg" if kind == "photo" else "video/mp4" if kind == "video" else "application/zip"
+        )
+        user = SimpleNamespace(id=user_id, first_name=f"user{user_id}")
+        return self.store(user_id, kind=kind, media=media, from_user=user, protected=protected)
+
+    # Messages
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> FakeMessage:
+        await self.call("send_message")
+        return self.store(chat_id, text=text)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs):
+        await self.call("edit_message_text")
+        message = self.telegram.chats[chat_id].get(message_id)
+        if message:
+            message.text = text
+        return message
+
+    async def copy_message(self, chat_id: int, from_chat_id: int, message_id: int,
+                           caption: Optional[str] = None, **kwargs) -> FakeMessage:
+        await self.call("copy_message")
+        if chat_id in self.blocked_chats:
+            raise UserIsBlocked()
+        source = self.telegram.chats[from_chat_id][message_id]
+        media = None
+        if source.media:
+            media = FakeMedia(**{**vars(source.media), "file_id": self.telegram.new_file_id()})
+        copied = self.store(chat_id, text=source.text, kind=source.kind, media=media)
+        copied.caption = caption
+        return copied
+
+    async def get_messages(self, chat_id: int, message_ids):
+        await self.call("get_messages")
+        chat = self.telegram.chats[chat_id]
+        if isinstance(message_ids, list):
+            return [chat.get(message_id) for message_id in message_ids]
+        return chat.get(message_ids)
+
+    async def delete_messages(self, chat_id: int, message_ids):
+        await self.call("delete_messages")
+        ids = message_ids if isinstance(message_ids, list) else [message_ids]
+        for message_id in ids:
+            self.telegram.chats[chat_id].pop(message_id, None)
+
+    # Media
+    async def stream_media(self, message: FakeMessage, offset: int = 0, limit: int = 0):
+        chunk_size = 1024 * 1024
+        total = -(-message.media.file_size // chunk_size)
+        end = min(total, offset + limit) if limit else total
+        await self.call("stream_media")
+        for index in range(offset, end):
+            length = min(chunk_size, message.media.file_size - index * chunk_size)
+            await asyncio.sleep(length / self.transfer_speed)
+            yield bytes(length)
+
+    async def _send_media(self, kind: str, chat_id: int, path: str, file_name: Optional[str],
+                          caption: Optional[str]) -> FakeMessage:
+        await self.call(f"send_{kind}")
+        size = os.path.getsize(path)
+        await asyncio.sleep(size / self.transfer_speed)
+        media = FakeMedia(
+            file_id=self.telegram.new_file_id(),
+            file_unique_id=f"up{self.telegram.new_file_id()[-20:]}",
+            file_size=size,
+            file_name=file_name,
+            mime_type="application/octet-stream"
+        )
+        message = self.store(chat_id, kind=kind, media=media)
+        message.caption = caption
+        return message
+
+    async def send_document(self, chat_id: int, document: str, file_name: Optional[str] = None,
+                            caption: Optional[str] = None, **kwargs) -> FakeMessage:
+        return await self._send_media("document", chat_id, document, file_name, caption)
+
+    async def send_video(self, chat_id: int, video: str, file_name: Optional[str] = None,
+                         caption: Optional[str] = None, **kwargs) -> FakeMessage:
+        return await self._send_media("video", chat_id, video, file_name, caption)
+
+    async def send_audio(self, chat_id: int, audio: str, file_name: Optional[str] = None,
+                         caption: Optional[str] = None, **kwargs) -> FakeMessage:
+        return await self._send_media("audio", chat_id, audio, file_name, caption)
+
+    async def send_photo(self, chat_id: int, photo: str, caption: Optional[str] = None, **kwargs) -> FakeMessage:
+        return await self._send_media("photo", chat_id, photo, None, caption)
@@ -0,0 +1,362 @@
+"""Benchmarks for the upload, broadcast and streaming paths with Telegram and Mongo faked.
+
+The real handlers, Database, BroadcastEngine and StreamServer run unchanged; only
+pyrogram.Client and motor's client are swapped for the fakes in fakes.py. Every run uses
+a fixed seed and records the commit, so results from different commits can be compared:
+
+    python benchmarks/run.py upload_burst --json before.json
+    python benchmarks/run.py upload_burst --baseline before.json
+    python benchmarks/run.py all --json results/   # one process per scenario
+
+Each scenario runs in its own process, so peak RSS is that scenario's own high-water mark.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+SCENARIOS = {}
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+def git_commit() -> Optional[str]:
+    try:
+        commit = subprocess.run(["git", "-C", REPO, "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "-C", REPO, "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux (bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / MB if sys.platform == "darwin" else peak / 1024
+
+async def timed(coroutine, latencies: List[float]):
+    started = time.perf_counter()
+    try:
+        return await coroutine
+    finally:
+        latencies.append(time.perf_counter() - started)
+
+def load_bot(args):
+    """Import bot.py against the fakes, inside a scratch directory for downloads/, logs/ and data/"""
+    os.environ.update({
+        "DATABASE_URL": "mongodb://benchmark",
+        "BOT_USERNAME": "benchmark_bot",
+        "ADMINS": "1",
+        "BIN_CHANNEL": "-1001",
+        "LOG_CHANNEL": "-1002",
+        "FREE_DAILY_LIMIT": "1000000000",
+        "PREMIUM_DAILY_LIMIT": "1000000000",
+        "FREE_FILE_SIZE": str(16 * 1024 * MB),
+        "PORT": "0",
+        "JOB_QUEUE": "false",
+        "WORKER_PROCESSES": "0",
+        "CHUNK_DISK_CACHE_SIZE": "0",
+        "BROADCAST_RATE": str(args.broadcast_rate),
+        # The fakes don't enforce Telegram's message limits, pacing to them would hide the code's cost
+        "OUTBOUND_RATE": "100000",
+        "OUTBOUND_CHAT_RATE": "100000",
+        "OUTBOUND_GROUP_RATE": "100000",
+    })
+    os.chdir(tempfile.mkdtemp(prefix="mystream-bench-"))
+    sys.path.insert(0, REPO)
+
+    import pyrogram
+    import motor.motor_asyncio
+    from fakes import FakeClient, FakeMongoClient
+
+    FakeMongoClient.latency = args.mongo_latency
+    FakeClient.api_latency = args.api_latency
+    FakeClient.transfer_speed = args.speed * MB
+    FakeClient.flood_wait_rate = args.flood_rate
+    FakeClient.flood_wait_seconds = args.flood_seconds
+    FakeClient.rng.seed(args.seed)
+    pyrogram.Client = FakeClient
+    motor.motor_asyncio.AsyncIOMotorClient = FakeMongoClient
+
+    import bot
+    bot.prepare_directories()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    return bot
+
+def reset_counters():
+    from fakes import FakeClient, FakeMongoClient
+    FakeClient.calls.clear()
+    FakeMongoClient.calls.clear()
+
+def build_result(name: str, args, operations: int, seconds: float, latencies: List[float],
+                 **extra) -> Dict[str, Any]:
+    from fakes import FakeClient, FakeMongoClient
+    mongo_calls = sum(FakeMongoClient.calls.values())
+    telegram_calls = sum(count for method, count in FakeClient.calls.items() if method != "flood_wait")
+    return {
+        "scenario": name,
+        "commit": git_commit(),
+        "params": {key: value for key, value in vars(args).items() if key not in ("json", "baseline", "verbose")},
+        "operations": operations,
+        "seconds": round(seconds, 3),
+        "throughput": round(operations / seconds, 2) if seconds else 0.0,
+        "latency_p50": round(percentile(latencies, 50), 4),
+        "latency_p99": round(percentile(latencies, 99), 4),
+        "latency_max": round(max(latencies, default=0.0), 4),
+        "mongo_calls_per_op": round(mongo_calls / operations, 3) if operations else 0.0,
+        "telegram_calls_per_op": round(telegram_calls / operations, 3) if operations else 0.0,
+        "flood_waits": FakeClient.calls.get("flood_wait", 0),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "mongo_calls": {f"{collection}.{op}": count for (collection, op), count in sorted(FakeMongoClient.calls.items())},
+        **extra
+    }
+
+# Scenarios
+
+@scenario
+async def upload_burst(bot, args) -> Dict[str, Any]:
+    """`--uploads` files from `--users` users all arriving at once through file_handler"""
+    users = args.users or 100
+    await bot.db.ensure_indexes()
+    bot.db.start_write_behind()
+
+    rng = random.Random(args.seed)
+    messages = []
+    for index in range(args.uploads):
+        if index and rng.random() < args.dedup_ratio:
+            unique_id = f"file{rng.randrange(index)}"  # the same file sent again
+        else:
+            unique_id = f"file{index}"
+        messages.append(bot.app.incoming(
+            10_000 + index % users, "document", args.file_size, unique_id, f"{unique_id}.bin",
+            protected=rng.random() < args.reupload_ratio  # protected content takes the re-upload path
+        ))
+
+    reset_counters()
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(bot.file_handler(bot.app, message), latencies) for message in messages))
+    seconds = time.perf_counter() - started
+    await bot.db.stop_write_behind()
+
+    replies = [message.text or "" for chat_id in {m.chat.id for m in messages}
+               for message in bot.app.telegram.chats[chat_id].values()]
+    return build_result(
+        "upload_burst", args, len(messages), seconds, latencies,
+        completed=sum(text.startswith("**✅ File Ready!**") for text in replies),
+        failed=sum(text.startswith("❌ Error") for text in replies)
+    )
+
+@scenario
+async def broadcast(bot, args) -> Dict[str, Any]:
+    """A /broadcast to `--users` users (default 100k), `--dead-ratio` of whom blocked the bot"""
+    users = args.users or 100_000
+    await bot.db.ensure_indexes()
+    rng = random.Random(args.seed)
+    bot.db.users.seed([
+        {"id": 10_000 + index, "is_banned": False, "is_premium": False, "daily_usage": 0}
+        for index in range(users)
+    ])
+    bot.app.blocked_chats.update(10_000 + index for index in range(users) if rng.random() < args.dead_ratio)
+
+    admin = 1
+    source = bot.app.store(admin, text="Hello everyone!")
+    command = bot.app.store(admin, text="/broadcast", reply_to_message=source)
+
+    batch_latencies = []
+    send_batch = bot.broadcaster._send_batch
+
+    async def timed_batch(*batch_args):
+        return await timed(send_batch(*batch_args), batch_latencies)
+
+    bot.broadcaster._send_batch = timed_batch
+    reset_counters()
+    bot.broadcaster.start()
+    started = time.perf_counter()
+    await bot.broadcast_handler(bot.app, command)
+    while not any(doc["status"] == "done" for doc in bot.db.broadcasts.docs.values()):
+        await asyncio.sleep(0.05)
+    seconds = time.perf_counter() - started
+    await bot.broadcaster.stop()
+
+    done = next(iter(bot.db.broadcasts.docs.values()))
+    return build_result(
+        "broadcast", args, users, seconds, batch_latencies,
+        latency_unit=f"one batch of {bot.Config.BROADCAST_BATCH_SIZE}",
+        success=done["success"], failed=done["failed"], dead=done["dead"]
+    )
+
+@scenario
+async def streaming(bot, args) -> Dict[str, Any]:
+    """`--requests` Range requests over `--files` stored files from `--clients` concurrent clients"""
+    from aiohttp import ClientSession
+    from aiohttp.test_utils import TestServer
+    from links import build_links
+    from server import StreamServer
+
+    await bot.db.ensure_indexes()
+    bot.db.start_write_behind()
+    files = []
+    for index in range(args.files):
+        source = bot.app.incoming(10_000, "video", args.file_size, f"stream{index}", f"video{index}.mp4")
+        stored = await source.copy(bot.Config.BIN_CHANNEL)
+        record = await bot.db.add_file_record(
+            file_id=stored.media.file_id, file_name=stored.media.file_name, file_size=stored.media.file_size,
+            mime_type="video/mp4", bin_message_id=stored.id, user_id=10_000, premium=False,
+            file_unique_id=f"stream{index}"
+        )
+        files.append((stored.media, urlsplit(build_links(record)['stream_link']).path))
+
+    pool = bot.pool
+    await pool.start()
+    bot.lifecycle.mark_ready()
+    # Without the local tier, so every range goes through the Telegram backend
+    test_server = TestServer(StreamServer(bot.telegram_storage, None, bot.db, bot.lifecycle).app)
+    await test_server.start_server()
+
+    rng = random.Random(args.seed)
+    # A few hot files get most of the traffic, like shared links do
+    weights = [1 / (rank + 1) for rank in range(len(files))]
+    plan = []
+    for _ in range(args.requests):
+        media, path = rng.choices(files, weights)[0]
+        start = rng.randrange(0, max(1, media.file_size - args.range_size * MB)) // MB * MB
+        plan.append((path, start, min(media.file_size, start + args.range_size * MB) - 1))
+
+    reset_counters()
+    latencies = []
+    received = 0
+    semaphore = asyncio.Semaphore(args.clients)
+
+    async def fetch(session, path, start, end):
+        async with semaphore:
+            async def request():
+                nonlocal received
+                async with session.get(test_server.make_url(path),
+                                       headers={"Range": f"bytes={start}-{end}"}) as response:
+                    body = await response.read()
+                    received += len(body)
+            await timed(request(), latencies)
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(fetch(session, *request) for request in plan))
+    seconds = time.perf_counter() - started
+
+    await test_server.close()
+    await pool.stop()
+    await bot.db.stop_write_behind()
+    return build_result(
+        "streaming", args, len(plan), seconds, latencies,
+        mb_per_second=round(received / MB / seconds, 2) if seconds else 0.0,
+        chunk_cache_hit_ratio=round(pool.cache.hit_ratio(), 3)
+    )
+
+# Reporting
+
+COMPARED = ("throughput", "latency_p50", "latency_p99", "mongo_calls_per_op", "telegram_calls_per_op", "peak_rss_mb")
+
+def print_result(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    print(f"\n== {result['scenario']} @ {result['commit']} ==")
+    for key, value in result.items():
+        if key in ("scenario", "commit", "params", "mongo_calls"):
+            continue
+        line = f"{key:>24}: {value}"
+        if baseline and key in COMPARED and baseline.get(key):
+            change = (value - baseline[key]) / baseline[key] * 100
+            line += f"   (was {baseline[key]} @ {baseline.get('commit')}, {change:+.1f}%)"
+        print(line)
+    print(f"{'mongo calls':>24}:")
+    for operation, count in result["mongo_calls"].items():
+        print(f"{'':>26}{operation}: {count}")
+
+def load_json(path: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def run_all(args, argv: List[str]):
+    """Run every scenario in a fresh process; --json and --baseline are taken as directories"""
+    passthrough = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ("--json", "--baseline"):
+            skip = True
+        elif arg != "all":
+            passthrough.append(arg)
+
+    for name in SCENARIOS:
+        command = [sys.executable, os.path.abspath(__file__), name, *passthrough]
+        if args.json:
+            os.makedirs(args.json, exist_ok=True)
+            command += ["--json", os.path.join(args.json, f"{name}.json")]
+        if args.baseline:
+            command += ["--baseline", os.path.join(args.baseline, f"{name}.json")]
+        subprocess.run(command, check=False)
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=[*SCENARIOS, "all"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mongo-latency", type=float, default=0.002, help="seconds per Mongo round trip")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds per Telegram API call")
+    parser.add_argument("--speed", type=float, default=50, help="Telegram transfer speed in MB/s")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of API calls answered with FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--users", type=int, default=0, help="100 for upload_burst, 100000 for broadcast")
+    parser.add_argument("--uploads", type=int, default=500)
+    # Not a whole number of parts, so downloads and reads go through a partial last part
+    parser.add_argument("--file-size", type=int, default=8 * MB + 123, help="bytes per file")
+    parser.add_argument("--dedup-ratio", type=float, default=0.2)
+    parser.add_argument("--reupload-ratio", type=float, default=0.1)
+    parser.add_argument("--dead-ratio", type=float, default=0.01)
+    parser.add_argument("--broadcast-rate", type=float, default=5000, help="BROADCAST_RATE for the run")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--range-size", type=int, default=2, help="MB per Range request")
+    parser.add_argument("--json", help="write the result here")
+    parser.add_argument("--baseline", help="a previous --json result to compare against")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    for attr in ("json", "baseline"):
+        if getattr(args, attr):
+            setattr(args, attr, os.path.abspath(getattr(args, attr)))
+
+    if args.scenario == "all":
+        run_all(args, argv)
+        return
+
+    bot = load_bot(args)
+    result = asyncio.get_event_loop().run_until_complete(SCENARIOS[args.scenario](bot, args))
+    print_result(result, load_json(args.baseline))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,44 +1,84 @@
 import os
+import sys
 import time
 import datetime
 import logging
 import asyncio
-import aiohttp
-import json
-from urllib.parse import quote
-from config import Config
+from typing import Any, Dict, Optional
+import metrics
+from config import Config, session_name
+from links import build_links, local_stream_url, sign
+from mediainfo import MediaProcessor, cached_thumbnail, describe, from_telegram
 from database import Database
-from pyrogram import Client, filters, enums
+from server import StreamServer
+from client_pool import ClientPool
+from storage import LocalStorage, StoredObject, TelegramStorage
+from ratelimit import OutboundScheduler
+from broadcast import BroadcastEngine
+from scheduler import ExpiryScheduler
+from pipeline import UploadQueue
+from cluster import Cluster
+from stats import StatsReconciler
+from lifecycle import Lifecycle
+from downloader import download_media, throttled_progress, PartialFileSweeper, PART_SUFFIX
+from pyrogram import Client, filters, idle
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
-from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated
-
-# Create necessary directories
-os.makedirs("downloads", exist_ok=True)
-os.chmod("downloads", 0o755)
-os.makedirs("data/files", exist_ok=True)
-os.makedirs("data/thumbnails", exist_ok=True)
-os.makedirs("logs", exist_ok=True)
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/bot.log'),
-        logging.StreamHandler()
-    ]
-)
+from pyrogram.errors import FloodWait, MessageNotModified
+from bson import ObjectId
+from bson.errors import InvalidId
+
 logger = logging.getLogger(__name__)
 
+# Importing this module only builds objects: directories, logging and every
+# connection are set up when the process starts
+def prepare_directories():
+    os.makedirs("downloads", exist_ok=True)
+    os.chmod("downloads", 0o755)
+    os.makedirs("data/files", exist_ok=True)
+    os.makedirs("logs", exist_ok=True)
+    # Sessions hold the bots' auth keys
+    os.makedirs(Config.SESSION_DIR, exist_ok=True)
+    os.chmod(Config.SESSION_DIR, 0o700)
+
+def configure_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('logs/bot.log'),
+            logging.StreamHandler()
+        ]
+    )
+
 app = Client(
-    "MystreamBot",
+    session_name(Config.SESSION_NAME, Config.BOT_TOKEN),
     api_id=Config.API_ID,
     api_hash=Config.API_HASH,
     bot_token=Config.BOT_TOKEN,
-    in_memory=True,
-    workers=100
+    # A persistent session skips re-authorizing and keeps the peer cache across restarts
+    workdir=Config.SESSION_DIR,
+    workers=100,
+    # Only the bot instance polls updates, workers use the same token just to move files
+    no_updates=Config.ROLE == "worker"
 )
 
-db = Database(Config.DATABASE_URL, Config.BOT_USERNAME)
+db = Database(Config.DATABASE_URL, Config.BOT_USERNAME, Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+pool = ClientPool(app)
+outbound = OutboundScheduler()
+# BIN_CHANNEL holds every file; the local tier only exists where the stream server runs
+telegram_storage = TelegramStorage(app, pool, outbound)
+local_storage = LocalStorage() if Config.PORT and Config.LOCAL_STORAGE_SIZE > 0 else None
+storage_backends = [backend for backend in (local_storage, telegram_storage) if backend]
+broadcaster = BroadcastEngine(app, db, outbound)
+expiry_scheduler = ExpiryScheduler(db, storage_backends)
+partial_sweeper = PartialFileSweeper("downloads")
+media_processor = MediaProcessor()
+lifecycle = Lifecycle()
+upload_queue = UploadQueue(Config.MAX_CONCURRENT_UPLOADS, Config.MAX_UPLOADS_PER_USER, Config.DOWNLOAD_DISK_BUDGET)
+cluster = Cluster(db)
+cluster.add_leader_service(broadcaster)
+cluster.add_leader_service(expiry_scheduler)
+cluster.add_leader_service(StatsReconciler(db))
 
 # Global variables
 BIN_CHANNEL = Config.BIN_CHANNEL
@@ -46,17 +86,16 @@ AUTO_DELETE_TIME = Config.AUTO_DELETE_TIME
 ADMINS = Config.ADMINS
 
 @app.on_message(filters.command("start") & filters.private)
+@metrics.track_handler
 async def start_command(client, message: Message):
     user_id = message.from_user.id
     if not await db.is_user_exist(user_id):
         await db.add_user(user_id)
-        try:
-            await client.send_message(
-                Config.LOG_CHANNEL,
-                f"#NEW_USER: \n\nNew User [{message.from_user.first_name}](tg://user?id={message.from_user.id}) started !!"
-            )
-        except:
-            pass
+        outbound.submit(
+            "log", Config.LOG_CHANNEL, client.send_message,
+            Config.LOG_CHANNEL,
+            f"#NEW_USER: \n\nNew User [{message.from_user.first_name}](tg://user?id={message.from_user.id}) started !!"
+        )
     
     if len(message.command) > 1:
         if message.command[1] == "plans":
@@ -83,24 +122,171 @@ async def start_command(client, message: Message):
         ])
     )
 
+# Ways a file can end up in BIN_CHANNEL, cheapest first
+UPLOAD_PATHS = ("dedup", "copy", "reupload")
+
+def record_upload_path(path: str, started: float, failed: bool = False):
+    if failed:
+        metrics.UPLOAD_PATH_ERRORS.inc(path=path)
+    else:
+        metrics.UPLOAD_PATH_SECONDS.observe(time.monotonic() - started, path=path)
+
+def needs_reupload(message: Message) -> bool:
+    """The server-side copy keeps the original file, so only re-upload when that is not enough"""
+    if getattr(message, "has_protected_content", False):
+        return True
+    if Config.FORCE_THUMBNAIL and not message.photo and os.path.exists(Config.THUMBNAIL_PATH):
+        return True
+    return False
+
+def stored_file(stored_object: StoredObject, content_hash: Optional[str] = None,
+                media_info: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    stored = {
+        "file_id": stored_object.ref,
+        "bin_message_id": stored_object.key,
+        "content_hash": content_hash
+    }
+    if media_info is not None:
+        stored["media_info"] = media_info
+    return stored
+
+def upload_thumbnail(media_info: Dict[str, Any]) -> Optional[str]:
+    """The extracted frame, unless FORCE_THUMBNAIL asks for the static one"""
+    static = Config.THUMBNAIL_PATH if os.path.exists(Config.THUMBNAIL_PATH) else None
+    if Config.FORCE_THUMBNAIL:
+        return static
+    return cached_thumbnail(media_info.get('thumbnail')) or static
+
+async def reupload_to_bin(message: Message, status: Message, file_name: str, caption: str) -> Dict[str, Any]:
+    """Download and send the file again, or return the stored record when the content is already there"""
+    media = message.document or message.video or message.audio or message.photo
+    # Named after the file so a failed attempt is resumed when the same file is sent again
+    download_path = os.path.join("downloads", media.file_unique_id)
+    file_path, content_hash = await download_media(
+        app, message, download_path, media.file_size,
+        on_progress=throttled_progress(status, Config.PROGRESS_UPDATE_INTERVAL, outbound)
+    )
+    
+    try:
+        shared = await db.find_shared_file(content_hash=content_hash)
+        if shared:
+            return shared
+        
+        # Probed here, where the file is on disk, rather than by range requests later
+        media_info = await media_processor.analyze(file_path, content_hash, media)
+        thumb = upload_thumbnail(media_info)
+        started = time.monotonic()
+        kind = "video" if message.video else "audio" if message.audio else "document" if message.document else "photo"
+        stored_object = await telegram_storage.put(
+            file_path, file_name=file_name, kind=kind, caption=caption, thumb=thumb, media_info=media_info
+        )
+        metrics.record_transfer("upload", os.path.getsize(file_path), time.monotonic() - started)
+        # Already on disk, so small files are kept to be served locally from the first request;
+        # photos are recompressed by Telegram and no longer match the download
+        if local_storage and kind != "photo" and local_storage.accepts(stored_object.size):
+            try:
+                await local_storage.put(
+                    file_path, stored_object.key, file_name, getattr(media, 'mime_type', None), move=True
+                )
+            except Exception as e:
+                logger.warning(f"Keeping message {stored_object.key} in local storage failed: {e}")
+        return stored_file(stored_object, content_hash, media_info)
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+async def store_in_bin(message: Message, status: Message, file_name: str, caption: str) -> Dict[str, Any]:
+    """Store the media in BIN_CHANNEL, preferring the zero-disk copy over download + re-upload.
+    
+    Returns the new file's IDs, or an existing file record (with `_id`) when the
+    downloaded content turned out to be stored already.
+    """
+    if not needs_reupload(message):
+        started = time.monotonic()
+        try:
+            stored = stored_file(await telegram_storage.copy(message, caption))
+            record_upload_path("copy", started)
+            return stored
+        except FloodWait:
+            # Longer than OUTBOUND_MAX_FLOOD_WAIT; a re-upload would be paused just the same
+            raise
+        except Exception as e:
+            record_upload_path("copy", started, failed=True)
+            logger.warning(f"Copy to BIN_CHANNEL failed, falling back to re-upload: {e}")
+    
+    started = time.monotonic()
+    try:
+        if Config.JOB_QUEUE:
+            await outbound.call("reply", status.chat.id, status.edit_text, "⏳ Waiting for a transfer worker...")
+            stored = await cluster.run_job("upload", {
+                "chat_id": message.chat.id,
+                "message_id": message.id,
+                "status_message_id": status.id,
+                "file_name": file_name,
+                "caption": caption
+            })
+        else:
+            stored = await reupload_within_budget(message, status, file_name, caption)
+    except Exception:
+        record_upload_path("reupload", started, failed=True)
+        raise
+    record_upload_path("dedup" if "_id" in stored else "reupload", started)
+    return stored
+
+async def reupload_within_budget(message: Message, status: Message, file_name: str, caption: str) -> Dict[str, Any]:
+    media = message.document or message.video or message.audio or message.photo
+    async with upload_queue.disk(media.file_size):
+        await outbound.call("reply", status.chat.id, status.edit_text, "📥 Downloading your file...")
+        return await reupload_to_bin(message, status, file_name, caption)
+
+async def run_upload_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Worker side of an "upload" job: re-upload a file the bot instance received"""
+    payload = job['payload']
+    message, status = await app.get_messages(
+        payload['chat_id'], [payload['message_id'], payload['status_message_id']]
+    )
+    if message.empty:
+        raise ValueError(f"Message {payload['message_id']} is no longer available")
+    async with lifecycle.transfer("job"):
+        return await reupload_within_budget(message, status, payload['file_name'], payload['caption'])
+
+cluster.add_job_handler("upload", run_upload_job)
+
 @app.on_message(filters.private & (filters.document | filters.video | filters.audio | filters.photo))
+@metrics.track_handler
 async def file_handler(client, message: Message):
+    if lifecycle.draining:
+        # Nothing was charged yet, the file can simply be sent again
+        await outbound.call(
+            "reply", message.chat.id, message.reply_text,
+            "🔄 The bot is restarting, please send your file again in a minute."
+        )
+        return
+    async with lifecycle.transfer("upload"):
+        await handle_file(client, message)
+
+async def handle_file(client, message: Message):
+    refund_quota = False
     try:
         user_id = message.from_user.id
-        if not await db.is_user_exist(user_id):
-            await db.add_user(user_id)
+        with metrics.UPLOAD_STAGE_SECONDS.time(stage="access"):
+            profile = await db.get_access_profile(user_id)
+            if not profile['exists']:
+                await db.add_user(user_id)
         
         # Check if user is banned
-        if await db.is_banned(user_id):
-            await message.reply_text("❌ You are banned from using this bot!")
+        if profile['banned']:
+            await outbound.call("reply", message.chat.id, message.reply_text, "❌ You are banned from using this bot!")
             return
         
         # Check premium status for large files
+        premium = profile['premium']
         media = message.document or message.video or message.audio or message.photo
         file_size = media.file_size
         
-        if not await db.is_premium(user_id) and file_size > Config.FREE_FILE_SIZE:
-            await message.reply_text(
+        if not premium and file_size > Config.FREE_FILE_SIZE:
+            await outbound.call(
+                "reply", message.chat.id, message.reply_text,
                 f"❌ Free users can only upload files up to {humanbytes(Config.FREE_FILE_SIZE)}\n\n"
                 f"💎 Upgrade to premium for {humanbytes(Config.MAX_FILE_SIZE)} files!",
                 reply_markup=InlineKeyboardMarkup([
@@ -110,161 +296,190 @@ async def file_handler(client, message: Message):
             return
         
         if file_size > Config.MAX_FILE_SIZE:
-            await message.reply_text("❌ File size exceeds maximum limit!")
+            await outbound.call("reply", message.chat.id, message.reply_text, "❌ File size exceeds maximum limit!")
             return
         
-        msg = await message.reply_text("📥 Downloading your file...")
-        
-        # Download file
-        file_name = getattr(media, 'file_name', None) or f"file_{message.id}"
-        download_path = os.path.join("downloads", file_name)
-        file_path = await message.download(file_name=download_path)
+        # Counted before any bytes move, and given back if the upload fails
+        with metrics.UPLOAD_STAGE_SECONDS.time(stage="quota"):
+            refund_quota = await db.consume_upload_quota(user_id)
+        if not refund_quota:
+            daily_limit = Config.PREMIUM_DAILY_LIMIT if premium else Config.FREE_DAILY_LIMIT
+            await outbound.call(
+                "reply", message.chat.id, message.reply_text,
+                f"❌ You've reached your daily limit of {daily_limit} files!\n\n"
+                f"⏰ Try again tomorrow" + ("" if premium else " or upgrade to premium for more."),
+                reply_markup=None if premium else InlineKeyboardMarkup([
+                    [InlineKeyboardButton("💰 Premium Plans", callback_data="premium")]
+                ])
+            )
+            return
         
-        await msg.edit_text("📤 Uploading to storage...")
+        msg = await outbound.call("reply", message.chat.id, message.reply_text, "⏳ Processing your file...")
         
-        # Upload to bin channel
+        file_name = getattr(media, 'file_name', None) or f"file_{message.id}"
         caption = f"📁 {file_name}\n📦 {humanbytes(file_size)}\n👤 User: {user_id}\n🆔 #ID{user_id}"
         
-        if message.video:
-            bin_message = await app.send_video(
-                chat_id=BIN_CHANNEL,
-                video=file_path,
-                caption=caption,
-                parse_mode=enums.ParseMode.HTML,
-                thumb="assets/thumbnail.jpg" if os.path.exists("assets/thumbnail.jpg") else None
-            )
-        elif message.audio:
-            bin_message = await app.send_audio(
-                chat_id=BIN_CHANNEL,
-                audio=file_path,
-                caption=caption,
-                parse_mode=enums.ParseMode.HTML,
-                thumb="assets/thumbnail.jpg" if os.path.exists("assets/thumbnail.jpg") else None
-            )
-        elif message.document:
-            bin_message = await app.send_document(
-                chat_id=BIN_CHANNEL,
-                document=file_path,
-                caption=caption,
-                parse_mode=enums.ParseMode.HTML,
-                thumb="assets/thumbnail.jpg" if os.path.exists("assets/thumbnail.jpg") else None
-            )
+        # The same file sent again reuses the stored copy without touching BIN_CHANNEL
+        started = time.monotonic()
+        with metrics.UPLOAD_STAGE_SECONDS.time(stage="dedup"):
+            stored = await db.find_shared_file(file_unique_id=media.file_unique_id)
+        if stored:
+            record_upload_path("dedup", started)
         else:
-            bin_message = await app.send_photo(
-                chat_id=BIN_CHANNEL,
-                photo=file_path,
-                caption=caption,
-                parse_mode=enums.ParseMode.HTML
-            )
-        
-        # Generate multiple links
-        file_id = bin_message.document.file_id if bin_message.document else bin_message.video.file_id if bin_message.video else bin_message.audio.file_id if bin_message.audio else bin_message.photo.file_id
-        
-        direct_link = f"{Config.DOWNLOAD_BASE_URL}/file/{file_id}?filename={quote(file_name)}"
-        stream_link = f"{Config.STREAM_BASE_URL}/stream/{file_id}"
-        embed_link = f"{Config.STREAM_BASE_URL}/embed/{file_id}"
+            async def show_position(position: int):
+                await outbound.call(
+                    "progress", msg.chat.id, msg.edit_text,
+                    f"⏳ Your file is in the queue, position **{position}**...",
+                    max_wait=0
+                )
+            
+            queued = time.monotonic()
+            async with upload_queue.slot(user_id, premium, on_wait=show_position):
+                metrics.UPLOAD_STAGE_SECONDS.observe(time.monotonic() - queued, stage="queue")
+                with metrics.UPLOAD_STAGE_SECONDS.time(stage="store"):
+                    stored = await store_in_bin(message, msg, file_name, caption)
         
-        # Save to database
-        await db.add_file_record(
-            file_id=file_id,
-            file_name=file_name,
-            file_size=file_size,
-            mime_type=media.mime_type if hasattr(media, 'mime_type') else "application/octet-stream",
-            bin_message_id=bin_message.id,
-            direct_link=direct_link,
-            stream_link=stream_link,
-            embed_link=embed_link,
-            user_id=user_id,
-            premium=await db.is_premium(user_id)
-        )
-        
-        # Auto-delete setup
-        if AUTO_DELETE_TIME > 0:
-            asyncio.create_task(auto_delete_message(bin_message, AUTO_DELETE_TIME))
+        file_id = stored['file_id']
+        bin_message_id = stored['bin_message_id']
+        recorded = time.monotonic()
+        if "_id" in stored:
+            record = await db.add_file_reference(stored['_id'], user_id) or stored
+            file_name = record['file_name']
+        else:
+            media_info = stored.get('media_info')
+            # Copied server-side: ffprobe reads the BIN_CHANNEL copy through the stream server once
+            # the user has the links, until then Telegram's metadata stands in
+            probe_source = local_stream_url(sign(bin_message_id, file_size)) if media_info is None else None
+            probe_later = bool(probe_source) and media_processor.can_probe(media)
+            if media_info is None:
+                media_info = {**from_telegram(media), 'probing': datetime.datetime.utcnow()} if probe_later else from_telegram(media)
+            
+            # Save to database
+            record = await db.add_file_record(
+                file_id=file_id,
+                file_name=file_name,
+                file_size=file_size,
+                mime_type=media.mime_type if hasattr(media, 'mime_type') else "application/octet-stream",
+                bin_message_id=bin_message_id,
+                user_id=user_id,
+                premium=premium,
+                file_unique_id=media.file_unique_id,
+                content_hash=stored['content_hash'],
+                media_info=media_info
+            )
+            if probe_later:
+                media_processor.analyze_later(
+                    probe_source, media.file_unique_id, media,
+                    lambda info, record_id=record['_id']: db.set_media_info(record_id, info)
+                )
+        record_id = record['_id']
+        # Generate multiple links, signed with the record's expiry
+        links = build_links(record)
+        direct_link = links['direct_link']
+        stream_link = links['stream_link']
+        embed_link = links['embed_link']
+        metrics.UPLOAD_STAGE_SECONDS.observe(time.monotonic() - recorded, stage="record")
+        refund_quota = False
         
         # Create buttons
         buttons = [
             [InlineKeyboardButton("📥 Direct Download", url=direct_link)],
             [InlineKeyboardButton("🎥 Stream Online", url=stream_link)],
-            [InlineKeyboardButton("🔗 Share Links", callback_data=f"share_{file_id}")]
+            [InlineKeyboardButton("🔗 Share Links", callback_data=f"share_{record_id}")]
         ]
         
         if "video" in getattr(media, 'mime_type', ''):
             buttons.insert(1, [InlineKeyboardButton("📺 Embed Player", url=embed_link)])
         
         if user_id in ADMINS:
-            buttons.append([InlineKeyboardButton("🗑️ Delete File", callback_data=f"delete_{bin_message.id}")])
-        
-        await msg.edit_text(
-            text=f"**✅ File Ready!**\n\n"
-                 f"**📁 File:** `{file_name}`\n"
-                 f"**📦 Size:** {humanbytes(file_size)}\n"
-                 f"**⏰ Auto-delete:** {AUTO_DELETE_TIME//3600} hours\n"
-                 f"**👤 Status:** {'💎 Premium' if await db.is_premium(user_id) else '🎫 Free'}\n\n"
-                 f"**🔗 Direct Download:**\n`{direct_link}`\n\n"
-                 f"**🎬 Stream Link:**\n`{stream_link}`",
-            reply_markup=InlineKeyboardMarkup(buttons),
-            disable_web_page_preview=True
-        )
+            buttons.append([InlineKeyboardButton("🗑️ Delete File", callback_data=f"delete_{bin_message_id}")])
         
-        # Log to channel
-        try:
-            await client.send_message(
-                Config.LOG_CHANNEL,
-                f"#NEW_FILE: \n\nUser: [{message.from_user.first_name}](tg://user?id={user_id})\nFile: {file_name}\nSize: {humanbytes(file_size)}\nPremium: {await db.is_premium(user_id)}"
+        with metrics.UPLOAD_STAGE_SECONDS.time(stage="reply"):
+            await outbound.call(
+                "reply", msg.chat.id, msg.edit_text,
+                text=f"**✅ File Ready!**\n\n"
+                     f"**📁 File:** `{file_name}`\n"
+                     f"**📦 Size:** {humanbytes(file_size)}\n"
+                     f"{media_line(record)}"
+                     f"**⏰ Auto-delete:** {AUTO_DELETE_TIME//3600} hours\n"
+                     f"**👤 Status:** {'💎 Premium' if premium else '🎫 Free'}\n\n"
+                     f"**🔗 Direct Download:**\n`{direct_link}`\n\n"
+                     f"**🎬 Stream Link:**\n`{stream_link}`",
+                reply_markup=InlineKeyboardMarkup(buttons),
+                disable_web_page_preview=True
             )
-        except:
-            pass
         
-        # Clean up
-        os.remove(file_path)
+        # Log to channel, behind the replies and without holding up this handler
+        outbound.submit(
+            "log", Config.LOG_CHANNEL, client.send_message,
+            Config.LOG_CHANNEL,
+            f"#NEW_FILE: \n\nUser: [{message.from_user.first_name}](tg://user?id={user_id})\nFile: {file_name}\nSize: {humanbytes(file_size)}\nPremium: {premium}"
+        )
         
     except Exception as e:
         logger.error(f"File handling error: {e}")
-        await message.reply_text("❌ Error processing your file.")
+        if refund_quota:
+            await db.refund_upload_quota(user_id)
+        await outbound.call("reply", message.chat.id, message.reply_text, "❌ Error processing your file.")
+
+def media_line(record: Dict[str, Any]) -> str:
+    summary = describe(record.get('media_info'))
+    return f"**🎞 Media:** {summary}\n" if summary else ""
+
+async def find_callback_file(key: str) -> Optional[Dict[str, Any]]:
+    # Callback data is capped at 64 bytes, so buttons carry the record's ObjectId; older
+    # messages still carry the much longer Telegram file_id
+    if ObjectId.is_valid(key):
+        return await db.get_file_record(ObjectId(key))
+    return await db.get_file_by_id(key)
 
 @app.on_callback_query(filters.regex("^share_"))
+@metrics.track_handler
 async def share_callback(client, callback_query: CallbackQuery):
-    file_id = callback_query.data.split("_", 1)[1]
-    file_data = await db.get_file_by_id(file_id)
+    file_key = callback_query.data.split("_", 1)[1]
+    file_data = await find_callback_file(file_key)
     
     if not file_data:
         await callback_query.answer("❌ File not found!", show_alert=True)
         return
     
     await callback_query.answer()
+    links = build_links(file_data)
     await callback_query.message.reply_text(
         text=f"**🔗 Share Links for {file_data['file_name']}**\n\n"
-             f"**📥 Direct Download:**\n`{file_data['direct_link']}`\n\n"
-             f"**🎥 Stream Link:**\n`{file_data['stream_link']}`\n\n"
-             f"**📺 Embed Link:**\n`{file_data.get('embed_link', 'N/A')}`",
+             f"**📥 Direct Download:**\n`{links['direct_link']}`\n\n"
+             f"**🎥 Stream Link:**\n`{links['stream_link']}`\n\n"
+             f"**📺 Embed Link:**\n`{links['embed_link']}`"
+             + (f"\n\n**📡 HLS Playlist:**\n`{links['hls_link']}`" if 'hls_link' in links else ""),
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("📥 Direct", url=file_data['direct_link'])],
-            [InlineKeyboardButton("🎥 Stream", url=file_data['stream_link'])],
-            [InlineKeyboardButton("📺 Embed", url=file_data.get('embed_link', file_data['stream_link']))],
-            [InlineKeyboardButton("🔙 Back", callback_data=f"back_{file_id}")]
+            [InlineKeyboardButton("📥 Direct", url=links['direct_link'])],
+            [InlineKeyboardButton("🎥 Stream", url=links['stream_link'])],
+            [InlineKeyboardButton("📺 Embed", url=links['embed_link'])],
+            [InlineKeyboardButton("🔙 Back", callback_data=f"back_{file_data['_id']}")]
         ]),
         disable_web_page_preview=True
     )
 
 @app.on_callback_query(filters.regex("^back_"))
+@metrics.track_handler
 async def back_callback(client, callback_query: CallbackQuery):
-    file_id = callback_query.data.split("_", 1)[1]
-    file_data = await db.get_file_by_id(file_id)
+    file_key = callback_query.data.split("_", 1)[1]
+    file_data = await find_callback_file(file_key)
     
     if not file_data:
         await callback_query.answer("❌ File not found!", show_alert=True)
         return
     
     await callback_query.answer()
+    links = build_links(file_data)
     buttons = [
-        [InlineKeyboardButton("📥 Direct Download", url=file_data['direct_link'])],
-        [InlineKeyboardButton("🎥 Stream Online", url=file_data['stream_link'])],
-        [InlineKeyboardButton("🔗 Share Links", callback_data=f"share_{file_id}")]
+        [InlineKeyboardButton("📥 Direct Download", url=links['direct_link'])],
+        [InlineKeyboardButton("🎥 Stream Online", url=links['stream_link'])],
+        [InlineKeyboardButton("🔗 Share Links", callback_data=f"share_{file_data['_id']}")]
     ]
     
     if "video" in file_data.get('mime_type', ''):
-        buttons.insert(1, [InlineKeyboardButton("📺 Embed Player", url=file_data.get('embed_link', file_data['stream_link']))])
+        buttons.insert(1, [InlineKeyboardButton("📺 Embed Player", url=links['embed_link'])])
     
     if callback_query.from_user.id in ADMINS:
         buttons.append([InlineKeyboardButton("🗑️ Delete File", callback_data=f"delete_{file_data['bin_message_id']}")])
@@ -273,52 +488,198 @@ async def back_callback(client, callback_query: CallbackQuery):
         text=f"**✅ File Ready!**\n\n"
              f"**📁 File:** `{file_data['file_name']}`\n"
              f"**📦 Size:** {humanbytes(file_data['file_size'])}\n"
+             f"{media_line(file_data)}"
              f"**⏰ Auto-delete:** {AUTO_DELETE_TIME//3600} hours\n\n"
-             f"**🔗 Direct Download:**\n`{file_data['direct_link']}`\n\n"
-             f"**🎬 Stream Link:**\n`{file_data['stream_link']}`",
+             f"**🔗 Direct Download:**\n`{links['direct_link']}`\n\n"
+             f"**🎬 Stream Link:**\n`{links['stream_link']}`",
         reply_markup=InlineKeyboardMarkup(buttons),
         disable_web_page_preview=True
     )
 
+# /myfiles pages are keyset-paginated: callback data carries the (upload_date, _id) of the
+# row to continue from, as "mf:o:<millis>:<id>" (older) or "mf:n:<millis>:<id>" (newer)
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_cursor(file: Dict[str, Any]) -> str:
+    millis = (file['upload_date'] - EPOCH) // datetime.timedelta(milliseconds=1)
+    return f"{millis}:{file['_id']}"
+
+def decode_cursor(value: str) -> tuple:
+    millis, record_id = value.split(":")
+    return EPOCH + datetime.timedelta(milliseconds=int(millis)), ObjectId(record_id)
+
+async def render_files_page(user_id: int, cursor: Optional[tuple] = None, newer: bool = False):
+    files, has_more = await db.get_user_files(user_id, Config.MYFILES_PAGE_SIZE, cursor, newer)
+    if not files and cursor:
+        # Everything past the cursor was deleted meanwhile, start over
+        return await render_files_page(user_id)
+    if not files:
+        return "📂 You have no stored files yet. Send me a file to get started!", None
+    
+    has_newer, has_older = (has_more, True) if newer else (cursor is not None, has_more)
+    lines = [
+        f"**{index}.** `{file['file_name']}`\n      {humanbytes(file['file_size'])} • {file['upload_date']:%Y-%m-%d %H:%M}"
+        for index, file in enumerate(files, start=1)
+    ]
+    # Deduplicated uploads open the shared record
+    buttons = [
+        [InlineKeyboardButton(f"{index}. {file['file_name'][:40]}",
+                              callback_data=f"mf:f:{file.get('record_id', file['_id'])}")]
+        for index, file in enumerate(files, start=1)
+    ]
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"mf:n:{encode_cursor(files[0])}"))
+    if has_older:
+        nav.append(InlineKeyboardButton("Older ➡️", callback_data=f"mf:o:{encode_cursor(files[-1])}"))
+    if nav:
+        buttons.append(nav)
+    
+    text = "📂 **Your Files**\n\n" + "\n".join(lines)
+    return text, InlineKeyboardMarkup(buttons)
+
+def render_file_details(file_data: Dict[str, Any]):
+    record_id = file_data['_id']
+    links = build_links(file_data)
+    buttons = [
+        [InlineKeyboardButton("📥 Direct Download", url=links['direct_link'])],
+        [InlineKeyboardButton("🎥 Stream Online", url=links['stream_link'])],
+        [InlineKeyboardButton("🔗 Share Links", callback_data=f"share_{record_id}")],
+        [InlineKeyboardButton("🗑️ Delete", callback_data=f"mf:d:{record_id}"),
+         InlineKeyboardButton("🔙 My Files", callback_data="mf:l")]
+    ]
+    if "video" in file_data.get('mime_type', ''):
+        buttons.insert(1, [InlineKeyboardButton("📺 Embed Player", url=links['embed_link'])])
+    
+    expires = f"{file_data['expires_at']:%Y-%m-%d %H:%M} UTC" if file_data.get('expires_at') else "never"
+    text = (
+        f"**📁 File:** `{file_data['file_name']}`\n"
+        f"**📦 Size:** {humanbytes(file_data['file_size'])}\n"
+        f"{media_line(file_data)}"
+        f"**📅 Uploaded:** {file_data['upload_date']:%Y-%m-%d %H:%M} UTC\n"
+        f"**⏰ Expires:** {expires}\n\n"
+        f"**🔗 Direct Download:**\n`{links['direct_link']}`\n\n"
+        f"**🎬 Stream Link:**\n`{links['stream_link']}`"
+    )
+    return text, InlineKeyboardMarkup(buttons)
+
+@app.on_message(filters.command("myfiles") & filters.private)
+@metrics.track_handler
+async def myfiles_command(client, message: Message):
+    text, markup = await render_files_page(message.from_user.id)
+    await message.reply_text(text, reply_markup=markup)
+
+@app.on_callback_query(filters.regex("^mf:"))
+@metrics.track_handler
+async def myfiles_callback(client, callback_query: CallbackQuery):
+    user_id = callback_query.from_user.id
+    action, _, argument = callback_query.data[len("mf:"):].partition(":")
+    try:
+        if action == "l":
+            text, markup = await render_files_page(user_id)
+        elif action in ("o", "n"):
+            text, markup = await render_files_page(user_id, decode_cursor(argument), newer=action == "n")
+        elif action == "f":
+            file_data = await db.get_file_record(ObjectId(argument))
+            if not file_data or (file_data['user_id'] != user_id
+                                 and not await db.has_file_reference(file_data['_id'], user_id)):
+                await callback_query.answer("❌ File not found!", show_alert=True)
+                return
+            text, markup = render_file_details(file_data)
+        elif action == "d":
+            text = "🗑️ Delete this file? Its links will stop working."
+            markup = InlineKeyboardMarkup([[
+                InlineKeyboardButton("✅ Yes, delete", callback_data=f"mf:x:{argument}"),
+                InlineKeyboardButton("❌ Cancel", callback_data=f"mf:f:{argument}")
+            ]])
+        elif action == "x":
+            record_id = ObjectId(argument)
+            # A deduplicated upload only drops the user's reference, the file stays for the others
+            if not await db.remove_file_reference(record_id, user_id):
+                deleted = await db.delete_user_file(record_id, user_id)
+                if not deleted:
+                    await callback_query.answer(
+                        "❌ This file is already gone or shared with other uploads, it will expire on its own.",
+                        show_alert=True
+                    )
+                    return
+                try:
+                    for backend in storage_backends:
+                        await backend.delete([deleted['bin_message_id']])
+                except Exception as e:
+                    logger.error(f"Could not delete stored file {deleted['bin_message_id']}: {e}")
+            text, markup = await render_files_page(user_id)
+        else:
+            await callback_query.answer()
+            return
+    except (ValueError, InvalidId):
+        await callback_query.answer("❌ Invalid request!", show_alert=True)
+        return
+    
+    await callback_query.answer()
+    try:
+        await callback_query.message.edit_text(text, reply_markup=markup, disable_web_page_preview=True)
+    except MessageNotModified:
+        pass
+
 @app.on_message(filters.command("broadcast") & filters.user(ADMINS))
+@metrics.track_handler
 async def broadcast_handler(client, message: Message):
     if not message.reply_to_message:
         await message.reply_text("❌ Please reply to a message to broadcast.")
         return
     
-    all_users = await db.get_all_users()
-    total_users = len(all_users)
-    success = 0
-    
-    progress_msg = await message.reply_text(f"📤 Broadcasting to {total_users} users...")
-    
-    for user_id in all_users:
-        try:
-            await message.reply_to_message.copy(user_id)
-            success += 1
-            if success % 100 == 0:
-                await progress_msg.edit_text(f"📤 Progress: {success}/{total_users}")
-        except Exception as e:
-            logger.error(f"Broadcast error for {user_id}: {e}")
-    
-    await progress_msg.edit_text(f"✅ Broadcast completed!\nSuccess: {success}\nFailed: {total_users - success}")
+    progress_msg = await message.reply_text("📤 Starting broadcast...")
+    await broadcaster.submit(message.chat.id, message.reply_to_message.id, progress_msg)
 
 @app.on_message(filters.command("stats") & filters.user(ADMINS))
+@metrics.track_handler
 async def stats_command(client, message: Message):
-    total_users = await db.total_users_count()
-    total_files = await db.total_files_count()
-    premium_users = await db.premium_users_count()
+    stats = await db.get_stats(Config.STATS_HISTORY_DAYS)
+    totals = stats['totals']
+    queue_stats = upload_queue.stats()
     
     await message.reply_text(
         f"📊 **Bot Statistics:**\n\n"
-        f"👥 Total Users: `{total_users}`\n"
-        f"💎 Premium Users: `{premium_users}`\n"
-        f"📁 Total Files: `{total_files}`\n"
+        f"👥 Total Users: `{totals.get('users', 0)}`\n"
+        f"💎 Premium Users: `{totals.get('premium', 0)}`\n"
+        f"📁 Total Files: `{totals.get('files', 0)}` (`{humanbytes(totals.get('bytes', 0))}`)\n"
         f"🆓 Free Limit: `{humanbytes(Config.FREE_FILE_SIZE)}`\n"
-        f"💎 Premium Limit: `{humanbytes(Config.MAX_FILE_SIZE)}`"
+        f"💎 Premium Limit: `{humanbytes(Config.MAX_FILE_SIZE)}`\n\n"
+        f"📦 **Upload Queue:** `{queue_stats['active']}` active, `{queue_stats['waiting']}` waiting, "
+        f"`{humanbytes(queue_stats['disk_reserved'])}` on disk\n\n"
+        f"📅 **Daily Activity:**\n"
+        f"{format_daily_stats(stats['days'])}\n\n"
+        f"⚡ **Storage Paths:**\n"
+        f"{format_upload_path_stats()}\n\n"
+        f"🧠 **User Cache:**\n"
+        f"{format_cache_stats(db.user_cache.stats())}"
+    )
+
+def format_upload_path_stats() -> str:
+    lines = []
+    for path in UPLOAD_PATHS:
+        stats = metrics.UPLOAD_PATH_SECONDS.get(path=path)
+        errors = int(metrics.UPLOAD_PATH_ERRORS.get(path=path))
+        avg = stats["sum"] / stats["count"] if stats["count"] else 0
+        lines.append(f"• {path}: `{stats['count']}` ok, `{errors}` failed, avg `{avg:.2f}s`")
+    return "\n".join(lines)
+
+def format_daily_stats(days: list) -> str:
+    return "\n".join(
+        f"• {day}: `{bucket.get('uploads', 0)}` uploads ({humanbytes(bucket.get('bytes_uploaded', 0))}), "
+        f"`{bucket.get('new_users', 0)}` new users"
+        for day, bucket in days
+    )
+
+def format_cache_stats(stats: dict) -> str:
+    return (
+        f"• hits `{stats['hits']}`, misses `{stats['misses']}` ({stats['hit_ratio']:.0%})\n"
+        f"• size `{stats['size']}`, evictions `{stats['evictions']}`"
     )
 
 @app.on_message(filters.command("ban") & filters.user(ADMINS))
+@metrics.track_handler
 async def ban_user(client, message: Message):
     if len(message.command) < 2:
         await message.reply_text("❌ Usage: /ban <user_id>")
@@ -332,6 +693,7 @@ async def ban_user(client, message: Message):
         await message.reply_text("❌ Invalid user ID!")
 
 @app.on_message(filters.command("unban") & filters.user(ADMINS))
+@metrics.track_handler
 async def unban_user(client, message: Message):
     if len(message.command) < 2:
         await message.reply_text("❌ Usage: /unban <user_id>")
@@ -357,6 +719,109 @@ def humanbytes(size):
         n += 1
     return f"{round(size, 2)} {units[n]}"
 
+async def start_workers(count: int) -> list:
+    """Run `count` transfer workers as child processes of this bot instance"""
+    workers = []
+    for index in range(1, count + 1):
+        env = {
+            **os.environ,
+            "ROLE": "worker",
+            "INSTANCE_ID": f"{Config.INSTANCE_ID}-worker{index}",
+            "WORKER_PROCESSES": "0",
+            "JOB_QUEUE": "true",
+            # The stream server stays in the bot process, and the workers split its download budget
+            "PORT": "0",
+            "DOWNLOAD_DISK_BUDGET": str(Config.DOWNLOAD_DISK_BUDGET // count),
+            "SESSION_NAME": f"{Config.SESSION_NAME}-worker{index}"
+        }
+        workers.append(await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env))
+    if workers:
+        logger.info(f"Started {len(workers)} worker process(es)")
+    return workers
+
+async def stop_workers(workers: list):
+    # SIGTERM lets each worker drain its own jobs within SHUTDOWN_TIMEOUT
+    for worker in workers:
+        if worker.returncode is None:
+            worker.terminate()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(worker.wait() for worker in workers)), Config.SHUTDOWN_TIMEOUT + 5)
+    except asyncio.TimeoutError:
+        for worker in workers:
+            if worker.returncode is None:
+                logger.warning(f"Worker {worker.pid} did not stop in time, killing it")
+                worker.kill()
+        await asyncio.gather(*(worker.wait() for worker in workers))
+
+def remove_temp_files():
+    """Delete what interrupted transfers left behind; .part files stay for resuming and are swept by age"""
+    removed = 0
+    for directory in ("downloads", Config.THUMBNAIL_CACHE_DIR, Config.HLS_CACHE_DIR):
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if directory == "downloads":
+                stale = not name.endswith(PART_SUFFIX)
+            else:
+                stale = name.endswith(".tmp")
+            if stale and os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+    if removed:
+        logger.info(f"Removed {removed} temporary file(s)")
+
+async def main():
+    server = None
+    if Config.PORT:
+        # Up first so /health answers "starting" while the rest comes up
+        server = StreamServer(telegram_storage, local_storage, db, lifecycle)
+        await server.start()
+    if Config.ROLE == "bot":
+        # Worker processes share downloads/, they aren't running yet
+        remove_temp_files()
+    
+    await asyncio.gather(db.warm_up(), app.start())
+    db.start_write_behind()
+    await pool.start()
+    if local_storage:
+        local_storage.start()
+    media_processor.start()
+    workers = await start_workers(Config.WORKER_PROCESSES) if Config.ROLE == "bot" else []
+    # Jobs go to the worker processes when there are any, otherwise this instance runs them itself
+    cluster.start(run_jobs=Config.ROLE == "worker" or (Config.JOB_QUEUE and not workers))
+    partial_sweeper.start()
+    lifecycle.mark_ready()
+    
+    await idle()
+    await shutdown(server, workers)
+
+async def shutdown(server: Optional[StreamServer], workers: list):
+    """Drain in-flight transfers within SHUTDOWN_TIMEOUT, then stop everything in reverse order"""
+    # Queued jobs are left for the other workers
+    cluster.stop_claiming()
+    if not await lifecycle.drain(Config.SHUTDOWN_TIMEOUT):
+        logger.warning(f"Stopping with transfers still running: {lifecycle.in_flight()}")
+    
+    await media_processor.stop()
+    if local_storage:
+        await local_storage.stop()
+    await partial_sweeper.stop()
+    await cluster.stop()
+    await stop_workers(workers)
+    if server:
+        await server.stop()
+    # Pending LOG_CHANNEL messages are dropped
+    await outbound.stop()
+    await pool.stop()
+    await app.stop()
+    await db.stop_write_behind()
+    if Config.ROLE == "bot":
+        remove_temp_files()
+    logger.info("Shutdown complete")
+
 if __name__ == "__main__":
+    prepare_directories()
+    configure_logging()
     print("🚀 Starting Mystream Bot with All Features...")
-    app.run()
+    app.run(main())
@@ -0,0 +1,158 @@
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List
+from pyrogram import Client
+from pyrogram.errors import UserIsBlocked, InputUserDeactivated
+import metrics
+from config import Config
+from database import Database
+from ratelimit import OutboundScheduler, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# How often the leader looks for broadcasts submitted on other instances
+WATCH_INTERVAL = 10
+
+class BroadcastEngine:
+    """Sends a message to every user through a worker pool sharing one rate limit.
+
+    Users are read in ID order one batch at a time; after each batch the last ID and
+    the counters are checkpointed in Mongo, so a restart resumes where it stopped.
+    Any instance can submit a broadcast, only the cluster leader sends them.
+    """
+
+    def __init__(self, client: Client, db: Database, outbound: OutboundScheduler):
+        self.client = client
+        self.db = db
+        self.outbound = outbound
+        self.bucket = TokenBucket(Config.BROADCAST_RATE)
+        self._tasks: Dict[Any, asyncio.Task] = {}
+        self._watcher = None
+        metrics.Gauge("bot_broadcasts_running", "Broadcasts currently being sent", function=lambda: len(self._tasks))
+
+    def start(self):
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        """Stop sending; running broadcasts stay marked running and resume from their checkpoint"""
+        tasks = list(self._tasks.values())
+        if self._watcher:
+            tasks.append(self._watcher)
+            self._watcher = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, from_chat_id: int, message_id: int, progress_message):
+        total = await self.db.total_users_count()
+        broadcast = await self.db.create_broadcast(
+            from_chat_id, message_id, progress_message.chat.id, progress_message.id, total
+        )
+        # On the leader start right away, otherwise its watcher picks the broadcast up
+        if self._watcher:
+            self._spawn(broadcast)
+
+    async def _watch(self):
+        while True:
+            try:
+                await self.resume()
+            except Exception as e:
+                logger.error(f"Looking for broadcasts failed: {e}")
+            await asyncio.sleep(WATCH_INTERVAL)
+
+    async def resume(self):
+        for broadcast in await self.db.get_running_broadcasts():
+            if broadcast['_id'] in self._tasks:
+                continue
+            logger.info(f"Resuming broadcast {broadcast['_id']} after user {broadcast['last_id']}")
+            self._spawn(broadcast)
+
+    def _spawn(self, broadcast: Dict[str, Any]):
+        task = asyncio.create_task(self.run(broadcast))
+        self._tasks[broadcast['_id']] = task
+        task.add_done_callback(lambda done: self._tasks.pop(broadcast['_id'], None))
+
+    async def run(self, broadcast: Dict[str, Any]):
+        started = time.monotonic()
+        elapsed_before = broadcast['elapsed']
+
+        try:
+            while True:
+                batch = [user_id async for user_id in
+                         self.db.iter_user_ids(broadcast['last_id'], Config.BROADCAST_BATCH_SIZE)]
+                if not batch:
+                    break
+
+                dead = await self._send_batch(broadcast, batch)
+                await self.db.mark_dead_users(dead)
+                broadcast['last_id'] = batch[-1]
+                broadcast['elapsed'] = elapsed_before + time.monotonic() - started
+                await self._checkpoint(broadcast)
+        except Exception as e:
+            # Left as running so the watcher picks it up again
+            logger.error(f"Broadcast {broadcast['_id']} stopped: {e}")
+            return
+
+        broadcast['status'] = "done"
+        await self._checkpoint(broadcast)
+
+    async def _send_batch(self, broadcast: Dict[str, Any], batch: List[int]) -> List[int]:
+        queue = asyncio.Queue()
+        for user_id in batch:
+            queue.put_nowait(user_id)
+
+        dead = []
+        workers = [
+            asyncio.create_task(self._worker(broadcast, queue, dead))
+            for _ in range(min(Config.BROADCAST_WORKERS, len(batch)))
+        ]
+        await asyncio.gather(*workers)
+        return dead
+
+    async def _worker(self, broadcast: Dict[str, Any], queue: asyncio.Queue, dead: List[int]):
+        while not queue.empty():
+            user_id = queue.get_nowait()
+            await self.bucket.acquire()
+            try:
+                # A FloodWait pauses every broadcast call and is retried, replies keep going
+                await self.outbound.call(
+                    "broadcast", user_id, self.client.copy_message,
+                    user_id, broadcast['from_chat_id'], broadcast['message_id'],
+                    max_wait=None
+                )
+                broadcast['success'] += 1
+            except (UserIsBlocked, InputUserDeactivated):
+                dead.append(user_id)
+                broadcast['dead'] += 1
+                broadcast['failed'] += 1
+            except Exception as e:
+                logger.error(f"Broadcast error for {user_id}: {e}")
+                broadcast['failed'] += 1
+
+    async def _checkpoint(self, broadcast: Dict[str, Any]):
+        await self.db.update_broadcast(broadcast['_id'], {
+            'status': broadcast['status'],
+            'last_id': broadcast['last_id'],
+            'success': broadcast['success'],
+            'failed': broadcast['failed'],
+            'dead': broadcast['dead'],
+            'elapsed': broadcast['elapsed']
+        })
+
+        sent = broadcast['success'] + broadcast['failed']
+        rate = sent / broadcast['elapsed'] if broadcast['elapsed'] else 0
+        if broadcast['status'] == "done":
+            text = (f"✅ Broadcast completed!\nSuccess: {broadcast['success']}\nFailed: {broadcast['failed']}\n"
+                    f"Blocked/deleted: {broadcast['dead']}\nSpeed: {rate:.1f} msg/s")
+        else:
+            text = f"📤 Progress: {sent}/{broadcast['total']}\n⚡ {rate:.1f} msg/s"
+
+        try:
+            await self.outbound.call(
+                "progress", broadcast['admin_chat_id'], self.client.edit_message_text,
+                broadcast['admin_chat_id'], broadcast['progress_message_id'], text,
+                max_wait=0
+            )
+        except Exception as e:
+            logger.debug(f"Broadcast progress edit failed: {e}")
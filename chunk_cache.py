@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+import metrics
+from disk_cache import DiskLRU
+
+logger = logging.getLogger(__name__)
+
+ChunkKey = Tuple[int, int]  # (BIN_CHANNEL message id, chunk index)
+# Telegram's part size; every part but a file's last is exactly this long
+CHUNK_SIZE = 1024 * 1024
+
+CACHE_HITS = metrics.Counter("bot_chunk_cache_hits_total", "Chunk reads served from the cache", ["tier"])
+CACHE_MISSES = metrics.Counter("bot_chunk_cache_misses_total", "Chunk reads that went to Telegram")
+CACHE_COALESCED = metrics.Counter("bot_chunk_cache_coalesced_total", "Chunk reads that joined a fetch already running")
+CACHE_EVICTIONS = metrics.Counter("bot_chunk_cache_evictions_total", "Chunks evicted from each tier", ["tier"])
+
+def chunk_length(index: int, file_size: int) -> int:
+    return max(0, min(CHUNK_SIZE, file_size - index * CHUNK_SIZE))
+
+class ChunkCache:
+    """LRU cache of Telegram parts with a RAM byte budget and an optional on-disk tier.
+
+    Chunks evicted from RAM spill to `disk_dir` while the disk budget allows, written and read
+    back in the default executor. Concurrent reads of a chunk that is being fetched share one fetch.
+    A fetch that returns anything but the part's full length fails and is not cached.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.memory_bytes = 0
+        self._memory = OrderedDict()
+        self._disk = DiskLRU(disk_dir, disk_max_bytes, on_evict=lambda _: CACHE_EVICTIONS.inc(tier="disk")) \
+            if disk_dir and disk_max_bytes > 0 else None
+        self._inflight: Dict[ChunkKey, asyncio.Future] = {}
+        # Chunks on their way to disk, still served from here until the write is done
+        self._spilling: Dict[ChunkKey, bytes] = {}
+
+        metrics.Gauge("bot_chunk_cache_bytes", "Bytes held by each chunk cache tier", ["tier"],
+                      function=lambda: {"memory": self.memory_bytes,
+                                        "disk": self._disk.bytes if self._disk is not None else 0})
+        metrics.Gauge("bot_chunk_cache_hit_ratio", "Share of chunk reads served from the cache",
+                      function=self.hit_ratio)
+
+    def start(self):
+        """Pick up the disk tier a previous run left behind"""
+        if self._disk is not None:
+            self._disk.load(lambda name: _chunk_key(name) is not None)
+
+    def hit_ratio(self) -> float:
+        hits = sum(CACHE_HITS.values.values())
+        lookups = hits + CACHE_MISSES.get()
+        return hits / lookups if lookups else 0.0
+
+    async def get(self, key: ChunkKey, fetch: Callable[[], Awaitable[bytes]], length: int) -> bytes:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            CACHE_HITS.inc(tier="memory")
+            return data
+
+        data = self._spilling.get(key)
+        if data is not None:
+            CACHE_HITS.inc(tier="disk")
+            return data
+
+        if self._on_disk(key):
+            try:
+                data = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+                if len(data) != length:
+                    raise IOError(f"has {len(data)} of {length} bytes")
+            except OSError as e:
+                logger.warning(f"Dropping unreadable cached chunk {key}: {e}")
+                self._disk.drop(_chunk_name(key))
+            else:
+                self._disk.touch(_chunk_name(key))
+                CACHE_HITS.inc(tier="disk")
+                self._store_memory(key, data)
+                return data
+
+        task = self._inflight.get(key)
+        if task is not None:
+            CACHE_COALESCED.inc()
+        else:
+            CACHE_MISSES.inc()
+            task = self._start_fetch(key, fetch, length)
+        # The fetch runs as its own task, a reader that disconnects doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    def prefetch(self, key: ChunkKey, fetch: Callable[[], Awaitable[bytes]], length: int):
+        """Start fetching a chunk in the background if it isn't cached or on its way already"""
+        if key in self._memory or key in self._spilling or self._on_disk(key) or key in self._inflight:
+            return
+        self._start_fetch(key, fetch, length)
+
+    def _start_fetch(self, key: ChunkKey, fetch: Callable[[], Awaitable[bytes]], length: int) -> asyncio.Future:
+        task = asyncio.ensure_future(self._fetch(key, fetch, length))
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._fetched(key, done))
+        return task
+
+    @staticmethod
+    async def _fetch(key: ChunkKey, fetch: Callable[[], Awaitable[bytes]], length: int) -> bytes:
+        data = await fetch()
+        if len(data) != length:
+            raise IOError(f"chunk {key} has {len(data)} of {length} bytes")
+        return data
+
+    def _fetched(self, key: ChunkKey, task: asyncio.Future):
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.debug(f"Chunk fetch {key} failed: {task.exception()}")
+            return
+        self._store_memory(key, task.result())
+
+    # RAM tier
+    def _store_memory(self, key: ChunkKey, data: bytes):
+        if key in self._memory or len(data) > self.max_bytes:
+            return
+        self._memory[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.max_bytes:
+            old_key, old_data = self._memory.popitem(last=False)
+            self.memory_bytes -= len(old_data)
+            CACHE_EVICTIONS.inc(tier="memory")
+            self._spill(old_key, old_data)
+
+    # Disk tier
+    def _on_disk(self, key: ChunkKey) -> bool:
+        return self._disk is not None and _chunk_name(key) in self._disk
+
+    def _spill(self, key: ChunkKey, data: bytes):
+        if (self._disk is None or not data or key in self._spilling or self._on_disk(key)
+                or len(data) > self._disk.max_bytes):
+            return
+        self._spilling[key] = data
+        write = asyncio.get_running_loop().run_in_executor(None, self._disk.write_file, _chunk_name(key), data)
+        write.add_done_callback(lambda done: self._spilled(key, done))
+
+    def _spilled(self, key: ChunkKey, write: asyncio.Future):
+        self._spilling.pop(key, None)
+        if write.cancelled():
+            return
+        try:
+            write.result()
+            self._disk.add(_chunk_name(key))
+        except OSError as e:
+            logger.warning(f"Could not spill chunk {key} to disk: {e}")
+
+    def _read_disk(self, key: ChunkKey) -> bytes:
+        with open(self._disk.path(_chunk_name(key)), "rb") as f:
+            return f.read()
+
+def _chunk_name(key: ChunkKey) -> str:
+    return f"{key[0]}_{key[1]}.chunk"
+
+def _chunk_key(name: str) -> Optional[ChunkKey]:
+    if not name.endswith(".chunk"):
+        return None
+    try:
+        message_id, index = name[:-len(".chunk")].split("_")
+        return int(message_id), int(index)
+    except ValueError:
+        return None
@@ -0,0 +1,141 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Dict
+from pyrogram import Client
+from pyrogram.types import Message
+import metrics
+from chunk_cache import ChunkCache, chunk_length
+from config import Config, session_name
+
+logger = logging.getLogger(__name__)
+
+# Fetched BIN_CHANNEL messages are reused for a while so every chunk doesn't cost a get_messages call
+MESSAGE_CACHE_SIZE = 1024
+MESSAGE_CACHE_TTL = 300
+# Tries per part before the range fails
+CHUNK_ATTEMPTS = 2
+
+CHUNK_SECONDS = metrics.Histogram("bot_chunk_fetch_seconds", "Time to fetch one part from Telegram", ["client"])
+
+class PooledClient:
+    def __init__(self, name: str, client: Client):
+        self.name = name
+        self.client = client
+        self.in_flight = 0
+        self._messages = OrderedDict()
+
+    async def get_message(self, message_id: int) -> Message:
+        cached = self._messages.get(message_id)
+        if cached and cached[1] > time.monotonic():
+            self._messages.move_to_end(message_id)
+            return cached[0]
+
+        # Each session needs its own copy: file references are bound to the client that fetched them
+        message = await self.client.get_messages(Config.BIN_CHANNEL, message_id)
+        self._messages[message_id] = (message, time.monotonic() + MESSAGE_CACHE_TTL)
+        self._messages.move_to_end(message_id)
+        while len(self._messages) > MESSAGE_CACHE_SIZE:
+            self._messages.popitem(last=False)
+        return message
+
+class ClientPool:
+    """The main bot plus helper bots (HELPER_BOT_TOKENS) that share BIN_CHANNEL fetches"""
+
+    def __init__(self, main_client: Client):
+        self.clients = [PooledClient("main", main_client)]
+        self.cache = ChunkCache(Config.CHUNK_CACHE_SIZE, Config.CHUNK_CACHE_DIR, Config.CHUNK_DISK_CACHE_SIZE)
+        metrics.Gauge("bot_client_in_flight", "Requests in flight per Telegram session", ["client"],
+                      function=self.in_flight)
+
+    async def start(self):
+        self.cache.start()
+        for index, token in enumerate(Config.HELPER_BOT_TOKENS, start=1):
+            client = Client(
+                session_name(f"{Config.SESSION_NAME}-helper{index}", token),
+                api_id=Config.API_ID,
+                api_hash=Config.API_HASH,
+                bot_token=token,
+                workdir=Config.SESSION_DIR,
+                no_updates=True
+            )
+            try:
+                await client.start()
+            except Exception as e:
+                logger.error(f"Helper client {index} failed to start: {e}")
+                continue
+            self.clients.append(PooledClient(f"helper{index}", client))
+        logger.info(f"Client pool ready with {len(self.clients)} session(s)")
+
+    async def stop(self):
+        for pooled in self.clients[1:]:
+            try:
+                await pooled.client.stop()
+            except Exception as e:
+                logger.error(f"Helper client {pooled.name} failed to stop: {e}")
+
+    def in_flight(self) -> Dict[str, int]:
+        return {pooled.name: pooled.in_flight for pooled in self.clients}
+
+    @asynccontextmanager
+    async def acquire(self):
+        pooled = min(self.clients, key=lambda c: c.in_flight)
+        pooled.in_flight += 1
+        try:
+            yield pooled
+        finally:
+            pooled.in_flight -= 1
+
+    async def get_message(self, message_id: int) -> Message:
+        async with self.acquire() as pooled:
+            return await pooled.get_message(message_id)
+
+    async def fetch_chunk(self, message_id: int, index: int) -> bytes:
+        for attempt in range(1, CHUNK_ATTEMPTS + 1):
+            async with self.acquire() as pooled:
+                with CHUNK_SECONDS.time(client=pooled.name):
+                    message = await pooled.get_message(message_id)
+                    async for chunk in pooled.client.stream_media(message, offset=index, limit=1):
+                        return chunk
+            # pyrogram logs a failed request and ends the stream; the retry goes to the least busy session
+            logger.warning(f"No data for part {index} of {message_id} from {pooled.name}, attempt {attempt}")
+        raise IOError(f"no data for part {index} of {message_id}")
+
+    async def get_chunk(self, message_id: int, index: int, file_size: int) -> bytes:
+        return await self.cache.get(
+            (message_id, index), lambda: self.fetch_chunk(message_id, index), chunk_length(index, file_size)
+        )
+
+    def prefetch(self, message_id: int, first: int, file_size: int):
+        """Warm the cache with the PREFETCH_CHUNKS parts a sequential player will ask for next"""
+        for index in range(first, first + Config.PREFETCH_CHUNKS):
+            length = chunk_length(index, file_size)
+            if not length:
+                break
+            self.cache.prefetch((message_id, index), lambda index=index: self.fetch_chunk(message_id, index), length)
+
+    async def iter_chunks(self, message_id: int, first: int, count: int, file_size: int):
+        """Yield `count` parts starting at `first` in order, fetching up to PARALLEL_CHUNKS at once"""
+        window = max(1, min(Config.PARALLEL_CHUNKS, count))
+        end = first + count
+        next_index = first
+        pending = deque()
+
+        try:
+            while next_index < end and len(pending) < window:
+                pending.append(asyncio.ensure_future(self.get_chunk(message_id, next_index, file_size)))
+                next_index += 1
+
+            while pending:
+                chunk = await pending.popleft()
+                if next_index < end:
+                    pending.append(asyncio.ensure_future(self.get_chunk(message_id, next_index, file_size)))
+                    next_index += 1
+                yield chunk
+        finally:
+            for task in pending:
+                task.cancel()
+
+        self.prefetch(message_id, end, file_size)
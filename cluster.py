@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List
+import metrics
+from config import Config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+LEADER_LOCK = "leader"
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+JOBS_TOTAL = metrics.Counter("bot_jobs_total", "Jobs run by this instance", ["kind", "outcome"])
+JOB_SECONDS = metrics.Histogram("bot_job_seconds", "Time to run one job", ["kind"])
+
+class JobFailed(Exception):
+    pass
+
+class Cluster:
+    """Coordinates instances that share DATABASE_URL.
+
+    One instance at a time holds the leader lease and runs the singleton services
+    (broadcasts, expiry sweeps, ...). Any instance can run jobs from the jobs collection;
+    a job is claimed atomically and its lease renewed while it runs, so a job whose
+    worker died is picked up again once the lease lapses.
+    """
+
+    def __init__(self, db: Database, instance_id: str = Config.INSTANCE_ID):
+        self.db = db
+        self.instance_id = instance_id
+        self.is_leader = False
+        self._services = []
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._lease_expires = 0.0
+        self._claiming = True
+        metrics.Gauge("bot_cluster_leader", "1 while this instance runs the singleton services",
+                      function=lambda: int(self.is_leader))
+
+    def add_leader_service(self, service):
+        """Register an object with start() and async stop() that must run on one instance only"""
+        self._services.append(service)
+
+    def add_job_handler(self, kind: str, handler: JobHandler):
+        self._handlers[kind] = handler
+
+    def start(self, run_jobs: bool):
+        self._tasks.append(asyncio.create_task(self._elect()))
+        if run_jobs and self._handlers:
+            for _ in range(Config.WORKER_CONCURRENCY):
+                self._tasks.append(asyncio.create_task(self._work()))
+        logger.info(f"Instance {self.instance_id} joined the cluster (jobs: {run_jobs})")
+
+    def stop_claiming(self):
+        """Let running jobs finish but take no new ones, they stay queued for other workers"""
+        self._claiming = False
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self.is_leader:
+            await self._step_down()
+            try:
+                await self.db.release_lock(LEADER_LOCK, self.instance_id)
+            except Exception as e:
+                logger.error(f"Could not release the leader lease: {e}")
+
+    # Leader election
+    async def _elect(self):
+        while True:
+            try:
+                leader = await self.db.acquire_lock(LEADER_LOCK, self.instance_id, Config.LEADER_LEASE)
+                if leader:
+                    self._lease_expires = time.monotonic() + Config.LEADER_LEASE
+            except Exception as e:
+                logger.error(f"Leader lease renewal failed: {e}")
+                # Keep leading only while the lease we last wrote is still valid
+                leader = self.is_leader and time.monotonic() < self._lease_expires
+
+            if leader and not self.is_leader:
+                self._step_up()
+            elif not leader and self.is_leader:
+                await self._step_down()
+            await asyncio.sleep(Config.LEADER_LEASE / 3)
+
+    def _step_up(self):
+        logger.info(f"Instance {self.instance_id} is now the leader")
+        self.is_leader = True
+        for service in self._services:
+            service.start()
+
+    async def _step_down(self):
+        logger.info(f"Instance {self.instance_id} is no longer the leader")
+        self.is_leader = False
+        for service in self._services:
+            try:
+                await service.stop()
+            except Exception as e:
+                logger.error(f"Stopping {type(service).__name__} failed: {e}")
+
+    # Jobs
+    async def run_job(self, kind: str, payload: Dict[str, Any], timeout: float = Config.JOB_TIMEOUT) -> Any:
+        """Queue a job for whichever worker claims it first and wait for its result"""
+        job_id = await self.db.enqueue_job(kind, payload)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(Config.JOB_POLL_INTERVAL)
+            job = await self.db.get_job(job_id)
+            if job and job['status'] == 'done':
+                return job.get('result')
+            if job and job['status'] == 'failed':
+                raise JobFailed(job.get('error') or "job failed")
+        raise JobFailed(f"{kind} job {job_id} timed out")
+
+    async def _work(self):
+        kinds = list(self._handlers)
+        while True:
+            if not self._claiming:
+                await asyncio.sleep(Config.JOB_POLL_INTERVAL)
+                continue
+            try:
+                job = await self.db.claim_job(kinds, self.instance_id, Config.JOB_LEASE)
+            except Exception as e:
+                logger.error(f"Claiming a job failed: {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(Config.JOB_POLL_INTERVAL)
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Dict[str, Any]):
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        result, error = None, None
+        try:
+            with JOB_SECONDS.time(kind=job['kind']):
+                result = await self._handlers[job['kind']](job)
+        except asyncio.CancelledError:
+            # Shutting down: the lease lapses and another worker picks the job up
+            raise
+        except Exception as e:
+            logger.error(f"{job['kind']} job {job['_id']} failed (attempt {job['attempts']}): {e}")
+            error = str(e) or type(e).__name__
+        finally:
+            heartbeat.cancel()
+
+        JOBS_TOTAL.inc(kind=job['kind'], outcome="error" if error else "ok")
+        await self.db.finish_job(job, self.instance_id, result, error)
+
+    async def _heartbeat(self, job: Dict[str, Any]):
+        while True:
+            await asyncio.sleep(Config.JOB_LEASE / 3)
+            try:
+                if not await self.db.renew_job(job['_id'], self.instance_id, Config.JOB_LEASE):
+                    logger.warning(f"Lost the lease on job {job['_id']}")
+                    return
+            except Exception as e:
+                logger.error(f"Renewing job {job['_id']} failed: {e}")
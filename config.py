@@ -13,6 +13,11 @@ class Config:
     
     # Database
     DATABASE_URL = os.environ.get("DATABASE_URL", "mongodb_url")
+    USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "60"))  # seconds
+    WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", "10"))  # seconds between counter flushes
+    WRITE_BEHIND_MAX_PENDING = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", "5000"))  # documents before an early flush
+    MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "2"))  # connections kept open and warm
     
     # Channel Configuration
     BIN_CHANNEL = int(os.environ.get("BIN_CHANNEL", "-1001234567890"))
@@ -22,14 +27,108 @@ class Config:
     
     # Auto Delete Time (seconds)
     AUTO_DELETE_TIME = int(os.environ.get("AUTO_DELETE_TIME", "43200"))  # 12 hours
+    EXPIRY_INTERVAL = int(os.environ.get("EXPIRY_INTERVAL", "60"))  # seconds between scheduler sweeps
+    EXPIRY_BATCH_SIZE = int(os.environ.get("EXPIRY_BATCH_SIZE", "500"))
+    EXPIRY_GRACE = int(os.environ.get("EXPIRY_GRACE", "86400"))  # TTL backstop delay after a file expires
     
     # File Size Limits
     FREE_FILE_SIZE = int(os.environ.get("FREE_FILE_SIZE", "1073741824"))  # 1GB for free users
     MAX_FILE_SIZE = int(os.environ.get("MAX_FILE_SIZE", "4294967296"))    # 4GB for premium
     
+    # Storage: copy media into BIN_CHANNEL server-side; only re-upload when the thumbnail must be replaced
+    THUMBNAIL_PATH = os.environ.get("THUMBNAIL_PATH", "assets/thumbnail.jpg")
+    FORCE_THUMBNAIL = os.environ.get("FORCE_THUMBNAIL", "False").lower() == "true"
+    
+    # Media probing: ffprobe/ffmpeg metadata and thumbnails, run in a process pool
+    MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", "2"))  # 0 disables probing
+    MEDIA_PROBE_TIMEOUT = int(os.environ.get("MEDIA_PROBE_TIMEOUT", "20"))  # seconds per ffprobe/ffmpeg run
+    THUMBNAIL_CACHE_DIR = os.environ.get("THUMBNAIL_CACHE_DIR", "data/thumbnails")
+    THUMBNAIL_CACHE_SIZE = int(os.environ.get("THUMBNAIL_CACHE_SIZE", "1073741824"))  # 1GB
+    
+    # Upload admission control
+    MAX_CONCURRENT_UPLOADS = int(os.environ.get("MAX_CONCURRENT_UPLOADS", "10"))
+    MAX_UPLOADS_PER_USER = int(os.environ.get("MAX_UPLOADS_PER_USER", "2"))
+    DOWNLOAD_DISK_BUDGET = int(os.environ.get("DOWNLOAD_DISK_BUDGET", "21474836480"))  # 20GB for downloads/
+    QUEUE_UPDATE_INTERVAL = int(os.environ.get("QUEUE_UPDATE_INTERVAL", "5"))  # seconds between position edits
+    
+    # Re-upload downloads
+    PROGRESS_UPDATE_INTERVAL = int(os.environ.get("PROGRESS_UPDATE_INTERVAL", "10"))  # seconds between progress edits
+    DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", "5"))  # consecutive failures before giving up
+    PARTIAL_FILE_MAX_AGE = int(os.environ.get("PARTIAL_FILE_MAX_AGE", "86400"))  # keep .part files for resuming
+    PARTIAL_SWEEP_INTERVAL = int(os.environ.get("PARTIAL_SWEEP_INTERVAL", "3600"))
+    
     # CDN/Server URLs
     DOWNLOAD_BASE_URL = os.environ.get("DOWNLOAD_BASE_URL", "https://your-cdn.com")
     STREAM_BASE_URL = os.environ.get("STREAM_BASE_URL", "https://stream.your-domain.com")
+    LINK_SECRET = os.environ.get("LINK_SECRET", "")  # HMAC key for link tokens, derived from BOT_TOKEN if unset
+    
+    # Built-in stream server
+    BIND_ADDRESS = os.environ.get("BIND_ADDRESS", "0.0.0.0")
+    PORT = int(os.environ.get("PORT", "8000"))
+    
+    # Helper bots for parallel BIN_CHANNEL fetches (comma separated tokens, each bot must be a BIN_CHANNEL admin)
+    HELPER_BOT_TOKENS = [x.strip() for x in os.environ.get("HELPER_BOT_TOKENS", "").split(",") if x.strip()]
+    PARALLEL_CHUNKS = int(os.environ.get("PARALLEL_CHUNKS", "4"))  # parts in flight per connection
+    
+    # Stream chunk cache (RAM tier, plus an optional disk tier when CHUNK_DISK_CACHE_SIZE > 0)
+    CHUNK_CACHE_SIZE = int(os.environ.get("CHUNK_CACHE_SIZE", "268435456"))  # 256MB
+    CHUNK_DISK_CACHE_SIZE = int(os.environ.get("CHUNK_DISK_CACHE_SIZE", "0"))
+    CHUNK_CACHE_DIR = os.environ.get("CHUNK_CACHE_DIR", "data/files/chunks")
+    PREFETCH_CHUNKS = int(os.environ.get("PREFETCH_CHUNKS", "2"))  # parts fetched ahead after each range
+    
+    # HLS mode for /stream: playlists and segments cut on demand by ffmpeg, cached on disk
+    HLS_ENABLED = os.environ.get("HLS_ENABLED", "False").lower() == "true"
+    HLS_SEGMENT_DURATION = int(os.environ.get("HLS_SEGMENT_DURATION", "6"))  # seconds
+    HLS_WORKERS = int(os.environ.get("HLS_WORKERS", "2"))  # ffmpeg processes cutting segments at once
+    HLS_SEGMENT_TIMEOUT = int(os.environ.get("HLS_SEGMENT_TIMEOUT", "60"))
+    HLS_KEYFRAME_TIMEOUT = int(os.environ.get("HLS_KEYFRAME_TIMEOUT", "600"))  # seconds to scan a file's keyframes
+    HLS_CACHE_DIR = os.environ.get("HLS_CACHE_DIR", "data/files/hls")
+    HLS_CACHE_SIZE = int(os.environ.get("HLS_CACHE_SIZE", "5368709120"))  # 5GB
+    
+    # Local storage tier: small uploads and hot files served from disk with sendfile (0 disables)
+    LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", "data/files/local")
+    LOCAL_STORAGE_SIZE = int(os.environ.get("LOCAL_STORAGE_SIZE", "10737418240"))  # 10GB
+    LOCAL_STORAGE_MAX_FILE_SIZE = int(os.environ.get("LOCAL_STORAGE_MAX_FILE_SIZE", "52428800"))  # 50MB
+    LOCAL_STORAGE_HOT_REQUESTS = int(os.environ.get("LOCAL_STORAGE_HOT_REQUESTS", "3"))  # streams before a copy
+    LOCAL_STORAGE_PROMOTIONS = int(os.environ.get("LOCAL_STORAGE_PROMOTIONS", "2"))  # copies running at once
+    
+    # Broadcast
+    BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))  # messages per second
+    BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "20"))
+    BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "500"))  # users per checkpoint
+    
+    # Outbound messages: Telegram allows about 30 per second overall, 1 per second per user
+    # and 20 per minute per group or channel
+    OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", "30"))  # messages per second
+    OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+    OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", "0.33"))
+    OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+    OUTBOUND_MAX_FLOOD_WAIT = int(os.environ.get("OUTBOUND_MAX_FLOOD_WAIT", "30"))  # longer waits fail the call
+    OUTBOUND_MAX_BACKGROUND = int(os.environ.get("OUTBOUND_MAX_BACKGROUND", "1000"))  # queued log messages
+    
+    # /myfiles
+    MYFILES_PAGE_SIZE = int(os.environ.get("MYFILES_PAGE_SIZE", "8"))
+    
+    # /stats counters
+    STATS_RECONCILE_INTERVAL = int(os.environ.get("STATS_RECONCILE_INTERVAL", "3600"))  # seconds between recounts
+    STATS_HISTORY_DAYS = int(os.environ.get("STATS_HISTORY_DAYS", "7"))  # daily buckets shown by /stats
+    
+    # Scale-out: every instance shares DATABASE_URL; only ROLE=bot polls updates, ROLE=worker runs jobs
+    ROLE = os.environ.get("ROLE", "bot").lower()
+    INSTANCE_ID = os.environ.get("INSTANCE_ID", f"{os.uname().nodename}-{os.getpid()}")
+    WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "0"))  # local worker processes started by the bot
+    JOB_QUEUE = os.environ.get("JOB_QUEUE", "False").lower() == "true" or WORKER_PROCESSES > 0
+    WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "2"))  # jobs run at once per instance
+    JOB_LEASE = int(os.environ.get("JOB_LEASE", "60"))  # seconds before a silent worker's job is reclaimed
+    JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+    JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+    JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", "7200"))  # seconds the bot waits for a job result
+    LEADER_LEASE = int(os.environ.get("LEADER_LEASE", "30"))  # seconds before another instance takes over
+    
+    # Process lifecycle
+    SESSION_DIR = os.environ.get("SESSION_DIR", "data/sessions")  # persistent Pyrogram sessions, skip re-authorizing
+    SESSION_NAME = os.environ.get("SESSION_NAME", "MystreamBot")  # unique per process sharing SESSION_DIR
+    SHUTDOWN_TIMEOUT = int(os.environ.get("SHUTDOWN_TIMEOUT", "25"))  # seconds to drain transfers on SIGTERM
     
     # Premium Configuration
     PREMIUM_DAILY_LIMIT = int(os.environ.get("PREMIUM_DAILY_LIMIT", "50"))
@@ -42,7 +141,7 @@ class Config:
     
     ABOUT_TEXT = """🤖 **About {}** \n\n**Version:** 2.0 \n**Developer:** @sathishsksk \n**Source:** [GitHub](https://github.com/sathishsksk/Mystream) \n\n**🚀 Features:** \n• Multi-quality streaming \n• Direct download links \n• Embed player support \n• Premium system \n• User management \n• Auto cleanup \n• MongoDB database \n• Admin controls \n• Broadcast system \n• Ban system \n• Usage statistics"""
     
-    HELP_TEXT = """📖 **How to Use** \n\n1. **Send any file** (document, video, audio, photo) \n2. **Get multiple links** (direct download, stream, embed) \n3. **Share the links** with anyone \n\n**📁 Supported Files:** \n• Videos (MP4, MKV, AVI) - Up to {premium_size} \n• Audio (MP3, WAV, FLAC) - Up to {premium_size} \n• Documents (PDF, ZIP, etc.) - Up to {premium_size} \n• Images (JPG, PNG, etc.) \n\n**⚡ Commands:** \n/start - Start the bot \n/stats - Bot statistics (admin) \n/broadcast - Broadcast message (admin) \n/ban - Ban user (admin) \n/unban - Unban user (admin) \n\n**Need help?** Join @{support_group}"""
+    HELP_TEXT = """📖 **How to Use** \n\n1. **Send any file** (document, video, audio, photo) \n2. **Get multiple links** (direct download, stream, embed) \n3. **Share the links** with anyone \n\n**📁 Supported Files:** \n• Videos (MP4, MKV, AVI) - Up to {premium_size} \n• Audio (MP3, WAV, FLAC) - Up to {premium_size} \n• Documents (PDF, ZIP, etc.) - Up to {premium_size} \n• Images (JPG, PNG, etc.) \n\n**⚡ Commands:** \n/start - Start the bot \n/myfiles - Browse your files \n/stats - Bot statistics (admin) \n/broadcast - Broadcast message (admin) \n/ban - Ban user (admin) \n/unban - Unban user (admin) \n\n**Need help?** Join @{support_group}"""
     
     @classmethod
     def format_start_text(cls, name, username):
@@ -73,6 +172,10 @@ class Config:
             support_group=cls.SUPPORT_GROUP
         )
 
+def session_name(base: str, token: str) -> str:
+    # Suffixed with the bot id from the token, so a new token never picks up another bot's session
+    return f"{base}_{token.split(':')[0]}"
+
 def humanbytes(size):
     if not size:
         return "0 B"
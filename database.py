@@ -1,14 +1,278 @@
+import time
+import asyncio
+import logging
 import motor.motor_asyncio
 import datetime
-from typing import List, Dict, Any
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+from pymongo import ASCENDING, DESCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import ObjectId
+import metrics
+from config import Config
 
+logger = logging.getLogger(__name__)
+
+# Only the fields the handlers check on every message are cached
+USER_STATE_PROJECTION = {
+    '_id': 0, 'is_banned': 1, 'is_premium': 1, 'premium_until': 1, 'daily_usage': 1, 'usage_day': 1
+}
+
+_MISSING = object()
+
+def usage_day(now: Optional[datetime.datetime] = None) -> str:
+    """The day bucket daily_usage counts against; a new day starts from 0 without any reset job"""
+    return (now or datetime.datetime.utcnow()).strftime('%Y-%m-%d')
+
+def user_state(user: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if not user:
+        return None
+    return {
+        'banned': user.get('is_banned', False),
+        'premium_until': user.get('premium_until') if user.get('is_premium', False) else None,
+        'daily_usage': user.get('daily_usage', 0),
+        'usage_day': user.get('usage_day')
+    }
+
+# Seconds before expiry after which a stored file is no longer handed out for deduplication
+SHARE_EXPIRY_MARGIN = 60
+
+# What a /myfiles page renders, the links are only loaded when a file is opened
+FILE_LIST_PROJECTION = {'file_name': 1, 'file_size': 1, 'upload_date': 1, 'record_id': 1}
+
+# Finished jobs are kept a day for inspection, then the TTL index removes them
+JOB_RETENTION = 86400
+
+class UserStateCache:
+    """TTL + LRU cache of compact per-user state, None is cached for unknown users"""
+    
+    def __init__(self, max_size: int = 10000, ttl: int = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+    
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+    
+    def set(self, user_id: int, state: Optional[Dict[str, Any]]):
+        self._entries[user_id] = (state, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+class WriteBehindBuffer:
+    """Coalesces counter updates per document and writes them as one unordered bulk_write.
+    
+    A crash loses at most `interval` seconds or `max_pending` documents worth of updates.
+    While flushes fail, updates for new documents past BACKLOG_FACTOR * `max_pending` are dropped.
+    """
+    
+    BACKLOG_FACTOR = 4
+    
+    def __init__(self, collection, interval: float, max_pending: int, upsert: bool = False):
+        self.collection = collection
+        self.interval = interval
+        self.max_pending = max_pending
+        self.upsert = upsert
+        self.pending = {}
+        self._task = None
+        self._full = None
+    
+    def add(self, key: str, value: Any, inc: Dict[str, int], latest: Optional[Dict[str, Any]] = None):
+        if (key, value) not in self.pending and len(self.pending) >= self.max_pending * self.BACKLOG_FACTOR:
+            WRITE_BEHIND_DROPPED.inc(collection=self.collection.name)
+            return
+        update = self.pending.setdefault((key, value), {'$inc': {}, '$max': {}})
+        for field, amount in inc.items():
+            update['$inc'][field] = update['$inc'].get(field, 0) + amount
+        for field, when in (latest or {}).items():
+            # $max keeps timestamps right even when flushes land out of order
+            update['$max'][field] = max(update['$max'].get(field, when), when)
+        if len(self.pending) >= self.max_pending and self._full:
+            self._full.set()
+    
+    async def flush(self) -> bool:
+        if not self.pending:
+            return True
+        pending, self.pending = list(self.pending.items()), {}
+        operations = [
+            UpdateOne({key: value}, {op: fields for op, fields in update.items() if fields}, upsert=self.upsert)
+            for (key, value), update in pending
+        ]
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # The unordered batch applied everything but the listed operations, retrying the rest would count them twice
+            failed = [pending[error['index']] for error in e.details.get('writeErrors', [])]
+            logger.error(f"Write-behind flush to {self.collection.name} failed for {len(failed)} of "
+                         f"{len(operations)} documents, retrying them later: {e.details.get('writeErrors', [])[:1]}")
+            self._requeue(failed)
+            WRITE_BEHIND_FLUSHED.inc(len(operations) - len(failed), collection=self.collection.name)
+            return not failed
+        except Exception as e:
+            logger.error(f"Write-behind flush to {self.collection.name} failed, retrying later: {e}")
+            self._requeue(pending)
+            return False
+        WRITE_BEHIND_FLUSHED.inc(len(operations), collection=self.collection.name)
+        return True
+    
+    def _requeue(self, updates):
+        for (key, value), update in updates:
+            self.add(key, value, update['$inc'], update['$max'])
+    
+    def start(self):
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+    
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            if not await self.flush():
+                # Don't hammer a struggling server just because the buffer is full
+                await asyncio.sleep(self.interval)
+
+WRITE_BEHIND_FLUSHED = metrics.Counter(
+    "bot_write_behind_operations_total", "Coalesced updates written by bulk_write", ["collection"]
+)
+WRITE_BEHIND_DROPPED = metrics.Counter(
+    "bot_write_behind_dropped_total", "Counter updates dropped while the buffer was full of failed writes", ["collection"]
+)
+
+@metrics.instrument_database
 class Database:
-    def __init__(self, uri: str, database_name: str):
-        self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+    def __init__(self, uri: str, database_name: str, cache_size: int = 10000, cache_ttl: int = 60):
+        # Connects on first use; warm_up() does that before the bot takes traffic
+        self._client = motor.motor_asyncio.AsyncIOMotorClient(
+            uri, connect=False, minPoolSize=Config.MONGO_MIN_POOL_SIZE
+        )
         self.db = self._client[database_name]
         self.users = self.db.users
         self.files = self.db.files
+        # One document per deduplicated upload, pointing at the shared record in files
+        self.file_refs = self.db.file_refs
         self.premium = self.db.premium
+        self.broadcasts = self.db.broadcasts
+        self.jobs = self.db.jobs
+        self.locks = self.db.locks
+        self.stats = self.db.stats
+        self.user_cache = UserStateCache(cache_size, cache_ttl)
+        self.file_counters = WriteBehindBuffer(self.files, Config.WRITE_BEHIND_INTERVAL, Config.WRITE_BEHIND_MAX_PENDING)
+        self.stats_counters = WriteBehindBuffer(
+            self.stats, Config.WRITE_BEHIND_INTERVAL, Config.WRITE_BEHIND_MAX_PENDING, upsert=True
+        )
+        metrics.Gauge(
+            "bot_write_behind_pending", "Documents with buffered counter updates", ["collection"],
+            function=lambda: {'files': len(self.file_counters.pending), 'stats': len(self.stats_counters.pending)}
+        )
+    
+    # Write-behind counters
+    def start_write_behind(self):
+        self.file_counters.start()
+        self.stats_counters.start()
+    
+    async def stop_write_behind(self):
+        """Stop the flush loops and write out whatever is still buffered"""
+        await self.file_counters.stop()
+        await self.stats_counters.stop()
+    
+    async def warm_up(self):
+        """Open the connection pool and make sure the indexes exist"""
+        await self.db.command('ping')
+        await self.ensure_indexes()
+    
+    # Index Management
+    async def ensure_indexes(self):
+        """Create the indexes the hot queries rely on, safe to run on every start"""
+        indexes = [
+            (self.users, [('id', ASCENDING)], {'unique': True}),
+            (self.users, [('premium_until', ASCENDING)], {}),
+            (self.files, [('file_id', ASCENDING)], {'unique': True}),
+            (self.files, [('user_id', ASCENDING), ('upload_date', DESCENDING), ('_id', DESCENDING)], {}),
+            (self.files, [('bin_message_id', ASCENDING)], {}),
+            (self.files, [('file_unique_id', ASCENDING)], {'sparse': True}),
+            (self.files, [('content_hash', ASCENDING)], {'sparse': True}),
+            (self.file_refs, [('user_id', ASCENDING), ('upload_date', DESCENDING), ('_id', DESCENDING)], {}),
+            (self.file_refs, [('record_id', ASCENDING)], {}),
+            # A reference ends with its own upload's expiry, the record may live on for newer ones
+            (self.file_refs, [('expires_at', ASCENDING)], {'expireAfterSeconds': 0}),
+            (self.jobs, [('status', ASCENDING), ('kind', ASCENDING), ('created_at', ASCENDING)], {}),
+            (self.jobs, [('finished_at', ASCENDING)], {'expireAfterSeconds': JOB_RETENTION}),
+        ]
+        for collection, keys, options in indexes:
+            try:
+                await collection.create_index(keys, **options)
+            except OperationFailure as e:
+                logger.error(f"Could not create index {keys} on {collection.name}: {e}")
+        
+        await self._ensure_files_ttl()
+    
+    async def _ensure_files_ttl(self):
+        # The expiry scheduler queries this index for due files and deletes them together with their
+        # BIN_CHANNEL message; the TTL only removes whatever it missed after a grace period
+        name = 'expires_at_ttl'
+        existing = await self.files.index_information()
+        if Config.AUTO_DELETE_TIME <= 0:
+            if name in existing:
+                await self.files.drop_index(name)
+            return
+        
+        expire_after = Config.EXPIRY_GRACE
+        if name not in existing:
+            await self.files.create_index('expires_at', name=name, expireAfterSeconds=expire_after)
+        elif existing[name].get('expireAfterSeconds') != expire_after:
+            await self.db.command('collMod', 'files', index={
+                'name': name,
+                'expireAfterSeconds': expire_after
+            })
+    
+    async def get_user_state(self, user_id: int) -> Optional[Dict[str, Any]]:
+        state = self.user_cache.get(user_id)
+        if state is not _MISSING:
+            return state
+        
+        user = await self.users.find_one({'id': user_id}, USER_STATE_PROJECTION)
+        state = user_state(user)
+        self.user_cache.set(user_id, state)
+        return state
     
     # User Management
     async def add_user(self, id: int):
@@ -21,13 +285,32 @@ class Database:
             "is_premium": False,
             "premium_until": None,
             "daily_usage": 0,
-            "last_reset": datetime.datetime.utcnow().date()
+            "usage_day": usage_day()
         }
-        await self.users.insert_one(user)
+        try:
+            await self.users.insert_one(user)
+            self._record_stats({'users': 1}, {'new_users': 1})
+        except DuplicateKeyError:
+            # Another handler registered the same user first
+            pass
+        self.user_cache.invalidate(id)
     
     async def is_user_exist(self, id: int) -> bool:
-        user = await self.users.find_one({'id': id})
-        return bool(user)
+        return await self.get_user_state(id) is not None
+    
+    async def get_access_profile(self, user_id: int) -> Dict[str, Any]:
+        """Everything file_handler checks before accepting an upload, from one projected query"""
+        state = await self.get_user_state(user_id)
+        if not state:
+            return {'exists': False, 'banned': False, 'premium': False, 'daily_usage': 0}
+        
+        now = datetime.datetime.utcnow()
+        return {
+            'exists': True,
+            'banned': state['banned'],
+            'premium': bool(state['premium_until'] and state['premium_until'] > now),
+            'daily_usage': state['daily_usage'] if state['usage_day'] == usage_day(now) else 0
+        }
     
     async def get_all_users(self) -> List[int]:
         users = []
@@ -35,6 +318,26 @@ class Database:
             users.append(user['id'])
         return users
     
+    async def iter_user_ids(self, after_id: Optional[int] = None, limit: int = 0):
+        """Stream reachable user IDs in ascending order, starting after `after_id`"""
+        query = {'is_dead': {'$ne': True}}
+        if after_id is not None:
+            query['id'] = {'$gt': after_id}
+        cursor = self.users.find(query, {'_id': 0, 'id': 1}).sort('id', ASCENDING).limit(limit)
+        async for user in cursor:
+            yield user['id']
+    
+    async def mark_dead_users(self, user_ids: List[int]):
+        """Flag users who blocked the bot or deleted their account so broadcasts skip them"""
+        if not user_ids:
+            return
+        await self.users.update_many(
+            {'id': {'$in': user_ids}},
+            {'$set': {'is_dead': True}}
+        )
+        for user_id in user_ids:
+            self.user_cache.invalidate(user_id)
+    
     async def total_users_count(self) -> int:
         return await self.users.count_documents({})
     
@@ -43,117 +346,437 @@ class Database:
             {'id': user_id},
             {'$set': {'is_banned': True}}
         )
+        self.user_cache.invalidate(user_id)
     
     async def unban_user(self, user_id: int):
         await self.users.update_one(
             {'id': user_id},
             {'$set': {'is_banned': False}}
         )
+        self.user_cache.invalidate(user_id)
     
     async def is_banned(self, user_id: int) -> bool:
-        user = await self.users.find_one({'id': user_id})
-        return user.get('is_banned', False) if user else False
+        state = await self.get_user_state(user_id)
+        return state['banned'] if state else False
     
     # Premium Management
     async def upgrade_premium(self, user_id: int, days: int):
-        premium_until = datetime.datetime.utcnow() + datetime.timedelta(days=days)
-        await self.users.update_one(
+        now = datetime.datetime.utcnow()
+        premium_until = now + datetime.timedelta(days=days)
+        before = await self.users.find_one_and_update(
             {'id': user_id},
             {'$set': {
                 'is_premium': True,
                 'premium_until': premium_until
-            }}
+            }},
+            projection={'_id': 0, 'premium_until': 1}
         )
+        # Extending an active premium doesn't add a premium user
+        if before and not (before.get('premium_until') and before['premium_until'] > now):
+            self._record_stats({'premium': 1}, {'new_premium': 1})
+        self.user_cache.invalidate(user_id)
     
     async def is_premium(self, user_id: int) -> bool:
-        user = await self.users.find_one({'id': user_id})
-        if not user:
+        state = await self.get_user_state(user_id)
+        if not state:
             return False
         
-        if user.get('is_premium', False) and user.get('premium_until'):
-            if user['premium_until'] > datetime.datetime.utcnow():
+        if state['premium_until']:
+            if state['premium_until'] > datetime.datetime.utcnow():
                 return True
             else:
                 # Premium expired
-                await self.users.update_one(
-                    {'id': user_id},
+                result = await self.users.update_one(
+                    {'id': user_id, 'is_premium': True},
                     {'$set': {'is_premium': False}}
                 )
+                if result.modified_count:
+                    self._record_stats({'premium': -1})
+                self.user_cache.invalidate(user_id)
                 return False
         return False
     
     async def premium_users_count(self) -> int:
-        return await self.users.count_documents({'is_premium': True})
+        # is_premium is only cleared lazily, premium_until is what decides
+        return await self.users.count_documents({'premium_until': {'$gt': datetime.datetime.utcnow()}})
     
     # File Management
     async def add_file_record(self, file_id: str, file_name: str, file_size: int, mime_type: str,
-                            bin_message_id: int, direct_link: str, stream_link: str, embed_link: str, 
-                            user_id: int, premium: bool):
+                            bin_message_id: int, user_id: int, premium: bool,
+                            file_unique_id: Optional[str] = None,
+                            content_hash: Optional[str] = None,
+                            media_info: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # Links are signed from the record when needed (links.build_links), not stored
+        now = datetime.datetime.utcnow()
         file_record = {
             "file_id": file_id,
             "file_name": file_name,
             "file_size": file_size,
             "mime_type": mime_type,
             "bin_message_id": bin_message_id,
-            "direct_link": direct_link,
-            "stream_link": stream_link,
-            "embed_link": embed_link,
             "user_id": user_id,
             "is_premium": premium,
-            "upload_date": datetime.datetime.utcnow(),
+            "upload_date": now,
             "access_count": 0,
-            "last_accessed": datetime.datetime.utcnow()
+            "last_accessed": now,
+            "ref_count": 1
         }
+        if file_unique_id:
+            file_record["file_unique_id"] = file_unique_id
+        if content_hash:
+            file_record["content_hash"] = content_hash
+        if media_info:
+            # Duration, resolution, codecs and thumbnail key from mediainfo.MediaProcessor
+            file_record["media_info"] = media_info
+        if Config.AUTO_DELETE_TIME > 0:
+            file_record["expires_at"] = now + datetime.timedelta(seconds=Config.AUTO_DELETE_TIME)
         await self.files.insert_one(file_record)
+        self._record_stats({'files': 1, 'bytes': file_size}, {'uploads': 1, 'bytes_uploaded': file_size})
+        return file_record
+    
+    async def set_media_info(self, record_id: ObjectId, media_info: Dict[str, Any]):
+        await self.files.update_one({'_id': record_id}, {'$set': {'media_info': media_info}})
+    
+    async def find_shared_file(self, file_unique_id: Optional[str] = None,
+                               content_hash: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Find a stored copy of the same file by Telegram's file_unique_id or by content hash"""
+        if file_unique_id:
+            query = {'file_unique_id': file_unique_id}
+        elif content_hash:
+            query = {'content_hash': content_hash}
+        else:
+            return None
         
-        # Update user daily usage
-        await self.users.update_one(
-            {'id': user_id},
-            {'$inc': {'daily_usage': 1}}
+        if Config.AUTO_DELETE_TIME > 0:
+            # Leave records that are about to expire to the scheduler, it may already hold them
+            margin = datetime.datetime.utcnow() + datetime.timedelta(seconds=SHARE_EXPIRY_MARGIN)
+            query['expires_at'] = {'$gt': margin}
+        return await self.files.find_one(query)
+    
+    async def add_file_reference(self, record_id: ObjectId, user_id: int) -> Optional[Dict[str, Any]]:
+        """Count another reference to a stored file, it is only auto-deleted after the newest one expires.
+        
+        The uploader gets a file_refs entry so the file shows up in their /myfiles.
+        Returns the updated record, whose expires_at the new links are signed with.
+        """
+        now = datetime.datetime.utcnow()
+        update = {'$inc': {'ref_count': 1}}
+        reference = {'user_id': user_id, 'record_id': record_id, 'upload_date': now}
+        if Config.AUTO_DELETE_TIME > 0:
+            expires_at = now + datetime.timedelta(seconds=Config.AUTO_DELETE_TIME)
+            update['$max'] = {'expires_at': expires_at}
+            reference['expires_at'] = expires_at
+        record = await self.files.find_one_and_update(
+            {'_id': record_id}, update, return_document=ReturnDocument.AFTER
         )
+        if record:
+            # Name and size are copied so a /myfiles page needs no lookup in files
+            reference.update(file_name=record['file_name'], file_size=record['file_size'])
+            await self.file_refs.insert_one(reference)
+            # A deduplicated upload still counts as an upload, it just stores nothing new
+            self._record_stats(day={'uploads': 1})
+        return record
+    
+    async def has_file_reference(self, record_id: ObjectId, user_id: int) -> bool:
+        return await self.file_refs.find_one({'record_id': record_id, 'user_id': user_id}, {'_id': 1}) is not None
+    
+    async def remove_file_reference(self, record_id: ObjectId, user_id: int) -> bool:
+        """Drop one of the user's references to a shared file; the file itself stays for the others"""
+        reference = await self.file_refs.find_one_and_delete({'record_id': record_id, 'user_id': user_id}, {'_id': 1})
+        if not reference:
+            return False
+        await self.files.update_one({'_id': record_id}, {'$inc': {'ref_count': -1}})
+        return True
     
     async def get_file_by_id(self, file_id: str):
         return await self.files.find_one({'file_id': file_id})
     
-    async def get_user_files(self, user_id: int, limit: int = 50):
-        files = []
-        async for file in self.files.find({'user_id': user_id}).sort('upload_date', -1).limit(limit):
-            files.append(file)
-        return files
+    async def get_file_by_message(self, bin_message_id: int) -> Optional[Dict[str, Any]]:
+        return await self.files.find_one(
+            {'bin_message_id': bin_message_id},
+            projection={'file_name': 1, 'mime_type': 1, 'media_info': 1}
+        )
+    
+    async def get_file_record(self, record_id: ObjectId) -> Optional[Dict[str, Any]]:
+        return await self.files.find_one({'_id': record_id})
+    
+    async def get_user_files(self, user_id: int, limit: int = 10, cursor: Optional[tuple] = None,
+                             newer: bool = False):
+        """One page of a user's files, newest first, keyset-paginated on (upload_date, _id).
+        
+        Their own records and their file_refs entries are paged alike and merged; a reference
+        row carries the shared record's id as `record_id`. `cursor` is the (upload_date, _id)
+        of the last row already shown, or of the first one when paging back with `newer`.
+        Returns (files, whether there is another page).
+        """
+        query = {'user_id': user_id}
+        if cursor:
+            upload_date, record_id = cursor
+            op = '$gt' if newer else '$lt'
+            query['$or'] = [
+                {'upload_date': {op: upload_date}},
+                {'upload_date': upload_date, '_id': {op: record_id}}
+            ]
+        direction = ASCENDING if newer else DESCENDING
+        pages = await asyncio.gather(*(
+            collection.find(query, FILE_LIST_PROJECTION).sort(
+                [('upload_date', direction), ('_id', direction)]
+            ).limit(limit + 1).to_list(length=limit + 1)
+            for collection in (self.files, self.file_refs)
+        ))
+        files = sorted(pages[0] + pages[1], key=lambda f: (f['upload_date'], f['_id']), reverse=not newer)[:limit + 1]
+        
+        has_more = len(files) > limit
+        files = files[:limit]
+        if newer:
+            files.reverse()
+        return files, has_more
     
     async def total_files_count(self) -> int:
         return await self.files.count_documents({})
     
-    async def increment_access_count(self, file_id: str):
-        await self.files.update_one(
-            {'file_id': file_id},
-            {'$inc': {'access_count': 1}, '$set': {'last_accessed': datetime.datetime.utcnow()}}
-        )
+    async def increment_access_count(self, bin_message_id: int):
+        self.file_counters.add('bin_message_id', bin_message_id, {'access_count': 1},
+                               {'last_accessed': datetime.datetime.utcnow()})
     
     async def delete_file(self, bin_message_id: int):
-        await self.files.delete_one({'bin_message_id': bin_message_id})
+        deleted = await self.files.find_one_and_delete({'bin_message_id': bin_message_id}, {'file_size': 1})
+        if deleted:
+            await self.file_refs.delete_many({'record_id': deleted['_id']})
+            self._record_stats({'files': -1, 'bytes': -deleted.get('file_size', 0)}, {'deleted_files': 1})
     
-    # Usage Management
-    async def reset_daily_usage(self):
-        """Reset daily usage for all users (run daily via cron)"""
-        await self.users.update_many(
-            {},
-            {'$set': {'daily_usage': 0, 'last_reset': datetime.datetime.utcnow().date()}}
+    async def delete_user_file(self, record_id: ObjectId, user_id: int) -> Optional[Dict[str, Any]]:
+        """Delete a file for its owner, unless deduplicated uploads of other users still point at it"""
+        deleted = await self.files.find_one_and_delete(
+            {'_id': record_id, 'user_id': user_id, 'ref_count': {'$not': {'$gt': 1}}},
+            {'bin_message_id': 1, 'file_size': 1}
+        )
+        if deleted:
+            # References whose own expiry passed may still be waiting for the TTL monitor
+            await self.file_refs.delete_many({'record_id': record_id})
+            self._record_stats({'files': -1, 'bytes': -deleted.get('file_size', 0)}, {'deleted_files': 1})
+        return deleted
+    
+    async def claim_expired_files(self, limit: int, lease: int = 300) -> List[Dict[str, Any]]:
+        """Lease up to `limit` expired records so only one scheduler loop deletes them"""
+        now = datetime.datetime.utcnow()
+        query = {
+            'expires_at': {'$lte': now},
+            '$or': [{'claimed_until': {'$exists': False}}, {'claimed_until': {'$lt': now}}]
+        }
+        due = await self.files.find(query, {'_id': 1}).limit(limit).to_list(length=limit)
+        if not due:
+            return []
+        
+        claim = ObjectId()
+        ids = [f['_id'] for f in due]
+        await self.files.update_many(
+            {'_id': {'$in': ids}, **query},
+            {'$set': {'claim': claim, 'claimed_until': now + datetime.timedelta(seconds=lease)}}
+        )
+        # Look the claim up by _id, the claim field itself isn't indexed
+        return await self.files.find(
+            {'_id': {'$in': ids}, 'claim': claim}, {'_id': 1, 'bin_message_id': 1}
+        ).to_list(length=limit)
+    
+    async def delete_files(self, ids: List[ObjectId]):
+        sizes = await self.files.find({'_id': {'$in': ids}}, {'file_size': 1}).to_list(length=None)
+        result = await self.files.delete_many({'_id': {'$in': ids}})
+        await self.file_refs.delete_many({'record_id': {'$in': ids}})
+        if result.deleted_count:
+            freed = sum(f.get('file_size', 0) for f in sizes)
+            self._record_stats({'files': -result.deleted_count, 'bytes': -freed},
+                               {'deleted_files': result.deleted_count})
+    
+    # Stats
+    def _record_stats(self, totals: Optional[Dict[str, int]] = None, day: Optional[Dict[str, int]] = None):
+        """Buffer counter changes for the running totals and today's history bucket"""
+        if totals:
+            self.stats_counters.add('_id', 'totals', totals)
+        if day:
+            self.stats_counters.add('_id', f"day:{usage_day()}", day)
+    
+    async def get_stats(self, days: int = 7) -> Dict[str, Any]:
+        """Totals and the last `days` daily buckets from one _id lookup, whatever the collection sizes"""
+        now = datetime.datetime.utcnow()
+        keys = ['totals'] + [f"day:{usage_day(now - datetime.timedelta(days=i))}" for i in range(days)]
+        found = {doc['_id']: doc async for doc in self.stats.find({'_id': {'$in': keys}})}
+        
+        def merged(key: str) -> Dict[str, Any]:
+            doc = found.get(key, {})
+            # Include what this instance hasn't flushed yet
+            pending = self.stats_counters.pending.get(('_id', key))
+            for field, amount in (pending['$inc'] if pending else {}).items():
+                doc[field] = doc.get(field, 0) + amount
+            return doc
+        
+        return {
+            'totals': merged('totals'),
+            'days': [(key[len('day:'):], merged(key)) for key in reversed(keys[1:])]
+        }
+    
+    async def reconcile_stats(self) -> Dict[str, int]:
+        """Recount the totals, correcting drift from TTL deletes, lazy premium expiry and crashes"""
+        await self.stats_counters.flush()
+        now = datetime.datetime.utcnow()
+        bytes_stored = 0
+        async for row in self.files.aggregate([{'$group': {'_id': None, 'bytes': {'$sum': '$file_size'}}}]):
+            bytes_stored = row['bytes']
+        totals = {
+            'users': await self.users.estimated_document_count(),
+            'files': await self.files.estimated_document_count(),
+            'bytes': bytes_stored,
+            'premium': await self.premium_users_count()
+        }
+        await self.stats.update_one(
+            {'_id': 'totals'}, {'$set': {**totals, 'reconciled_at': now}}, upsert=True
+        )
+        # The day bucket also keeps a snapshot, so the history shows growth and not only activity
+        await self.stats.update_one(
+            {'_id': f"day:{usage_day(now)}"},
+            {'$set': {f"total_{name}": value for name, value in totals.items()}},
+            upsert=True
         )
+        return totals
     
+    # Usage Management
     async def get_daily_usage(self, user_id: int) -> int:
-        user = await self.users.find_one({'id': user_id})
-        if user and user.get('last_reset') == datetime.datetime.utcnow().date():
-            return user.get('daily_usage', 0)
-        return 0
+        profile = await self.get_access_profile(user_id)
+        return profile['daily_usage']
     
     async def can_upload(self, user_id: int) -> bool:
-        user = await self.users.find_one({'id': user_id})
-        if not user:
+        profile = await self.get_access_profile(user_id)
+        if not profile['exists']:
             return False
         
-        is_premium = await self.is_premium(user_id)
-        daily_limit = Config.PREMIUM_DAILY_LIMIT if is_premium else Config.FREE_DAILY_LIMIT
-        daily_usage = await self.get_daily_usage(user_id)
+        daily_limit = Config.PREMIUM_DAILY_LIMIT if profile['premium'] else Config.FREE_DAILY_LIMIT
+        return profile['daily_usage'] < daily_limit
+    
+    async def consume_upload_quota(self, user_id: int) -> bool:
+        """Check the daily limit and count one upload in a single atomic update.
+        
+        A stale usage_day counts as 0, so the first upload of a day resets the counter.
+        Returns False when the user is missing, banned or already at their limit.
+        """
+        now = datetime.datetime.utcnow()
+        today = usage_day(now)
+        used = {'$cond': [{'$eq': ['$usage_day', today]}, {'$ifNull': ['$daily_usage', 0]}, 0]}
+        limit = {'$cond': [
+            {'$and': [{'$eq': ['$is_premium', True]}, {'$gt': ['$premium_until', now]}]},
+            Config.PREMIUM_DAILY_LIMIT,
+            Config.FREE_DAILY_LIMIT
+        ]}
         
-        return daily_usage < daily_limit
+        user = await self.users.find_one_and_update(
+            {'id': user_id, 'is_banned': {'$ne': True}, '$expr': {'$lt': [used, limit]}},
+            [{'$set': {'daily_usage': {'$add': [used, 1]}, 'usage_day': today}}],
+            projection=USER_STATE_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+        if not user:
+            return False
+        self.user_cache.set(user_id, user_state(user))
+        return True
+    
+    async def refund_upload_quota(self, user_id: int):
+        """Give back an upload counted by consume_upload_quota that did not go through"""
+        await self.users.update_one(
+            {'id': user_id, 'usage_day': usage_day(), 'daily_usage': {'$gt': 0}},
+            {'$inc': {'daily_usage': -1}}
+        )
+        self.user_cache.invalidate(user_id)
+    
+    # Broadcast Management
+    async def create_broadcast(self, from_chat_id: int, message_id: int, admin_chat_id: int,
+                               progress_message_id: int, total: int) -> Dict[str, Any]:
+        broadcast = {
+            "from_chat_id": from_chat_id,
+            "message_id": message_id,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress_message_id,
+            "status": "running",
+            "last_id": None,
+            "total": total,
+            "success": 0,
+            "failed": 0,
+            "dead": 0,
+            "elapsed": 0.0,
+            "started_at": datetime.datetime.utcnow()
+        }
+        result = await self.broadcasts.insert_one(broadcast)
+        broadcast['_id'] = result.inserted_id
+        return broadcast
+    
+    async def update_broadcast(self, broadcast_id, fields: Dict[str, Any]):
+        await self.broadcasts.update_one({'_id': broadcast_id}, {'$set': fields})
+    
+    async def get_running_broadcasts(self) -> List[Dict[str, Any]]:
+        return await self.broadcasts.find({'status': 'running'}).to_list(length=None)
+    
+    # Cluster coordination
+    async def acquire_lock(self, name: str, owner: str, lease: int) -> bool:
+        """Take or renew the named lease; False while another owner holds an unexpired one"""
+        now = datetime.datetime.utcnow()
+        try:
+            lock = await self.locks.find_one_and_update(
+                {'_id': name, '$or': [{'owner': owner}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'expires_at': now + datetime.timedelta(seconds=lease)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The lock exists and is held by someone else, so the upsert tried to insert a second one
+            return False
+        return lock['owner'] == owner
+    
+    async def release_lock(self, name: str, owner: str):
+        await self.locks.delete_one({'_id': name, 'owner': owner})
+    
+    async def enqueue_job(self, kind: str, payload: Dict[str, Any]) -> ObjectId:
+        result = await self.jobs.insert_one({
+            'kind': kind,
+            'payload': payload,
+            'status': 'queued',
+            'attempts': 0,
+            'created_at': datetime.datetime.utcnow()
+        })
+        return result.inserted_id
+    
+    async def claim_job(self, kinds: List[str], worker: str, lease: int) -> Optional[Dict[str, Any]]:
+        """Atomically take the oldest queued job, or a running one whose worker stopped renewing it"""
+        now = datetime.datetime.utcnow()
+        return await self.jobs.find_one_and_update(
+            {
+                'kind': {'$in': kinds},
+                '$or': [{'status': 'queued'}, {'status': 'running', 'lease_until': {'$lt': now}}]
+            },
+            {
+                '$set': {'status': 'running', 'worker': worker,
+                         'lease_until': now + datetime.timedelta(seconds=lease)},
+                '$inc': {'attempts': 1}
+            },
+            sort=[('created_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def renew_job(self, job_id: ObjectId, worker: str, lease: int) -> bool:
+        result = await self.jobs.update_one(
+            {'_id': job_id, 'worker': worker, 'status': 'running'},
+            {'$set': {'lease_until': datetime.datetime.utcnow() + datetime.timedelta(seconds=lease)}}
+        )
+        return result.modified_count == 1
+    
+    async def finish_job(self, job: Dict[str, Any], worker: str, result: Any = None,
+                         error: Optional[str] = None):
+        """Store the result, or requeue a failed job until it runs out of attempts"""
+        if error is None:
+            fields = {'status': 'done', 'result': result, 'finished_at': datetime.datetime.utcnow()}
+        elif job['attempts'] < Config.JOB_MAX_ATTEMPTS:
+            fields = {'status': 'queued', 'error': error}
+        else:
+            fields = {'status': 'failed', 'error': error, 'finished_at': datetime.datetime.utcnow()}
+        # Scoped to this worker, a job reclaimed after a lost lease isn't overwritten
+        await self.jobs.update_one({'_id': job['_id'], 'worker': worker, 'status': 'running'}, {'$set': fields})
+    
+    async def get_job(self, job_id: ObjectId) -> Optional[Dict[str, Any]]:
+        return await self.jobs.find_one({'_id': job_id}, {'status': 1, 'result': 1, 'error': 1})
@@ -0,0 +1,96 @@
+import os
+from collections import OrderedDict
+from typing import Callable, Iterator, Optional
+
+TEMP_SUFFIX = ".tmp"
+
+class DiskLRU:
+    """Files in one directory under a byte budget, the least recently used evicted first.
+
+    Entries are file names. `load()` rebuilds the index from the directory, oldest first by
+    access or modification time, and removes the `.tmp` files an interrupted write left.
+    `on_evict` is called with the name of every entry evicted for space.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, keep_newest: bool = False,
+                 on_evict: Optional[Callable[[str], None]] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Keep the newest entry even when it alone exceeds the budget, it is about to be served
+        self.keep_newest = keep_newest
+        self.on_evict = on_evict
+        self.bytes = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def load(self, accept: Callable[[str], bool], by_access: bool = False):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            if name.endswith(TEMP_SUFFIX):
+                os.remove(path)
+                continue
+            if not accept(name):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime if by_access else stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self.bytes += size
+        self.trim()
+
+    def add(self, name: str) -> int:
+        """Count a file written under `name` as the most recently used entry; returns its size"""
+        size = os.path.getsize(self.path(name))
+        self.bytes += size - self._entries.pop(name, 0)
+        self._entries[name] = size
+        self.trim()
+        return size
+
+    def write(self, name: str, data: bytes) -> int:
+        """Write `data` through a temp file, so a crash never leaves a truncated entry"""
+        self.write_file(name, data)
+        return self.add(name)
+
+    def write_file(self, name: str, data: bytes):
+        """The file half of `write()`; it leaves the index alone, so it can run in an executor"""
+        temp_path = self.path(name) + TEMP_SUFFIX
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self.path(name))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def touch(self, name: str):
+        self._entries.move_to_end(name)
+
+    def drop(self, name: str):
+        self.bytes -= self._entries.pop(name, 0)
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+    def trim(self):
+        while self.bytes > self.max_bytes and len(self._entries) > (1 if self.keep_newest else 0):
+            name = next(iter(self._entries))
+            self.drop(name)
+            if self.on_evict:
+                self.on_evict(name)
@@ -0,0 +1,171 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+from pyrogram.types import Message
+import metrics
+from chunk_cache import CHUNK_SIZE
+from config import Config, humanbytes
+from ratelimit import OutboundScheduler
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = ".part"
+
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+# path -> [lock, users]: two uploads of the same file must not append to one .part at once
+_active: Dict[str, list] = {}
+
+def _hash_prefix(path: str, length: int):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = length
+        while remaining:
+            block = f.read(min(CHUNK_SIZE, remaining))
+            if not block:
+                break
+            sha256.update(block)
+            remaining -= len(block)
+    return sha256
+
+async def _realign(f, part_path: str, offset: int, sha256):
+    """After a failure, continue from the last whole part that was written and hashed"""
+    f.flush()
+    aligned = offset // CHUNK_SIZE * CHUNK_SIZE
+    f.truncate(aligned)
+    if aligned != offset:
+        sha256 = await asyncio.get_running_loop().run_in_executor(None, _hash_prefix, part_path, aligned)
+    return sha256, aligned
+
+async def download_media(client: Client, message: Message, path: str, file_size: int,
+                         on_progress: Optional[ProgressCallback] = None) -> Tuple[str, str]:
+    """Download into `path`.part, resuming after errors and FloodWaits, then rename it to `path`.
+
+    The SHA-256 is computed while downloading. A .part left behind by an earlier attempt
+    is resumed from its last whole part. Returns (path, hex digest).
+    """
+    entry = _active.setdefault(path, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            return await _download(client, message, path, file_size, on_progress)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _active.pop(path, None)
+
+async def _download(client: Client, message: Message, path: str, file_size: int,
+                    on_progress: Optional[ProgressCallback]) -> Tuple[str, str]:
+    part_path = path + PART_SUFFIX
+    loop = asyncio.get_running_loop()
+
+    offset = 0
+    if os.path.exists(part_path):
+        # stream_media works in whole parts, so resume offsets are kept part-aligned
+        offset = os.path.getsize(part_path) // CHUNK_SIZE * CHUNK_SIZE
+        os.truncate(part_path, offset)
+    sha256 = await loop.run_in_executor(None, _hash_prefix, part_path, offset) if offset else hashlib.sha256()
+    if offset:
+        logger.info(f"Resuming {part_path} at {offset} bytes")
+
+    retries = 0
+    started = time.monotonic()
+    resumed_at = offset
+    with open(part_path, "ab") as f:
+        while offset < file_size:
+            try:
+                async for chunk in client.stream_media(message, offset=offset // CHUNK_SIZE):
+                    await loop.run_in_executor(None, f.write, chunk)
+                    sha256.update(chunk)
+                    offset += len(chunk)
+                    retries = 0
+                    if on_progress:
+                        await on_progress(offset, file_size)
+                if offset >= file_size:
+                    break
+                # pyrogram logs most errors and just ends the stream, so a short one is a failure too
+                raise IOError(f"stream ended at {offset} of {file_size} bytes")
+            except FloodWait as e:
+                metrics.record_flood_wait("download", e.value)
+                sha256, offset = await _realign(f, part_path, offset, sha256)
+                await asyncio.sleep(e.value)
+            except (OSError, asyncio.TimeoutError, ConnectionError) as e:
+                retries += 1
+                if retries > Config.DOWNLOAD_RETRIES:
+                    raise
+                logger.warning(f"Download of {path} failed at {offset} bytes, retry {retries}: {e}")
+                sha256, offset = await _realign(f, part_path, offset, sha256)
+                await asyncio.sleep(min(2 ** retries, 30))
+
+    metrics.record_transfer("download", offset - resumed_at, time.monotonic() - started)
+    os.replace(part_path, path)
+    return path, sha256.hexdigest()
+
+def throttled_progress(status: Message, interval: float, outbound: OutboundScheduler) -> ProgressCallback:
+    """Edit `status` with download progress at most once every `interval` seconds"""
+    state = {"next": 0.0}
+
+    async def update(current: int, total: int):
+        now = time.monotonic()
+        if now < state["next"] or current >= total:
+            return
+        state["next"] = now + interval
+        try:
+            # A progress edit is stale by the time a FloodWait ends, so it isn't retried
+            await outbound.call(
+                "progress", status.chat.id, status.edit_text,
+                f"📥 Downloading your file... {current * 100 // total}%\n"
+                f"`{humanbytes(current)}` of `{humanbytes(total)}`",
+                max_wait=0
+            )
+        except FloodWait as e:
+            state["next"] = now + max(interval, e.value)
+        except Exception as e:
+            logger.debug(f"Progress edit failed: {e}")
+
+    return update
+
+class PartialFileSweeper:
+    """Removes .part files nobody resumed within PARTIAL_FILE_MAX_AGE"""
+
+    def __init__(self, directory: str = "downloads"):
+        self.directory = directory
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _loop(self):
+        while True:
+            try:
+                removed = self.sweep()
+                if removed:
+                    logger.info(f"Removed {removed} stale partial download(s)")
+            except OSError as e:
+                logger.error(f"Partial download sweep failed: {e}")
+            await asyncio.sleep(Config.PARTIAL_SWEEP_INTERVAL)
+
+    def sweep(self) -> int:
+        cutoff = time.time() - Config.PARTIAL_FILE_MAX_AGE
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(PART_SUFFIX) or path[:-len(PART_SUFFIX)] in _active:
+                continue
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
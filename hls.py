@@ -0,0 +1,231 @@
+import os
+import re
+import json
+import math
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import metrics
+from config import Config
+from disk_cache import TEMP_SUFFIX, DiskLRU
+from mediainfo import run_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_NAME = re.compile(r"^(copy|audio|video|full)-(\d{1,6})\.ts$")
+# One MPEG-TS packet; anything shorter means the seek landed past the end of the file
+TS_PACKET_SIZE = 188
+
+# Codecs browsers and Apple devices play from MPEG-TS as they are
+COPY_VIDEO_CODECS = {"h264"}
+COPY_AUDIO_CODECS = {"aac", "mp3"}
+
+# Keyframe lists kept in memory, the disk cache holds the rest
+KEYFRAME_MEMORY_SIZE = 256
+
+# Segment mode -> ffmpeg codec arguments; only what can't be copied is re-encoded. A copied video
+# can only be cut at its keyframes, re-encoded ones are cut at fixed times
+COPY_MODES = {"copy", "audio"}
+MODES = {
+    "copy": (["-c:v", "copy"], ["-c:a", "copy"]),
+    "audio": (["-c:v", "copy"], ["-c:a", "aac", "-b:a", "128k"]),
+    "video": (["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"], ["-c:a", "copy"]),
+    "full": (["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"], ["-c:a", "aac", "-b:a", "128k"]),
+}
+
+SEGMENT_HITS = metrics.Counter("bot_hls_segment_hits_total", "HLS segments served from the disk cache")
+SEGMENT_MISSES = metrics.Counter("bot_hls_segment_misses_total", "HLS segments cut by ffmpeg", ["mode"])
+
+class SegmentNotFound(Exception):
+    pass
+
+def remux_mode(media_info: Dict[str, Any]) -> str:
+    """Pick the cheapest segment mode for the probed codecs; unknown codecs are tried as copies"""
+    video = media_info.get("video_codec")
+    audio = media_info.get("audio_codec")
+    copy_video = video is None or video in COPY_VIDEO_CODECS
+    copy_audio = audio is None or audio in COPY_AUDIO_CODECS
+    if copy_video:
+        return "copy" if copy_audio else "audio"
+    return "video" if copy_audio else "full"
+
+def reencode_mode(media_info: Dict[str, Any]) -> str:
+    """The mode that re-encodes the video, for when its keyframes aren't known"""
+    audio = media_info.get("audio_codec")
+    return "video" if audio is None or audio in COPY_AUDIO_CODECS else "full"
+
+def fixed_bounds(duration: float, segment_duration: int = Config.HLS_SEGMENT_DURATION) -> List[float]:
+    return [index * segment_duration for index in range(max(1, math.ceil(duration / segment_duration)))]
+
+def keyframe_bounds(keyframes: List[float], segment_duration: int = Config.HLS_SEGMENT_DURATION) -> List[float]:
+    """Segment start times for a copied video: the first keyframe at least `segment_duration` past the last start"""
+    bounds = [0.0]
+    for time in keyframes:
+        if time - bounds[-1] >= segment_duration:
+            bounds.append(time)
+    return bounds
+
+def segment_lengths(bounds: List[float], duration: float) -> List[float]:
+    return [max(end - start, 0.001) for start, end in zip(bounds, bounds[1:] + [max(duration, bounds[-1])])]
+
+def build_playlist(bounds: List[float], duration: float, mode: str) -> str:
+    """A VOD playlist of the segments starting at `bounds`, named relative to the playlist URL"""
+    lengths = segment_lengths(bounds, duration)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        # Keyframe-aligned segments can run longer than HLS_SEGMENT_DURATION; no EXTINF may exceed this
+        f"#EXT-X-TARGETDURATION:{math.ceil(max(lengths))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for index, length in enumerate(lengths):
+        lines.append(f"#EXTINF:{length:.3f},")
+        lines.append(f"{mode}-{index}.ts")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+class HlsSegmenter:
+    """Cuts HLS segments on demand with ffmpeg and keeps them in an LRU disk cache.
+
+    ffmpeg reads the source through the stream server by range, so only the bytes
+    around a segment are fetched from Telegram. Requests for a segment that is being
+    cut share one ffmpeg run, and the next segment is cut ahead while a slot is free.
+    Segments of a copied video start at its keyframes, which are scanned once per file
+    in the background and cached next to the segments.
+    """
+
+    def __init__(self, cache_dir: str = Config.HLS_CACHE_DIR, max_bytes: int = Config.HLS_CACHE_SIZE,
+                 workers: int = Config.HLS_WORKERS):
+        self.workers = workers
+        self._cache = DiskLRU(cache_dir, max_bytes, keep_newest=True,
+                              on_evict=lambda name: self._keyframes.pop(name, None))
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._scans: Dict[int, asyncio.Task] = {}
+        self._keyframes = OrderedDict()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._scan_slots: Optional[asyncio.Semaphore] = None
+
+        metrics.Gauge("bot_hls_cache_bytes", "Bytes held by the HLS segment cache",
+                      function=lambda: self._cache.bytes)
+
+    def start(self):
+        self._cache.load(lambda name: name.endswith((".ts", ".keyframes.json")))
+        self._slots = asyncio.Semaphore(self.workers)
+        # Scans read whole files, they get their own slots so segments aren't stuck behind them
+        self._scan_slots = asyncio.Semaphore(self.workers)
+
+    async def stop(self):
+        tasks = list(self._inflight.values()) + list(self._scans.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def keyframes(self, message_id: int, source: str) -> Optional[List[float]]:
+        """Keyframe times of the video, or None while they are being scanned"""
+        name = f"{message_id}.keyframes.json"
+        if name in self._cache:
+            keyframes = self._keyframes.get(name)
+            if keyframes is None:
+                try:
+                    with open(self._cache.path(name)) as f:
+                        keyframes = json.load(f)
+                except (OSError, ValueError):
+                    self._cache.drop(name)
+            if keyframes is not None:
+                self._cache.touch(name)
+                self._keyframes[name] = keyframes
+                self._keyframes.move_to_end(name)
+                while len(self._keyframes) > KEYFRAME_MEMORY_SIZE:
+                    self._keyframes.popitem(last=False)
+                return keyframes
+        if message_id not in self._scans:
+            task = asyncio.create_task(self._scan(name, source))
+            self._scans[message_id] = task
+            task.add_done_callback(lambda done: self._scan_done(message_id, done))
+        return None
+
+    def _scan_done(self, message_id: int, task: asyncio.Task):
+        self._scans.pop(message_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Scanning the keyframes of message {message_id} failed: {task.exception()}")
+
+    async def _scan(self, name: str, source: str):
+        async with self._scan_slots:
+            # The packets are only demuxed, nothing is decoded
+            output = await run_ffmpeg("keyframes", [
+                "ffprobe", "-v", "error", "-select_streams", "v:0",
+                "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", source
+            ], Config.HLS_KEYFRAME_TIMEOUT)
+        times, keyframes = [], []
+        for line in output.decode().splitlines():
+            pts_time, _, flags = line.partition(",")
+            if pts_time in ("", "N/A"):
+                continue
+            times.append(float(pts_time))
+            if "K" in flags:
+                keyframes.append(float(pts_time))
+        # Packet times count from the stream's start time, -ss counts from the start of the file
+        start = min(times, default=0.0)
+        self._cache.write(name, json.dumps(sorted(round(time - start, 6) for time in keyframes)).encode())
+
+    async def segment(self, message_id: int, source: str, mode: str, bounds: List[float],
+                      duration: float, index: int) -> str:
+        """Path of segment `index` of the ones starting at `bounds`, cut from `source` (a stream URL) if it isn't cached"""
+        name = self._segment_name(message_id, mode, bounds, index)
+        path = self._cache.path(name)
+        if name in self._cache and os.path.exists(path):
+            self._cache.touch(name)
+            SEGMENT_HITS.inc()
+        else:
+            task = self._inflight.get(name) or self._start_cut(name, source, mode, bounds, duration, index)
+            # Shared with other readers of the segment, a disconnect must not cancel it for them
+            await asyncio.shield(task)
+
+        if index + 1 < len(bounds):
+            next_name = self._segment_name(message_id, mode, bounds, index + 1)
+            if next_name not in self._cache and next_name not in self._inflight and not self._slots.locked():
+                self._start_cut(next_name, source, mode, bounds, duration, index + 1)
+        return path
+
+    @staticmethod
+    def _segment_name(message_id: int, mode: str, bounds: List[float], index: int) -> str:
+        # The start time is part of the name, so keyframe-aligned and fixed segments never mix
+        return f"{message_id}_{mode}_{index}_{round(bounds[index] * 1000)}.ts"
+
+    def _start_cut(self, name: str, source: str, mode: str, bounds: List[float], duration: float,
+                   index: int) -> asyncio.Task:
+        start = bounds[index]
+        length = segment_lengths(bounds, duration)[index]
+        task = asyncio.create_task(self._cut(name, source, mode, start, length))
+        self._inflight[name] = task
+        task.add_done_callback(lambda done: self._cut_done(name, done))
+        return task
+
+    def _cut_done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"HLS segment {key} failed: {task.exception()}")
+
+    async def _cut(self, name: str, source: str, mode: str, start: float, length: float):
+        video, audio = MODES[mode]
+        path = self._cache.path(name)
+        temp_path = path + TEMP_SUFFIX
+        SEGMENT_MISSES.inc(mode=mode)
+        try:
+            async with self._slots:
+                # -copyts keeps the source timestamps, so segments cut separately line up; a copied
+                # video starts exactly at `start` because that is one of its keyframes
+                await run_ffmpeg("segment", [
+                    "ffmpeg", "-v", "error", "-y", "-ss", repr(start), "-i", source,
+                    "-t", repr(length), "-map", "0:v:0", "-map", "0:a:0?",
+                    *video, *audio, "-copyts", "-muxdelay", "0", "-f", "mpegts", temp_path
+                ], Config.HLS_SEGMENT_TIMEOUT)
+            if not os.path.exists(temp_path) or os.path.getsize(temp_path) < TS_PACKET_SIZE:
+                raise SegmentNotFound(name)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._cache.add(name)
@@ -0,0 +1,66 @@
+import time
+import asyncio
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class Lifecycle:
+    """Readiness and in-flight transfer tracking for one bot or worker process.
+
+    The process is "starting" until everything is up, "ready" while it takes traffic and
+    "draining" once a stop signal arrived: new uploads are turned away while the ones
+    already running (uploads, jobs, streams) get until the drain deadline to finish.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self.started = time.monotonic()
+        self._transfers = Counter()
+        self._idle: Optional[asyncio.Event] = None
+
+        metrics.Gauge("bot_ready", "1 while this process takes traffic", function=lambda: int(self.ready))
+        metrics.Gauge("bot_transfers_in_flight", "Transfers a shutdown waits for", ["kind"],
+                      function=self.in_flight)
+
+    @property
+    def status(self) -> str:
+        if self.draining:
+            return "draining"
+        return "ready" if self.ready else "starting"
+
+    def mark_ready(self):
+        self.ready = True
+        logger.info(f"Ready after {time.monotonic() - self.started:.1f}s")
+
+    def in_flight(self) -> Dict[str, int]:
+        return {kind: count for kind, count in self._transfers.items() if count}
+
+    @asynccontextmanager
+    async def transfer(self, kind: str):
+        self._transfers[kind] += 1
+        try:
+            yield
+        finally:
+            self._transfers[kind] -= 1
+            if self._idle and not sum(self._transfers.values()):
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """Stop taking traffic and wait up to `timeout` seconds for running transfers"""
+        self.ready = False
+        self.draining = True
+        if not sum(self._transfers.values()):
+            return True
+
+        logger.info(f"Draining {self.in_flight()} within {timeout:.0f}s")
+        self._idle = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
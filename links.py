@@ -0,0 +1,85 @@
+import hmac
+import time
+import base64
+import struct
+import hashlib
+import binascii
+import calendar
+import datetime
+from typing import Any, Dict, NamedTuple, Optional
+from urllib.parse import quote
+from config import Config
+
+# version, BIN_CHANNEL message id, file size, expiry in epoch seconds (0 = never)
+_PAYLOAD = struct.Struct(">BIQI")
+TOKEN_VERSION = 1
+SIGNATURE_SIZE = 12
+# 29 bytes as unpadded base64url
+TOKEN_LENGTH = -(-(_PAYLOAD.size + SIGNATURE_SIZE) * 4 // 3)
+
+# Without LINK_SECRET the key is derived from the bot token, so every instance signs alike
+_SECRET = (Config.LINK_SECRET or hashlib.sha256(f"links:{Config.BOT_TOKEN}".encode()).hexdigest()).encode()
+
+class InvalidToken(Exception):
+    pass
+
+class TokenExpired(InvalidToken):
+    pass
+
+class LinkToken(NamedTuple):
+    message_id: int
+    file_size: int
+    expires: int
+
+def _signature(payload: bytes) -> bytes:
+    return hmac.new(_SECRET, payload, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+def sign(message_id: int, file_size: int, expires_at: Optional[datetime.datetime] = None) -> str:
+    expires = calendar.timegm(expires_at.utctimetuple()) if expires_at else 0
+    payload = _PAYLOAD.pack(TOKEN_VERSION, message_id, file_size, expires)
+    return base64.urlsafe_b64encode(payload + _signature(payload)).rstrip(b"=").decode()
+
+def verify(token: str) -> LinkToken:
+    """Check a token's signature and expiry; raises InvalidToken or TokenExpired"""
+    if len(token) != TOKEN_LENGTH:
+        raise InvalidToken()
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, binascii.Error):
+        raise InvalidToken()
+
+    payload, signature = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+    if not hmac.compare_digest(_signature(payload), signature):
+        raise InvalidToken()
+    version, message_id, file_size, expires = _PAYLOAD.unpack(payload)
+    if version != TOKEN_VERSION:
+        raise InvalidToken()
+    if expires and expires < time.time():
+        raise TokenExpired()
+    return LinkToken(message_id, file_size, expires)
+
+def internal_key(token: str) -> str:
+    return base64.urlsafe_b64encode(_signature(b"internal:" + token.encode())).rstrip(b"=").decode()
+
+def is_internal(token: str, key: Optional[str]) -> bool:
+    """Whether a request carries the key local_stream_url() adds, so it isn't counted as a view"""
+    return bool(key) and hmac.compare_digest(internal_key(token), key)
+
+def local_stream_url(token: str) -> Optional[str]:
+    """The same stream on this instance's own server, for ffmpeg to read by range"""
+    if not Config.PORT:
+        return None
+    host = "127.0.0.1" if Config.BIND_ADDRESS in ("", "0.0.0.0", "::") else Config.BIND_ADDRESS
+    return f"http://{host}:{Config.PORT}/stream/{token}?internal={internal_key(token)}"
+
+def build_links(record: Dict[str, Any]) -> Dict[str, str]:
+    """The share links of a file record, signed so the stream server needs no lookup to serve them"""
+    token = sign(record['bin_message_id'], record['file_size'], record.get('expires_at'))
+    links = {
+        'direct_link': f"{Config.DOWNLOAD_BASE_URL}/file/{token}?filename={quote(record['file_name'])}",
+        'stream_link': f"{Config.STREAM_BASE_URL}/stream/{token}",
+        'embed_link': f"{Config.STREAM_BASE_URL}/embed/{token}"
+    }
+    if Config.HLS_ENABLED and (record.get('mime_type') or "").startswith("video"):
+        links['hls_link'] = f"{Config.STREAM_BASE_URL}/stream/{token}/index.m3u8"
+    return links
@@ -0,0 +1,220 @@
+import os
+import re
+import json
+import time
+import shutil
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+import metrics
+from config import Config
+from disk_cache import TEMP_SUFFIX, DiskLRU
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects thumbnails larger than 320 px on either side
+THUMBNAIL_SIZE = 320
+THUMBNAIL_SUFFIX = ".jpg"
+# Content keys are SHA-256 digests or Telegram file_unique_ids
+_KEY = re.compile(r"^[A-Za-z0-9_-]{8,128}$")
+
+MEDIA_SECONDS = metrics.Histogram("bot_media_seconds", "Time spent in ffprobe/ffmpeg", ["step"])
+MEDIA_ERRORS = metrics.Counter("bot_media_errors_total", "Failed ffprobe/ffmpeg runs", ["step"])
+
+def cached_thumbnail(key: Optional[str]) -> Optional[str]:
+    """Path of the cached thumbnail for a content key, if there is one"""
+    if not key or not _KEY.match(key):
+        return None
+    path = os.path.join(Config.THUMBNAIL_CACHE_DIR, key + THUMBNAIL_SUFFIX)
+    return path if os.path.exists(path) else None
+
+def from_telegram(media) -> Dict[str, Any]:
+    """The metadata Telegram already sends along with the media, used when probing is not possible"""
+    info = {}
+    for field in ("duration", "width", "height"):
+        value = getattr(media, field, None)
+        if value:
+            info[field] = value
+    return info
+
+def is_probeable(media) -> bool:
+    mime_type = getattr(media, "mime_type", None) or ""
+    return mime_type.startswith(("video/", "audio/"))
+
+def describe(info: Optional[Dict[str, Any]]) -> str:
+    """One line like `1920x1080 • 1:02:03 • h264/aac` for the bot's messages"""
+    if not info:
+        return ""
+    parts = []
+    if info.get("width") and info.get("height"):
+        parts.append(f"{info['width']}x{info['height']}")
+    if info.get("duration"):
+        minutes, seconds = divmod(int(info["duration"]), 60)
+        hours, minutes = divmod(minutes, 60)
+        parts.append(f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}")
+    codecs = "/".join(c for c in (info.get("video_codec"), info.get("audio_codec")) if c)
+    if codecs:
+        parts.append(codecs)
+    return " • ".join(parts)
+
+async def run_ffmpeg(step: str, command: List[str], timeout: float) -> bytes:
+    """Run one ffmpeg/ffprobe command as an asyncio subprocess and return its stdout"""
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        *command, stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        # Timed out or cancelled: don't leave ffmpeg running
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        MEDIA_ERRORS.inc(step=step)
+        raise
+    finally:
+        MEDIA_SECONDS.observe(time.monotonic() - started, step=step)
+
+    if process.returncode:
+        MEDIA_ERRORS.inc(step=step)
+        raise RuntimeError(stderr.decode(errors="replace").strip()[-200:] or f"exit code {process.returncode}")
+    return stdout
+
+def _summarize(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Reduce `ffprobe -show_format -show_streams` JSON to what the bot keeps"""
+    info: Dict[str, Any] = {}
+    fmt = data.get("format", {})
+    if fmt.get("format_name"):
+        info["container"] = fmt["format_name"].split(",")[0]
+    if fmt.get("duration"):
+        info["duration"] = int(float(fmt["duration"]))
+    if fmt.get("bit_rate"):
+        info["bit_rate"] = int(fmt["bit_rate"])
+
+    for stream in data.get("streams", []):
+        kind = stream.get("codec_type")
+        if kind == "video" and stream.get("disposition", {}).get("attached_pic"):
+            # Cover art of audio files shows up as a one-frame video stream
+            info["cover_art"] = True
+        elif kind == "video" and "video_codec" not in info:
+            info["video_codec"] = stream.get("codec_name")
+            info["width"] = stream.get("width")
+            info["height"] = stream.get("height")
+        elif kind == "audio" and "audio_codec" not in info:
+            info["audio_codec"] = stream.get("codec_name")
+    return {k: v for k, v in info.items() if v is not None}
+
+class MediaProcessor:
+    """Extracts stream metadata and a thumbnail with ffprobe/ffmpeg.
+
+    At most `max_workers` ffmpeg processes run at once, each awaited as an asyncio
+    subprocess so the event loop never waits on them. Thumbnails are cached in
+    THUMBNAIL_CACHE_DIR under the file's content key, oldest evicted first once
+    THUMBNAIL_CACHE_SIZE is exceeded. Without ffmpeg on the PATH only the metadata
+    Telegram provides is returned.
+    """
+
+    def __init__(self, max_workers: int = Config.MEDIA_WORKERS, cache_dir: str = Config.THUMBNAIL_CACHE_DIR,
+                 cache_max_bytes: int = Config.THUMBNAIL_CACHE_SIZE):
+        self.max_workers = max_workers
+        self._cache = DiskLRU(cache_dir, cache_max_bytes)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._background: Set[asyncio.Task] = set()
+
+        metrics.Gauge("bot_thumbnail_cache_bytes", "Bytes held by the thumbnail cache",
+                      function=lambda: self._cache.bytes)
+
+    def start(self):
+        if self.max_workers <= 0:
+            return
+        if not (shutil.which("ffprobe") and shutil.which("ffmpeg")):
+            logger.warning("ffmpeg/ffprobe not found, media metadata falls back to what Telegram provides")
+            return
+        self._cache.load(lambda name: name.endswith(THUMBNAIL_SUFFIX))
+        self._slots = asyncio.Semaphore(self.max_workers)
+
+    async def stop(self):
+        # ffmpeg processes still running are killed when their callers are cancelled
+        tasks = list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._slots = None
+
+    def can_probe(self, media) -> bool:
+        return self._slots is not None and is_probeable(media)
+
+    def analyze_later(self, source: Optional[str], key: Optional[str], media,
+                      save: Callable[[Dict[str, Any]], Awaitable]):
+        """analyze() in the background, handing the result to `save`; for files already on record"""
+        if not source or not self.can_probe(media):
+            return
+        task = asyncio.create_task(self._analyze_later(source, key, media, save))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _analyze_later(self, source: str, key: Optional[str], media,
+                             save: Callable[[Dict[str, Any]], Awaitable]):
+        try:
+            info = await self.analyze(source, key, media)
+        except asyncio.CancelledError:
+            # Stopping: settle for Telegram's metadata rather than leave the record waiting
+            await save(from_telegram(media))
+            raise
+        try:
+            await save(info)
+        except Exception as e:
+            logger.warning(f"Saving the metadata of {key or source} failed: {e}")
+
+    async def analyze(self, source: Optional[str], key: Optional[str], media) -> Dict[str, Any]:
+        """Metadata of `media` read from `source` (a path or URL ffmpeg can open), plus a thumbnail.
+
+        Never raises: whatever ffprobe could not provide falls back to Telegram's metadata.
+        """
+        info = from_telegram(media)
+        if not self._slots or not source or not is_probeable(media):
+            return info
+
+        try:
+            output = await self._run("probe", [
+                "ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", source
+            ])
+            info.update(_summarize(json.loads(output)))
+        except Exception as e:
+            logger.warning(f"Probing {key or source} failed: {e}")
+            return info
+
+        if key and _KEY.match(key) and (info.get("video_codec") or info.get("cover_art")):
+            if cached_thumbnail(key):
+                info["thumbnail"] = key
+            else:
+                # A frame a little into the video is more telling than the usually black first one
+                seek = min(info.get("duration", 0) * 0.1, 60) if info.get("video_codec") else 0
+                path = self._cache.path(key + THUMBNAIL_SUFFIX)
+                try:
+                    await self._thumbnail(source, path, seek)
+                except Exception as e:
+                    logger.warning(f"Thumbnail of {key} failed: {e}")
+                else:
+                    self._cache.add(key + THUMBNAIL_SUFFIX)
+                    info["thumbnail"] = key
+        info.pop("cover_art", None)
+        return info
+
+    async def _thumbnail(self, source: str, path: str, seek: float):
+        scale = f"scale='if(gt(iw,ih),{THUMBNAIL_SIZE},-2)':'if(gt(iw,ih),-2,{THUMBNAIL_SIZE})'"
+        temp_path = path + TEMP_SUFFIX
+        try:
+            await self._run("thumbnail", [
+                "ffmpeg", "-v", "error", "-y", "-ss", str(seek), "-i", source,
+                "-map", "0:v:0", "-frames:v", "1", "-vf", scale, "-q:v", "5", "-f", "image2", temp_path
+            ])
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    async def _run(self, step: str, command: List[str]) -> bytes:
+        async with self._slots:
+            return await run_ffmpeg(step, command, Config.MEDIA_PROBE_TIMEOUT)
@@ -0,0 +1,176 @@
+import time
+import inspect
+import functools
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+# Prometheus text exposition format, kept dependency free
+_REGISTRY: Dict[str, "Metric"] = {}
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = tuple(2 ** n for n in range(16, 31, 2))  # 64 KB/s .. 1 GB/s
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _REGISTRY[name] = self
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values, extra)} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        return [("", self.labels, key, "", value) for key, value in self.values.items()]
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 function: Optional[Callable] = None):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+        # Read at scrape time: returns a number, or {label value: number} for a single label
+        self.function = function
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is None:
+            return [("", self.labels, key, "", value) for key, value in self.values.items()]
+        result = self.function()
+        if isinstance(result, dict):
+            return [("", self.labels, (key,), "", value) for key, value in result.items()]
+        return [("", (), (), "", result)]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["buckets"][i] += 1
+        series["count"] += 1
+        series["sum"] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def get(self, **labels) -> Dict:
+        return self.series.get(self._key(labels), {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0})
+
+    def samples(self):
+        samples = []
+        for key, series in self.series.items():
+            for bound, count in zip(self.buckets, series["buckets"]):
+                samples.append(("_bucket", self.labels, key, f'le="{bound}"', count))
+            samples.append(("_bucket", self.labels, key, 'le="+Inf"', series["count"]))
+            samples.append(("_count", self.labels, key, "", series["count"]))
+            samples.append(("_sum", self.labels, key, "", series["sum"]))
+        return samples
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _REGISTRY.values()) + "\n"
+
+# Shared metrics
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time spent in each Pyrogram handler", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Unhandled exceptions per Pyrogram handler", ["handler"])
+UPLOAD_STAGE_SECONDS = Histogram("bot_upload_stage_seconds", "Latency of each file_handler stage", ["stage"])
+UPLOAD_PATH_SECONDS = Histogram("bot_upload_path_seconds", "Time to store a file per storage path", ["path"])
+UPLOAD_PATH_ERRORS = Counter("bot_upload_path_errors_total", "Failed attempts per storage path", ["path"])
+TRANSFER_BYTES = Counter("bot_transfer_bytes_total", "Bytes moved through the bot", ["direction"])
+TRANSFER_RATE = Histogram("bot_transfer_bytes_per_second", "Throughput of finished transfers",
+                          ["direction"], buckets=RATE_BUCKETS)
+MONGO_SECONDS = Histogram("bot_mongo_call_seconds", "Latency of each Database method", ["method"])
+MONGO_ERRORS = Counter("bot_mongo_errors_total", "Exceptions raised by each Database method", ["method"])
+FLOOD_WAITS = Counter("bot_flood_waits_total", "FloodWait errors received", ["site"])
+FLOOD_WAIT_SECONDS = Counter("bot_flood_wait_seconds_total", "Seconds Telegram asked us to wait", ["site"])
+
+def record_flood_wait(site: str, seconds: float):
+    FLOOD_WAITS.inc(site=site)
+    FLOOD_WAIT_SECONDS.inc(seconds, site=site)
+
+def record_transfer(direction: str, size: int, seconds: float):
+    TRANSFER_BYTES.inc(size, direction=direction)
+    if seconds > 0:
+        TRANSFER_RATE.observe(size / seconds, direction=direction)
+
+def track_handler(func):
+    """Time a Pyrogram handler; put it below the @app.on_* decorator"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with HANDLER_SECONDS.time(handler=func.__name__):
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=func.__name__)
+                raise
+    return wrapper
+
+def _track_mongo(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with MONGO_SECONDS.time(method=func.__name__):
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                MONGO_ERRORS.inc(method=func.__name__)
+                raise
+    return wrapper
+
+def instrument_database(cls):
+    """Class decorator timing every public coroutine method of Database"""
+    for name, attr in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(attr):
+            setattr(cls, name, _track_mongo(attr))
+    return cls
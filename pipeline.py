@@ -0,0 +1,124 @@
+import shutil
+import asyncio
+import logging
+import itertools
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class UploadTicket:
+    def __init__(self, user_id: int, premium: bool, seq: int):
+        self.user_id = user_id
+        # Premium uploads always sort ahead of free ones, FIFO within each lane
+        self.key = (0 if premium else 1, seq)
+        self.admitted = asyncio.get_event_loop().create_future()
+
+class UploadQueue:
+    """Admission control for file_handler: a global cap, a per-user cap and a disk budget for downloads/"""
+
+    def __init__(self, max_active: int, max_per_user: int, disk_budget: int, download_dir: str = "downloads"):
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.disk_budget = disk_budget
+        self.download_dir = download_dir
+        self.active = 0
+        self.disk_reserved = 0
+        self._per_user = defaultdict(int)
+        self._waiting = []
+        self._seq = itertools.count()
+        self._disk_condition = None
+        metrics.Gauge("bot_upload_queue_active", "Uploads holding a slot", function=lambda: self.active)
+        metrics.Gauge("bot_upload_queue_waiting", "Uploads waiting for a slot", function=lambda: len(self._waiting))
+        metrics.Gauge("bot_upload_disk_reserved_bytes", "downloads/ bytes reserved by the re-upload path",
+                      function=lambda: self.disk_reserved)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'active': self.active,
+            'waiting': len(self._waiting),
+            'disk_reserved': self.disk_reserved
+        }
+
+    def position(self, ticket: UploadTicket) -> int:
+        return self._waiting.index(ticket) + 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, premium: bool,
+                   on_wait: Optional[Callable[[int], Awaitable[Any]]] = None):
+        """Wait for an upload slot, calling `on_wait(position)` whenever the queue position changes"""
+        ticket = UploadTicket(user_id, premium, next(self._seq))
+        self._waiting.append(ticket)
+        self._waiting.sort(key=lambda t: t.key)
+        self._dispatch()
+
+        try:
+            last_position = None
+            while not ticket.admitted.done():
+                position = self.position(ticket)
+                if on_wait and position != last_position:
+                    last_position = position
+                    try:
+                        await on_wait(position)
+                    except Exception as e:
+                        logger.debug(f"Queue position update failed: {e}")
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.admitted), Config.QUEUE_UPDATE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if ticket.admitted.done():
+                self._release(ticket)
+            else:
+                self._waiting.remove(ticket)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def _dispatch(self):
+        for ticket in list(self._waiting):
+            if self.active >= self.max_active:
+                break
+            # A user at their cap doesn't hold up anyone behind them
+            if self._per_user[ticket.user_id] >= self.max_per_user:
+                continue
+            self._waiting.remove(ticket)
+            self.active += 1
+            self._per_user[ticket.user_id] += 1
+            ticket.admitted.set_result(True)
+
+    def _release(self, ticket: UploadTicket):
+        self.active -= 1
+        self._per_user[ticket.user_id] -= 1
+        if not self._per_user[ticket.user_id]:
+            del self._per_user[ticket.user_id]
+        self._dispatch()
+
+    def _disk_available(self) -> int:
+        free = shutil.disk_usage(self.download_dir).free + self.disk_reserved
+        return min(self.disk_budget, free)
+
+    @asynccontextmanager
+    async def disk(self, size: int):
+        """Reserve `size` bytes of the downloads/ budget, a file larger than the budget runs alone"""
+        if self._disk_condition is None:
+            self._disk_condition = asyncio.Condition()
+
+        async with self._disk_condition:
+            await self._disk_condition.wait_for(
+                lambda: self.disk_reserved == 0 or self.disk_reserved + size <= self._disk_available()
+            )
+            self.disk_reserved += size
+
+        try:
+            yield
+        finally:
+            async with self._disk_condition:
+                self.disk_reserved -= size
+                self._disk_condition.notify_all()
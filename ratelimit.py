@@ -0,0 +1,165 @@
+import time
+import asyncio
+import logging
+import itertools
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Set
+from pyrogram.errors import FloodWait
+import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Allows `rate` calls per second with bursts up to `capacity`, and can be paused for a FloodWait"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        # The lock hands out tokens in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Lower goes first when calls compete for the global rate
+PRIORITIES = {"reply": 0, "storage": 1, "progress": 2, "log": 3, "cleanup": 4, "broadcast": 5}
+# Per-chat buckets kept; the least recently used are dropped
+CHAT_BUCKETS = 10000
+
+WAIT_SECONDS = metrics.Histogram("bot_outbound_wait_seconds", "Time outbound calls waited for their turn", ["kind"])
+DROPPED = metrics.Counter("bot_outbound_dropped_total", "Background calls dropped with the backlog full", ["kind"])
+
+class OutboundScheduler:
+    """Paces the messages the bot sends to Telegram.
+
+    Every call takes a token from its chat's bucket (OUTBOUND_CHAT_RATE for users,
+    OUTBOUND_GROUP_RATE for groups and channels) and then one from the global
+    OUTBOUND_RATE bucket, which is handed out by call kind in PRIORITIES order, so a
+    broadcast never gets ahead of user replies. A FloodWait pauses only the kind of
+    call that got it; the call is retried if the wait is at most `max_wait` seconds.
+    """
+
+    def __init__(self, rate: float = Config.OUTBOUND_RATE):
+        self.bucket = TokenBucket(rate)
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._paused_until: Dict[str, float] = {}
+        self._waiting = Counter()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._sequence = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+
+        metrics.Gauge("bot_outbound_queue_depth", "Outbound calls waiting for their turn", ["kind"],
+                      function=lambda: dict(self._waiting))
+
+    async def stop(self):
+        tasks = list(self._background)
+        if self._dispatcher:
+            tasks.append(self._dispatcher)
+            self._dispatcher = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def pause(self, kind: str, seconds: float):
+        self._paused_until[kind] = max(self._paused_until.get(kind, 0.0), time.monotonic() + seconds)
+
+    async def call(self, kind: str, chat_id: Optional[int], func: Callable[..., Awaitable], /, *args,
+                   max_wait: Optional[float] = Config.OUTBOUND_MAX_FLOOD_WAIT, **kwargs):
+        """Run `func(*args, **kwargs)` once it's the call's turn; `chat_id` None skips the per-chat limit.
+
+        FloodWaits longer than `max_wait` seconds are raised, `max_wait` None retries them all.
+        """
+        while True:
+            started = time.monotonic()
+            self._waiting[kind] += 1
+            try:
+                await self._resume(kind)
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self._turn(kind)
+            finally:
+                self._waiting[kind] -= 1
+            WAIT_SECONDS.observe(time.monotonic() - started, kind=kind)
+
+            try:
+                return await func(*args, **kwargs)
+            except FloodWait as e:
+                metrics.record_flood_wait(kind, e.value)
+                self.pause(kind, e.value)
+                if max_wait is not None and e.value > max_wait:
+                    raise
+
+    def submit(self, kind: str, chat_id: Optional[int], func: Callable[..., Awaitable], /, *args, **kwargs):
+        """Like call(), in the background: for messages nobody waits on, such as LOG_CHANNEL entries"""
+        if len(self._background) >= Config.OUTBOUND_MAX_BACKGROUND:
+            DROPPED.inc(kind=kind)
+            return
+        task = asyncio.create_task(self._run_background(kind, chat_id, func, *args, **kwargs))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _run_background(self, kind: str, chat_id: Optional[int], func: Callable[..., Awaitable], /,
+                              *args, **kwargs):
+        try:
+            await self.call(kind, chat_id, func, *args, max_wait=None, **kwargs)
+        except Exception as e:
+            logger.debug(f"Background {kind} call failed: {e}")
+
+    async def _resume(self, kind: str):
+        while True:
+            delay = self._paused_until.get(kind, 0.0) - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id > 0:
+                bucket = TokenBucket(Config.OUTBOUND_CHAT_RATE, Config.OUTBOUND_CHAT_BURST)
+            else:
+                bucket = TokenBucket(Config.OUTBOUND_GROUP_RATE, Config.OUTBOUND_CHAT_BURST)
+            self._chats[chat_id] = bucket
+            while len(self._chats) > CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _turn(self, kind: str):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        turn = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((PRIORITIES[kind], next(self._sequence), turn))
+        await turn
+
+    async def _dispatch(self):
+        while True:
+            _, _, turn = await self._queue.get()
+            if turn.done():
+                # The caller gave up waiting
+                continue
+            await self.bucket.acquire()
+            if not turn.done():
+                turn.set_result(None)
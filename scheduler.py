@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from typing import List
+from config import Config
+from database import Database
+from storage import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+class ExpiryScheduler:
+    """One loop that deletes expired files, with the deadlines kept in Mongo (files.expires_at).
+
+    Runs on the cluster leader only; the claim lease still guards a handover mid-sweep.
+    """
+
+    def __init__(self, db: Database, backends: List[StorageBackend]):
+        self.db = db
+        self.backends = backends
+        self._task = None
+
+    def start(self):
+        if Config.AUTO_DELETE_TIME > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                deleted = await self.run_once()
+            except Exception as e:
+                logger.error(f"Expiry sweep failed: {e}")
+                deleted = 0
+            # A full batch means there is a backlog, keep going without sleeping
+            if deleted < Config.EXPIRY_BATCH_SIZE:
+                await asyncio.sleep(Config.EXPIRY_INTERVAL)
+
+    async def run_once(self) -> int:
+        due = await self.db.claim_expired_files(Config.EXPIRY_BATCH_SIZE)
+        if not due:
+            return 0
+
+        keys = [f['bin_message_id'] for f in due]
+        for backend in self.backends:
+            await backend.delete(keys)
+        await self.db.delete_files([f['_id'] for f in due])
+        logger.info(f"Auto-deleted {len(due)} expired file(s)")
+        return len(due)
+
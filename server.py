@@ -0,0 +1,404 @@
+import html
+import time
+import logging
+import datetime
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import quote
+from aiohttp import web
+import links
+import metrics
+from hls import (COPY_MODES, SEGMENT_NAME, HlsSegmenter, SegmentNotFound, build_playlist, fixed_bounds,
+                 keyframe_bounds, reencode_mode, remux_mode)
+from mediainfo import cached_thumbnail
+from config import Config
+from database import Database
+from lifecycle import Lifecycle
+from storage import STORAGE_READS, LocalStorage, StoredObject, TelegramStorage, get_media
+
+logger = logging.getLogger(__name__)
+
+# Files whose reads are counted for promotion to local storage
+HOT_TRACKED_FILES = 10000
+# A media probe that started longer ago than this died with its process
+PROBE_STALE_AFTER = datetime.timedelta(minutes=10)
+# media_info of files being watched over HLS, so segment requests don't each query the database
+HLS_MEDIA_CACHE_SIZE = 1024
+HLS_MEDIA_CACHE_TTL = 300
+
+EMBED_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<style>html,body{{margin:0;height:100%;background:#000}}{tag}{{width:100%;height:100%}}</style>
+</head>
+<body>
+<{tag} src="{src}"{attributes} controls preload="metadata"></{tag}>
+</body>
+</html>"""
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+class LocalFileResponse(web.FileResponse):
+    """A FileResponse that counts as an in-flight stream while sendfile runs.
+
+    aiohttp prepares it after the handler returned, so the tracking can't wrap the handler.
+    """
+
+    def __init__(self, path: str, lifecycle: Lifecycle, **kwargs):
+        super().__init__(path, **kwargs)
+        self.lifecycle = lifecycle
+
+    async def prepare(self, request: web.BaseRequest):
+        started = time.monotonic()
+        try:
+            async with self.lifecycle.transfer("stream"):
+                return await super().prepare(request)
+        finally:
+            if request.method != "HEAD":
+                metrics.record_transfer("stream", self.content_length or 0, time.monotonic() - started)
+
+def parse_range(header: Optional[str], file_size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single `bytes=` range into an inclusive (start, end) pair, None means the whole file"""
+    if not header:
+        return None
+
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        raise RangeNotSatisfiable()
+
+    start_text, _, end_text = spec.strip().partition("-")
+    try:
+        if not start_text:
+            # Suffix range: the last N bytes
+            length = int(end_text)
+            if length <= 0:
+                raise RangeNotSatisfiable()
+            start, end = max(file_size - length, 0), file_size - 1
+        else:
+            start = int(start_text)
+            end = int(end_text) if end_text else file_size - 1
+    except ValueError:
+        raise RangeNotSatisfiable()
+
+    end = min(end, file_size - 1)
+    if start < 0 or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+class StreamServer:
+    def __init__(self, storage: TelegramStorage, local: Optional[LocalStorage], db: Database, lifecycle: Lifecycle):
+        self.storage = storage
+        self.local = local
+        self.pool = storage.pool
+        self.db = db
+        self.lifecycle = lifecycle
+        self._reads = OrderedDict()
+        self._hls_media = OrderedDict()
+        self.runner = None
+        self.app = web.Application(middlewares=[self.readiness])
+        self.app.add_routes([
+            web.get("/health", self.health),
+            web.get("/metrics", self.export_metrics),
+            web.get("/file/{token}", self.download),
+            web.get("/stream/{token}", self.stream),
+            web.get("/embed/{token}", self.embed),
+            web.get("/thumb/{key}", self.thumbnail),
+        ])
+        self.hls = None
+        if Config.HLS_ENABLED:
+            self.hls = HlsSegmenter()
+            self.app.add_routes([
+                web.get("/stream/{token}/index.m3u8", self.hls_playlist),
+                web.get("/stream/{token}/{segment}", self.hls_segment),
+            ])
+
+    async def start(self):
+        if self.hls:
+            self.hls.start()
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        # Transfers already had SHUTDOWN_TIMEOUT to drain by the time the site stops
+        site = web.TCPSite(self.runner, Config.BIND_ADDRESS, Config.PORT, shutdown_timeout=1.0)
+        await site.start()
+        logger.info(f"Stream server listening on {Config.BIND_ADDRESS}:{Config.PORT}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+        if self.hls:
+            await self.hls.stop()
+
+    @web.middleware
+    async def readiness(self, request: web.Request, handler):
+        # Until the clients are up only the probes answer; a draining server keeps serving
+        if self.lifecycle.status == "starting" and request.path not in ("/health", "/metrics"):
+            raise web.HTTPServiceUnavailable(text="Starting up", headers={"Retry-After": "5"})
+        return await handler(request)
+
+    # Routes
+    async def health(self, request: web.Request):
+        # 503 while starting or draining, so a load balancer only routes to ready instances
+        return web.json_response({
+            "status": self.lifecycle.status,
+            "transfers": self.lifecycle.in_flight(),
+            "in_flight": self.pool.in_flight()
+        }, status=200 if self.lifecycle.ready else 503)
+
+    async def export_metrics(self, request: web.Request):
+        return web.Response(
+            body=metrics.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    async def download(self, request: web.Request):
+        return await self.serve_file(request, attachment=True)
+
+    async def stream(self, request: web.Request):
+        return await self.serve_file(request, attachment=False)
+
+    async def embed(self, request: web.Request):
+        token = request.match_info["token"]
+        link = await self.resolve(token)
+        media = await self.get_linked_media(link)
+
+        # One lookup per page view for what the upload probed; the streams themselves stay stateless
+        file_data = await self.db.get_file_by_message(link.message_id) or {}
+        media_info = file_data.get("media_info") or {}
+        attributes = ""
+        if cached_thumbnail(media_info.get("thumbnail")):
+            attributes += f' poster="/thumb/{media_info["thumbnail"]}"'
+        if media_info.get("width") and media_info.get("height"):
+            attributes += f' width="{media_info["width"]}" height="{media_info["height"]}"'
+
+        mime_type = getattr(media, "mime_type", None) or ""
+        page = EMBED_TEMPLATE.format(
+            title=html.escape(getattr(media, "file_name", None) or f"file_{link.message_id}"),
+            tag="audio" if mime_type.startswith("audio") else "video",
+            src=f"/stream/{quote(token)}",
+            attributes=attributes
+        )
+        return web.Response(text=page, content_type="text/html")
+
+    async def thumbnail(self, request: web.Request):
+        path = cached_thumbnail(request.match_info["key"])
+        if not path:
+            raise web.HTTPNotFound(text="Thumbnail not found")
+        # Keyed by content, so a thumbnail never changes
+        return web.FileResponse(path, headers={"Cache-Control": "public, max-age=86400, immutable"})
+
+    # HLS
+    async def hls_media(self, link: links.LinkToken, token: str) -> Tuple[str, float, Dict[str, Any]]:
+        """The stream URL ffmpeg reads, the duration and the media_info of a linked video"""
+        source = links.local_stream_url(token)
+        if not source:
+            raise web.HTTPNotFound(text="HLS is not available")
+        media = await self.get_linked_media(link)
+        if not (getattr(media, "mime_type", None) or "").startswith("video/"):
+            raise web.HTTPNotFound(text="HLS is only available for videos")
+        media_info = await self.get_media_info(link.message_id)
+
+        duration = media_info.get("duration") or getattr(media, "duration", None)
+        if not duration:
+            # Documents without a probed duration can't be split into a playlist
+            raise web.HTTPNotFound(text="HLS is not available for this file")
+        return source, duration, media_info
+
+    async def get_media_info(self, message_id: int) -> Dict[str, Any]:
+        cached = self._hls_media.get(message_id)
+        if cached and cached[1] > time.monotonic():
+            self._hls_media.move_to_end(message_id)
+            return cached[0]
+
+        file_data = await self.db.get_file_by_message(message_id) or {}
+        media_info = file_data.get("media_info") or {}
+        probing = media_info.get("probing")
+        if probing and probing > datetime.datetime.utcnow() - PROBE_STALE_AFTER:
+            # The segment mode depends on the codecs, a playlist handed out now could go stale
+            raise web.HTTPServiceUnavailable(text="The file is still being analyzed", headers={"Retry-After": "5"})
+        self._hls_media[message_id] = (media_info, time.monotonic() + HLS_MEDIA_CACHE_TTL)
+        self._hls_media.move_to_end(message_id)
+        while len(self._hls_media) > HLS_MEDIA_CACHE_SIZE:
+            self._hls_media.popitem(last=False)
+        return media_info
+
+    def hls_bounds(self, message_id: int, source: str, duration: float, media_info: Dict[str, Any],
+                   mode: str) -> Optional[List[float]]:
+        """Segment start times in `mode`, or None for a mode no playlist of this file lists"""
+        if mode == remux_mode(media_info) and mode in COPY_MODES:
+            keyframes = self.hls.keyframes(message_id, source)
+            if keyframes is None:
+                raise web.HTTPServiceUnavailable(text="The video is still being indexed", headers={"Retry-After": "5"})
+            return keyframe_bounds(keyframes)
+        if mode in (remux_mode(media_info), reencode_mode(media_info)):
+            return fixed_bounds(duration)
+        return None
+
+    async def hls_playlist(self, request: web.Request):
+        token = request.match_info["token"]
+        link = await self.resolve(token)
+        source, duration, media_info = await self.hls_media(link, token)
+        mode = remux_mode(media_info)
+        if mode in COPY_MODES and self.hls.keyframes(link.message_id, source) is None:
+            # A copied video can only be cut at its keyframes; until they are scanned it is re-encoded
+            mode = reencode_mode(media_info)
+        bounds = self.hls_bounds(link.message_id, source, duration, media_info, mode)
+        # The segments are cut from internal reads, so the playlist is what counts as a view
+        await self.db.increment_access_count(link.message_id)
+        return web.Response(
+            text=build_playlist(bounds, duration, mode),
+            content_type="application/vnd.apple.mpegurl",
+            headers={"Cache-Control": "public, max-age=3600"}
+        )
+
+    async def hls_segment(self, request: web.Request):
+        match = SEGMENT_NAME.match(request.match_info["segment"])
+        if not match:
+            raise web.HTTPNotFound()
+        token = request.match_info["token"]
+        link = await self.resolve(token)
+        source, duration, media_info = await self.hls_media(link, token)
+        # Only what a playlist lists, anything else would have ffmpeg cut segments nobody asked for
+        mode, index = match.group(1), int(match.group(2))
+        bounds = self.hls_bounds(link.message_id, source, duration, media_info, mode)
+        if bounds is None or index >= len(bounds):
+            raise web.HTTPNotFound(text="Segment not found")
+
+        try:
+            path = await self.hls.segment(link.message_id, source, mode, bounds, duration, index)
+        except SegmentNotFound:
+            raise web.HTTPNotFound(text="Segment not found")
+        except Exception as e:
+            logger.error(f"Cutting HLS segment {match.group(0)} of message {link.message_id} failed: {e}")
+            raise web.HTTPBadGateway(text="Could not prepare the segment")
+        # Segments never change for a token, so a CDN can keep them
+        return web.FileResponse(path, headers={
+            "Content-Type": "video/mp2t",
+            "Cache-Control": "public, max-age=86400, immutable"
+        })
+
+    # Link resolution
+    async def resolve(self, token: str) -> links.LinkToken:
+        """Verify a signed link without touching the database; only legacy file_id links are looked up"""
+        try:
+            return links.verify(token)
+        except links.TokenExpired:
+            raise web.HTTPGone(text="This link has expired")
+        except links.InvalidToken:
+            if len(token) == links.TOKEN_LENGTH:
+                raise web.HTTPNotFound(text="File not found")
+
+        # Links handed out before signing was introduced carry the Telegram file_id
+        file_data = await self.db.get_file_by_id(token)
+        if not file_data:
+            raise web.HTTPNotFound(text="File not found")
+        return links.LinkToken(file_data["bin_message_id"], file_data["file_size"], 0)
+
+    async def get_linked_media(self, link: links.LinkToken):
+        message = await self.pool.get_message(link.message_id)
+        media = get_media(message) if message and not message.empty else None
+        # A size mismatch means the BIN_CHANNEL message is gone and its id was reused
+        if not media or media.file_size != link.file_size:
+            raise web.HTTPGone(text="File is no longer available")
+        return media
+
+    # Streaming
+    async def serve_file(self, request: web.Request, attachment: bool):
+        token = request.match_info["token"]
+        link = await self.resolve(token)
+        message_id = link.message_id
+        # ffprobe and the HLS segmenter reading through this server aren't views
+        counted = not links.is_internal(token, request.query.get("internal"))
+        try:
+            # Checked against BIN_CHANNEL even for local copies, so deleted files stop being served
+            media = await self.get_linked_media(link)
+        except web.HTTPGone:
+            if self.local:
+                await self.local.delete([message_id])
+            raise
+
+        file_size = media.file_size
+        file_name = request.query.get("filename") or getattr(media, "file_name", None) or f"file_{message_id}"
+        disposition = "attachment" if attachment else "inline"
+        headers = {
+            "Content-Type": getattr(media, "mime_type", None) or "application/octet-stream",
+            "Content-Disposition": f"{disposition}; filename*=UTF-8''{quote(file_name)}"
+        }
+
+        if self.local:
+            response = await self.serve_local(request, message_id, file_size, headers, counted)
+            if response is not None:
+                return response
+
+        try:
+            byte_range = parse_range(request.headers.get("Range"), file_size)
+        except RangeNotSatisfiable:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{file_size}"})
+
+        start, end = byte_range or (0, file_size - 1)
+        response = web.StreamResponse(status=206 if byte_range else 200, headers=headers)
+        response.headers["Content-Length"] = str(end - start + 1)
+        response.headers["Accept-Ranges"] = "bytes"
+        if byte_range:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+
+        if counted:
+            await self.db.increment_access_count(message_id)
+            if self.local and start == 0:
+                self.count_read(message_id, media)
+        started = time.monotonic()
+        sent = 0
+        try:
+            async with self.lifecycle.transfer("stream"):
+                async for chunk in self.storage.get_range(message_id, start, end, file_size):
+                    await response.write(chunk)
+                    sent += len(chunk)
+        except (ConnectionResetError, ConnectionError):
+            # Players drop connections all the time while seeking
+            logger.debug(f"Client disconnected while streaming message {message_id}")
+            return response
+        finally:
+            metrics.record_transfer("stream", sent, time.monotonic() - started)
+
+        await response.write_eof()
+        return response
+
+    async def serve_local(self, request: web.Request, message_id: int, file_size: int,
+                          headers: dict, counted: bool = True) -> Optional[web.StreamResponse]:
+        """The local copy as a sendfile response, or None when there is none"""
+        stored = await self.local.stat(message_id)
+        if not stored:
+            return None
+        if stored.size != file_size:
+            await self.local.delete([message_id])
+            return None
+
+        if request.method != "HEAD":
+            STORAGE_READS.inc(backend=self.local.name)
+            if counted:
+                await self.db.increment_access_count(message_id)
+        # FileResponse answers Range and HEAD requests itself
+        return LocalFileResponse(stored.ref, self.lifecycle, headers=headers)
+
+    def count_read(self, message_id: int, media):
+        """Copy a file to local storage once it was read from the start LOCAL_STORAGE_HOT_REQUESTS times"""
+        if not self.local.accepts(media.file_size):
+            return
+        reads = self._reads.pop(message_id, 0) + 1
+        if reads < Config.LOCAL_STORAGE_HOT_REQUESTS:
+            self._reads[message_id] = reads
+            while len(self._reads) > HOT_TRACKED_FILES:
+                self._reads.popitem(last=False)
+            return
+        self.local.promote(StoredObject(
+            message_id, media.file_size,
+            getattr(media, "mime_type", None) or "application/octet-stream",
+            getattr(media, "file_name", None) or f"file_{message_id}"
+        ), self.storage)
@@ -0,0 +1,35 @@
+import asyncio
+import logging
+from database import Database
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class StatsReconciler:
+    """Periodically recounts the incrementally maintained /stats totals from the collections"""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        # Runs right away on the new leader, which also backfills counters that never existed
+        while True:
+            try:
+                totals = await self.db.reconcile_stats()
+                logger.info(f"Reconciled stats: {totals}")
+            except Exception as e:
+                logger.error(f"Stats reconcile failed: {e}")
+            await asyncio.sleep(Config.STATS_RECONCILE_INTERVAL)
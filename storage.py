@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional
+from pyrogram import Client, enums
+from pyrogram.types import Message
+import metrics
+from chunk_cache import CHUNK_SIZE
+from client_pool import ClientPool
+from config import Config
+from disk_cache import TEMP_SUFFIX, DiskLRU
+from ratelimit import OutboundScheduler
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts at most 100 message IDs per delete_messages call
+DELETE_CHUNK = 100
+
+STORAGE_READS = metrics.Counter("bot_storage_reads_total", "Ranges served per storage backend", ["backend"])
+PROMOTIONS = metrics.Counter("bot_storage_promotions_total", "Files copied to local storage", ["outcome"])
+
+class StoredObject(NamedTuple):
+    key: int  # BIN_CHANNEL message id, the key file records and links carry
+    size: int
+    mime_type: str
+    file_name: str
+    ref: Optional[str] = None  # Telegram file_id, or the path of a local copy
+
+def get_media(message: Message):
+    return message.document or message.video or message.audio or message.photo
+
+class StorageBackend(ABC):
+    """Where the bytes of stored files live.
+
+    Objects are addressed by their BIN_CHANNEL message id, so every backend can hold a
+    copy of the same file and the links stay the same whichever one serves it.
+    """
+
+    name = ""
+
+    @abstractmethod
+    async def put(self, path: str, key: Optional[int] = None, file_name: Optional[str] = None,
+                  mime_type: Optional[str] = None, move: bool = False, **options) -> StoredObject:
+        """Store a local file under `key`, or a new key when it is None; `move` consumes the file.
+
+        `options` are backend specific.
+        """
+
+    @abstractmethod
+    def get_range(self, key: int, start: int, end: int, size: int) -> AsyncIterator[bytes]:
+        """Yield the bytes of [start, end] of an object of `size` bytes"""
+
+    @abstractmethod
+    async def stat(self, key: int) -> Optional[StoredObject]:
+        """The object stored under `key`, None if this backend doesn't have it"""
+
+    @abstractmethod
+    async def delete(self, keys: List[int]):
+        """Remove the objects, keys this backend doesn't have are ignored"""
+
+class TelegramStorage(StorageBackend):
+    """BIN_CHANNEL: every file lives here, reads go through the client pool and its chunk cache.
+
+    Writes are "storage" calls of the outbound scheduler. They skip the per-chat limit,
+    which would cap uploads at 20 a minute; FloodWaits pace them instead. Deletes are
+    "cleanup" calls, so a FloodWait during an expiry sweep doesn't hold up uploads.
+    """
+
+    name = "telegram"
+
+    def __init__(self, client: Client, pool: ClientPool, outbound: OutboundScheduler):
+        self.client = client
+        self.pool = pool
+        self.outbound = outbound
+
+    async def put(self, path: str, key: Optional[int] = None, file_name: Optional[str] = None,
+                  mime_type: Optional[str] = None, move: bool = False, kind: str = "document",
+                  caption: str = "", thumb: Optional[str] = None,
+                  media_info: Optional[Dict[str, Any]] = None) -> StoredObject:
+        """Upload a local file as a `kind` (video, audio, document or photo) message.
+
+        The new message id is the key, so none can be given; Telegram detects the mime type itself.
+        """
+        if key is not None:
+            raise ValueError("Telegram assigns the key of an upload")
+        media_info = media_info or {}
+        common = dict(chat_id=Config.BIN_CHANNEL, caption=caption, parse_mode=enums.ParseMode.HTML)
+        if kind == "video":
+            send = self.client.send_video
+            options = dict(video=path, file_name=file_name, thumb=thumb,
+                           duration=media_info.get('duration', 0),
+                           width=media_info.get('width', 0),
+                           height=media_info.get('height', 0))
+        elif kind == "audio":
+            send = self.client.send_audio
+            options = dict(audio=path, file_name=file_name, thumb=thumb,
+                           duration=media_info.get('duration', 0))
+        elif kind == "document":
+            send = self.client.send_document
+            options = dict(document=path, file_name=file_name, thumb=thumb)
+        else:
+            send = self.client.send_photo
+            options = dict(photo=path)
+        message = await self.outbound.call("storage", None, send, **options, **common)
+        if move:
+            os.remove(path)
+        return self._object(message)
+
+    async def copy(self, message: Message, caption: str) -> StoredObject:
+        # Telegram copies the media by reference, no bytes go through the bot
+        bin_message = await self.outbound.call(
+            "storage", None, message.copy,
+            chat_id=Config.BIN_CHANNEL,
+            caption=caption,
+            parse_mode=enums.ParseMode.HTML
+        )
+        return self._object(bin_message)
+
+    async def get_range(self, key: int, start: int, end: int, size: int) -> AsyncIterator[bytes]:
+        first_chunk = start // CHUNK_SIZE
+        last_chunk = end // CHUNK_SIZE
+        first_cut = start % CHUNK_SIZE
+        last_cut = end % CHUNK_SIZE + 1
+        chunk_count = last_chunk - first_chunk + 1
+
+        index = 0
+        STORAGE_READS.inc(backend=self.name)
+        async for chunk in self.pool.iter_chunks(key, first_chunk, chunk_count, size):
+            if chunk_count == 1:
+                chunk = chunk[first_cut:last_cut]
+            elif index == 0:
+                chunk = chunk[first_cut:]
+            elif index == chunk_count - 1:
+                chunk = chunk[:last_cut]
+            yield chunk
+            index += 1
+
+    async def stat(self, key: int) -> Optional[StoredObject]:
+        message = await self.pool.get_message(key)
+        if not message or message.empty or not get_media(message):
+            return None
+        return self._object(message)
+
+    async def delete(self, keys: List[int]):
+        for i in range(0, len(keys), DELETE_CHUNK):
+            await self.outbound.call(
+                "cleanup", None, self.client.delete_messages, Config.BIN_CHANNEL, keys[i:i + DELETE_CHUNK],
+                max_wait=None
+            )
+
+    @staticmethod
+    def _object(message: Message) -> StoredObject:
+        media = get_media(message)
+        return StoredObject(
+            key=message.id,
+            size=media.file_size,
+            mime_type=getattr(media, "mime_type", None) or "application/octet-stream",
+            file_name=getattr(media, "file_name", None) or f"file_{message.id}",
+            ref=media.file_id
+        )
+
+class LocalStorage(StorageBackend):
+    """Copies of small or hot files on local disk, served with sendfile by the stream server.
+
+    Each object is `<key>` plus a `<key>.json` with its metadata. The least recently read
+    ones are evicted past `max_bytes`; Telegram keeps the original, so eviction loses nothing.
+    """
+
+    name = "local"
+
+    def __init__(self, root: str = Config.LOCAL_STORAGE_DIR, max_bytes: int = Config.LOCAL_STORAGE_SIZE):
+        self.max_bytes = max_bytes
+        self._files = DiskLRU(root, max_bytes, on_evict=self._forget)
+        self._objects: Dict[int, StoredObject] = {}
+        self._promoting: Dict[int, asyncio.Task] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+
+        metrics.Gauge("bot_local_storage_bytes", "Bytes held by local storage", function=lambda: self._files.bytes)
+
+    def start(self):
+        # The access time is when an object was last read, see stat()
+        self._files.load(self._load_object, by_access=True)
+        self._slots = asyncio.Semaphore(Config.LOCAL_STORAGE_PROMOTIONS)
+
+    async def stop(self):
+        tasks = list(self._promoting.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def accepts(self, size: int) -> bool:
+        return 0 < size <= min(Config.LOCAL_STORAGE_MAX_FILE_SIZE, self.max_bytes)
+
+    async def put(self, path: str, key: Optional[int] = None, file_name: Optional[str] = None,
+                  mime_type: Optional[str] = None, move: bool = False, **options) -> StoredObject:
+        """Store a copy of the object `key`; with `move` the file is renamed in instead of copied"""
+        if key is None:
+            raise ValueError("local copies are stored under the key Telegram assigned")
+        target = self._path(key)
+        loop = asyncio.get_running_loop()
+        if move:
+            try:
+                os.replace(path, target)
+            except OSError:
+                # Another filesystem, fall back to copying
+                await loop.run_in_executor(None, shutil.copyfile, path, target)
+                os.remove(path)
+        else:
+            await loop.run_in_executor(None, shutil.copyfile, path, target)
+        stored = StoredObject(key, os.path.getsize(target), mime_type or "application/octet-stream",
+                              file_name or f"file_{key}", target)
+        with open(target + ".json", "w") as f:
+            json.dump({"size": stored.size, "mime_type": stored.mime_type, "file_name": stored.file_name}, f)
+        self._objects[key] = stored
+        self._files.add(str(key))
+        return stored
+
+    async def get_range(self, key: int, start: int, end: int, size: int) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        STORAGE_READS.inc(backend=self.name)
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = await loop.run_in_executor(None, f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    async def stat(self, key: int) -> Optional[StoredObject]:
+        stored = self._objects.get(key)
+        if stored is None:
+            return None
+        if not os.path.exists(stored.ref):
+            self._drop(key)
+            return None
+        self._files.touch(str(key))
+        try:
+            # The access time orders the index rebuilt on restart; the mtime stays, it is part of the ETag
+            os.utime(stored.ref, ns=(time.time_ns(), os.stat(stored.ref).st_mtime_ns))
+        except OSError:
+            pass
+        return stored
+
+    async def delete(self, keys: List[int]):
+        for key in keys:
+            self._drop(key)
+
+    def promote(self, stored: StoredObject, source: StorageBackend):
+        """Copy an object from `source` in the background, unless it is here or on its way"""
+        if stored.key in self._objects or stored.key in self._promoting or not self.accepts(stored.size):
+            return
+        task = asyncio.create_task(self._promote(stored, source))
+        self._promoting[stored.key] = task
+        task.add_done_callback(lambda _: self._promoting.pop(stored.key, None))
+
+    async def _promote(self, stored: StoredObject, source: StorageBackend):
+        temp_path = self._path(stored.key) + TEMP_SUFFIX
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._slots:
+                with open(temp_path, "wb") as f:
+                    async for chunk in source.get_range(stored.key, 0, stored.size - 1, stored.size):
+                        await loop.run_in_executor(None, f.write, chunk)
+            if os.path.getsize(temp_path) != stored.size:
+                raise IOError(f"got {os.path.getsize(temp_path)} of {stored.size} bytes")
+            await self.put(temp_path, stored.key, stored.file_name, stored.mime_type, move=True)
+            PROMOTIONS.inc(outcome="ok")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            PROMOTIONS.inc(outcome="error")
+            logger.warning(f"Copying message {stored.key} to local storage failed: {e}")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    # Index
+    def _path(self, key: int) -> str:
+        return self._files.path(str(key))
+
+    def _drop(self, key: int):
+        self._files.drop(str(key))
+        self._forget(str(key))
+
+    def _forget(self, name: str):
+        self._objects.pop(int(name), None)
+        try:
+            os.remove(self._files.path(name) + ".json")
+        except OSError:
+            pass
+
+    def _load_object(self, name: str) -> bool:
+        if not name.isdigit():
+            return False
+        path = self._files.path(name)
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            # No usable metadata, Telegram still has the file
+            os.remove(path)
+            return False
+        self._objects[int(name)] = StoredObject(int(name), os.path.getsize(path), meta["mime_type"],
+                                                meta["file_name"], path)
+        return True
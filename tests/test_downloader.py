@@ -0,0 +1,45 @@
+import asyncio
+import hashlib
+import os
+import downloader
+
+MB = downloader.CHUNK_SIZE
+
+class FakeClient:
+    """stream_media over an in-memory file; `short_once` ends the first stream after that many parts"""
+
+    def __init__(self, data: bytes, short_once: int = 0):
+        self.data = data
+        self.short_once = short_once
+        self.calls = 0
+
+    async def stream_media(self, message, offset: int = 0):
+        self.calls += 1
+        for index in range(offset, -(-len(self.data) // MB)):
+            if self.calls == 1 and self.short_once and index == self.short_once:
+                return  # pyrogram ends the stream instead of raising
+            yield self.data[index * MB:(index + 1) * MB]
+
+def download(tmp_path, client: FakeClient):
+    async def run():
+        return await downloader.download_media(client, None, str(tmp_path / "file"), len(client.data))
+    return asyncio.run(asyncio.wait_for(run(), 10))
+
+def test_partial_last_part_finishes_in_one_stream(tmp_path):
+    data = os.urandom(5 * MB + 123)
+    client = FakeClient(data)
+    path, digest = download(tmp_path, client)
+    assert client.calls == 1
+    assert os.path.getsize(path) == len(data)
+    assert digest == hashlib.sha256(data).hexdigest()
+
+def test_short_stream_resumes_from_last_part(tmp_path, monkeypatch):
+    sleep = asyncio.sleep
+    monkeypatch.setattr(downloader.asyncio, "sleep", lambda seconds: sleep(0))
+    data = os.urandom(3 * MB + 1)
+    client = FakeClient(data, short_once=2)
+    path, digest = download(tmp_path, client)
+    assert client.calls == 2
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert digest == hashlib.sha256(data).hexdigest()